@@ -0,0 +1,75 @@
+"""
+Compares the streaming HashEngine against hashing whole files on the main thread.
+
+Usage:
+    python benchmarks/bench_hashing.py [--files 8] [--size-mb 256] [--tiny 2000]
+
+Each approach runs in its own subprocess so the reported peak RSS is not shared between them.
+"""
+
+import argparse
+import hashlib
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def make_tree(root: str, files: int, size_mb: int, tiny: int) -> None:
+    chunk = os.urandom(1024 * 1024)
+    for i in range(files):
+        with open(os.path.join(root, f"big_{i}.bin"), "wb") as f:
+            for _ in range(size_mb):
+                f.write(chunk)
+    for i in range(tiny):
+        with open(os.path.join(root, f"tiny_{i}.txt"), "wb") as f:
+            f.write(os.urandom(512))
+
+
+def run_baseline(paths) -> dict:
+    return {p: hashlib.md5(open(p, "rb").read()).hexdigest() for p in paths}
+
+
+def run_engine(paths) -> dict:
+    from argsync.hashing import HashEngine
+
+    with HashEngine() as engine:
+        return dict(engine.imap_unordered(paths))
+
+
+def child(mode: str, root: str) -> None:
+    paths = sorted(os.path.join(root, f) for f in os.listdir(root))
+    start = time.perf_counter()
+    digests = run_baseline(paths) if mode == "baseline" else run_engine(paths)
+    elapsed = time.perf_counter() - start
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    checksum = hashlib.md5("".join(digests[p] for p in paths).encode()).hexdigest()
+    print(f"{mode:<10} {elapsed:8.2f}s  peak RSS {peak_kb / 1024:8.1f} MiB  checksum {checksum[:8]}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=8, help="Number of large files.")
+    parser.add_argument("--size-mb", type=int, default=256, help="Size of each large file in MiB.")
+    parser.add_argument("--tiny", type=int, default=2000, help="Number of 512-byte files.")
+    parser.add_argument("--child", choices=["baseline", "engine"], help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.root)
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"Writing {args.files} x {args.size_mb} MiB and {args.tiny} tiny files...")
+        make_tree(root, args.files, args.size_mb, args.tiny)
+        for mode in ("baseline", "engine"):
+            subprocess.run([sys.executable, __file__, "--child", mode, "--root", root], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures how long the argsync CLI takes to start, and checks that it does not load the sync dependencies early.
+
+Usage:
+    python benchmarks/bench_import.py [--runs 10] [--max-ms 250]
+
+Every run starts a fresh interpreter, so nothing is cached in sys.modules between runs. With --max-ms the script
+exits with an error when the median of a case is slower, so it can guard against startup regressions in CI. The
+script also fails when one of the light commands loads a module of HEAVY_MODULES.
+
+remove-profile runs against an empty temporary config directory, so no saved credentials are removed.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules that only the commands doing the actual syncing should load
+HEAVY_MODULES = ("pydrive2", "googleapiclient", "oauth2client", "tqdm", "yaml", "aiohttp")
+
+# Commands that print or remove something local, and should start as fast as the interpreter allows
+LIGHT_COMMANDS = {
+    "argsync --help": ["--help"],
+    "argsync push --help": ["push", "--help"],
+    "argsync pull --help": ["pull", "--help"],
+    "argsync watch --help": ["watch", "--help"],
+    "argsync run --help": ["run", "--help"],
+    "argsync remove-profile": ["remove-profile"],
+}
+
+
+def command_code(args: list) -> str:
+    code = ""
+    if "remove-profile" in args:
+        # The credentials saved before the config directory existed are left alone too
+        code += "import argsync.credentials, pathlib, os\n"
+        code += "argsync.credentials.LEGACY_PATH = pathlib.Path(os.environ['ARGSYNC_CREDENTIALS'] + '.legacy')\n"
+    code += f"from argsync.main import cli\ntry:\n    cli({args!r})\nexcept SystemExit:\n    pass\n"
+    return code
+
+
+CASES = {"import argsync.main": "import argsync.main"}
+CASES.update({name: command_code(args) for name, args in LIGHT_COMMANDS.items()})
+
+
+def time_case(code: str, runs: int, env: dict) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL, env=env)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def loaded_heavy_modules(code: str, env: dict) -> list:
+    # The command output goes to stdout, so the loaded modules are reported on stderr
+    code += f"import sys\nprint(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules), file=sys.stderr)\n"
+    return subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True, env=env
+    ).stderr.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs of each case.")
+    parser.add_argument("--max-ms", type=float, help="Fail when the median of a case is slower than this.")
+    args = parser.parse_args()
+
+    config_dir = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_CONFIG_HOME=config_dir, ARGSYNC_CREDENTIALS=os.path.join(config_dir, "credentials.json"))
+
+    baseline = time_case("pass", args.runs, env)
+    print(f"{'python -c pass':<24} {baseline:8.1f} ms")
+    failed = False
+    for name, code in CASES.items():
+        median = time_case(code, args.runs, env)
+        print(f"{name:<24} {median:8.1f} ms  ({median - baseline:+.1f} ms over the interpreter)")
+        if args.max_ms is not None and median > args.max_ms:
+            failed = True
+
+    heavy = False
+    for name, command_args in LIGHT_COMMANDS.items():
+        loaded = loaded_heavy_modules(command_code(command_args), env)
+        if loaded:
+            print(f"{name} loaded {', '.join(loaded)}")
+            heavy = True
+    if heavy:
+        failed = True
+    else:
+        print("No light command loaded any of " + ", ".join(HEAVY_MODULES))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
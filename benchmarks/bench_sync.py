@@ -0,0 +1,179 @@
+"""
+Runs push and pull end to end against an in-process FakeDrive and reports wall time, API calls and memory.
+
+Usage:
+    python benchmarks/bench_sync.py [--scenarios tiny,huge,deep,wide] [--scale 1.0] [--workers 5]
+                                    [--latency 0.02] [--bandwidth-mb 0] [--rate-limit 0] [--adaptive]
+                                    [--transport threads] [--json results.json]
+
+Scenarios:
+    tiny    many 1 KiB files spread over a few folders
+    huge    a few large files
+    deep    a long chain of nested folders with a few files each
+    wide    one level of many folders
+
+Every scenario runs in its own subprocess, so peak RSS is not shared between them. Each one goes through
+an initial push, a push with nothing to do, a push after modifying part of the tree, an initial pull and a
+pull with nothing to do.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ("tiny", "huge", "deep", "wide")
+
+
+def write_file(path: str, size: int) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(os.urandom(min(remaining, 1024 * 1024)))
+            remaining -= 1024 * 1024
+
+
+def make_tree(scenario: str, root: str, scale: float) -> None:
+    if scenario == "tiny":
+        for i in range(int(2000 * scale)):
+            write_file(os.path.join(root, f"dir_{i % 20}", f"tiny_{i}.txt"), 1024)
+    elif scenario == "huge":
+        for i in range(max(int(3 * scale), 1)):
+            write_file(os.path.join(root, f"huge_{i}.bin"), 128 * 1024 * 1024)
+    elif scenario == "deep":
+        path = root
+        for depth in range(max(int(30 * scale), 1)):
+            path = os.path.join(path, f"level_{depth}")
+            for i in range(3):
+                write_file(os.path.join(path, f"file_{i}.txt"), 4096)
+    elif scenario == "wide":
+        for i in range(max(int(500 * scale), 1)):
+            for j in range(4):
+                write_file(os.path.join(root, f"folder_{i}", f"file_{j}.txt"), 4096)
+
+
+def modify_tree(root: str) -> None:
+    # Rewrites, removes and adds about a tenth of the files each
+    paths = sorted(os.path.join(d, f) for d, _, files in os.walk(root) for f in files)
+    rng = random.Random(0)
+    sample = rng.sample(paths, max(len(paths) // 10, 1))
+    for n, path in enumerate(sample):
+        if n % 3 == 0:
+            write_file(path, os.path.getsize(path))
+        elif n % 3 == 1:
+            write_file(path + ".new", 4096)
+        else:
+            os.remove(path)
+
+
+def peak_rss_mb() -> float:
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return peak_kb / 1024
+
+
+def child(scenario: str, args: argparse.Namespace) -> None:
+    from fakedrive import FakeDrive
+
+    from argsync.pull import pull
+    from argsync.push import push
+
+    work = tempfile.mkdtemp(prefix="argsync-bench-")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work, "cache")
+    src = os.path.join(work, "src", scenario)
+    dest = os.path.join(work, "dest")
+    os.makedirs(src)
+    os.makedirs(dest)
+    make_tree(scenario, src, args.scale)
+
+    drive = FakeDrive(
+        root=os.path.join(work, "drive"),
+        latency=args.latency,
+        bandwidth=args.bandwidth_mb * 1024 * 1024 or None,
+        rate_limit=args.rate_limit or None,
+    )
+    options = {"drive": drive, "adaptive": args.adaptive, "transport": args.transport}
+    phases = [
+        ("push", lambda: push(src, "gdrive:", (), args.workers, **options)),
+        ("push again", lambda: push(src, "gdrive:", (), args.workers, **options)),
+        ("push modified", lambda: (modify_tree(src), push(src, "gdrive:", (), args.workers, **options))),
+        ("pull", lambda: pull(f"gdrive:{scenario}", dest, args.workers, **options)),
+        ("pull again", lambda: pull(f"gdrive:{scenario}", dest, args.workers, **options)),
+    ]
+    results = []
+    try:
+        for name, run in phases:
+            drive.reset_stats()
+            start = time.perf_counter()
+            error = None
+            try:
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    run()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - start
+            results.append({"scenario": scenario, "phase": name, "seconds": elapsed, "peak_rss_mb": peak_rss_mb()})
+            results[-1].update(drive.stats(), error=error)
+            if error is not None:
+                break
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(results))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the number of files of every scenario.")
+    parser.add_argument("--workers", type=int, default=5, help="Number of transfer workers.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every API round trip.")
+    parser.add_argument("--bandwidth-mb", type=float, default=0, help="MiB/s per connection, 0 for unlimited.")
+    parser.add_argument("--rate-limit", type=float, default=0, help="API calls per second, 0 for unlimited.")
+    parser.add_argument("--adaptive", action="store_true", help="Run with adaptive concurrency.")
+    parser.add_argument(
+        "--transport", choices=("threads", "async"), default="threads", help="Transport of push and pull."
+    )
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args)
+        return
+
+    argv = sys.argv[1:]
+    results = []
+    print(
+        f"{'scenario':<8} {'phase':<14} {'seconds':>8} {'calls':>7} {'trips':>7} "
+        f"{'MiB up':>8} {'MiB down':>9} {'limited':>7} {'peak RSS':>9}"
+    )
+    for scenario in args.scenarios.split(","):
+        out = subprocess.run(
+            [sys.executable, __file__, *argv, "--child", scenario], check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        for row in json.loads(out.strip().splitlines()[-1]):
+            results.append(row)
+            print(
+                f"{row['scenario']:<8} {row['phase']:<14} {row['seconds']:8.2f} {row['total_calls']:7d} "
+                f"{row['round_trips']:7d} {row['bytes_up'] / 2**20:8.1f} {row['bytes_down'] / 2**20:9.1f} "
+                f"{row['rate_limited']:7d} {row['peak_rss_mb']:7.1f}MB"
+            )
+            if row["error"]:
+                print(f"{'':<8} failed: {row['error'].splitlines()[0]}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
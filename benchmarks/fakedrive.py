@@ -0,0 +1,819 @@
+"""
+An in-process stand-in for pydrive2's GoogleDrive, for measuring push and pull without a Google account.
+
+FakeDrive keeps metadata in memory and file content on local disk, and answers every call argsync makes:
+ListFile queries, CreateFile/Upload/Trash/GetContentFile, the drive.auth.service files, changes and batch
+endpoints, and the raw resumable-upload and ranged-download requests. The raw requests, and the REST calls of
+the async transport, are also served over HTTP on a local port, started the first time api_url is read. Each round trip can be slowed down
+by a fixed latency and a bandwidth cap, and throttled by a rate limit that fails calls the way Google Drive
+does. Calls and bytes are counted so benchmarks can report them.
+
+Calls served without HTTP report to the metrics of the drive themselves, see argsync.metrics.instrument. The
+others go through the http objects argsync instruments like it does for Google Drive.
+"""
+
+import collections
+import datetime
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httplib2
+from googleapiclient.errors import HttpError
+from pydrive2.files import ApiRequestError
+
+from argsync.metrics import metrics_for
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+ROOT_ID = "root"
+# Google Drive's default page size for files.list and changes.list
+DEFAULT_PAGE_SIZE = 100
+# PyDrive2's GetList uses this page size when the caller does not set maxResults
+GETLIST_PAGE_SIZE = 1000
+
+_TOKEN_RE = re.compile(r"\s*(\(|\)|'(?:[^'\\]|\\.)*'|!=|=|\w+)")
+
+
+def _parse_query(q: str) -> Callable[[Dict], bool]:
+    """
+    Compiles the subset of the Drive v2 query language used by argsync into a predicate.
+
+    Supported terms are `'<id>' in parents`, and `=`/`!=` comparisons on title, mimeType and trashed,
+    combined with and, or, not and parentheses.
+
+    Args:
+        q (str): The query.
+
+    Returns:
+        function: Tells whether a file resource matches the query.
+    """
+    tokens = _TOKEN_RE.findall(q)
+    pos = 0
+
+    def peek() -> Optional[str]:
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take() -> str:
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError(f"Unexpected end of query: {q}")
+        pos += 1
+        return tokens[pos - 1]
+
+    def literal(token: str) -> Any:
+        if token.startswith("'"):
+            return token[1:-1].replace("\\'", "'")
+        if token in ("true", "false"):
+            return token == "true"
+        raise ValueError(f"Unsupported value {token} in query: {q}")
+
+    def field(resource: Dict, name: str) -> Any:
+        if name == "trashed":
+            return resource["labels"]["trashed"]
+        return resource.get(name)
+
+    def factor() -> Callable[[Dict], bool]:
+        token = take()
+        if token == "not":
+            inner = factor()
+            return lambda r: not inner(r)
+        if token == "(":
+            inner = expr()
+            take()
+            return inner
+        if token.startswith("'") and peek() == "in":
+            take()
+            if take() != "parents":
+                raise ValueError(f"Unsupported membership test in query: {q}")
+            parent_id = literal(token)
+            return lambda r: any(p["id"] == parent_id for p in r["parents"])
+        op, value = take(), literal(take())
+        if op == "=":
+            return lambda r: field(r, token) == value
+        if op == "!=":
+            return lambda r: field(r, token) != value
+        raise ValueError(f"Unsupported operator {op} in query: {q}")
+
+    def term() -> Callable[[Dict], bool]:
+        parts = [factor()]
+        while peek() == "and":
+            take()
+            parts.append(factor())
+        return lambda r: all(p(r) for p in parts)
+
+    def expr() -> Callable[[Dict], bool]:
+        parts = [term()]
+        while peek() == "or":
+            take()
+            parts.append(term())
+        return lambda r: any(p(r) for p in parts)
+
+    predicate = expr()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected {tokens[pos]} in query: {q}")
+    return predicate
+
+
+def _project(resource: Dict, fields: Optional[str]) -> Dict:
+    """
+    Applies a partial-response selector like `items(id,title,parents(id))` to one item.
+
+    Args:
+        resource (dict): The full file resource.
+        fields (str): The fields parameter of the call. None returns the full resource.
+
+    Returns:
+        dict: The selected part of the resource.
+    """
+    if not fields:
+        return resource
+    match = re.search(r"items\(([^()]*(?:\([^()]*\)[^()]*)*)\)", fields)
+    if match is None:
+        return resource
+    selected = {}
+    for name in re.findall(r"(\w+)(?:\([^()]*\))?", match.group(1)):
+        if name in resource:
+            selected[name] = resource[name]
+    return selected
+
+
+def _error(status: int, reason: str, message: str) -> HttpError:
+    content = json.dumps({"error": {"code": status, "message": message, "errors": [{"reason": reason}]}})
+    return HttpError(httplib2.Response({"status": status}), content.encode())
+
+
+class FakeDrive:
+    """
+    A GoogleDrive-compatible backend that lives in the current process.
+
+    Attributes:
+        calls (collections.Counter): Number of API round trips by endpoint, e.g. "files.list" or "batch".
+        bytes_up (int): Number of content bytes uploaded.
+        bytes_down (int): Number of content and listing bytes downloaded.
+        rate_limited (int): Number of calls rejected by the rate limit.
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        rate_limit: Optional[float] = None,
+    ):
+        """
+        Args:
+            root (str): Directory for file content. A temporary directory is used when None.
+            latency (float): Seconds added to every round trip.
+            bandwidth (float): Bytes per second of every connection. None means unlimited.
+            rate_limit (float): Calls per second allowed, with a burst of the same size. None means unlimited.
+        """
+        self._own_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix="argsync-fakedrive-")
+        os.makedirs(self.root, exist_ok=True)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._files: Dict[str, Dict] = {}
+        self._changes: List[Tuple[int, str]] = []
+        self._sessions: Dict[str, Dict] = {}
+        self._tokens = float(rate_limit or 0)
+        self._refilled = time.monotonic()
+        self.calls: collections.Counter = collections.Counter()
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.rate_limited = 0
+        self.auth = FakeAuth(self)
+        self._server: Optional[_FakeServer] = None
+
+    # pydrive2 entry points
+
+    def ListFile(self, param: Optional[Dict] = None) -> "FakeFileList":
+        return FakeFileList(self, param)
+
+    def CreateFile(self, metadata: Optional[Dict] = None) -> "FakeFile":
+        return FakeFile(self, metadata)
+
+    # Accounting
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns a snapshot of the counters.
+
+        Returns:
+            dict: The calls by endpoint, the number of calls and of HTTP round trips, the bytes moved and the
+                number of rate-limited calls.
+        """
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                # Every call counts against the quota, including those inside a batch
+                "total_calls": sum(n for endpoint, n in self.calls.items() if endpoint != "batch"),
+                # A batch is a single HTTP exchange however many calls it carries
+                "round_trips": sum(n for endpoint, n in self.calls.items() if not endpoint.startswith("batch.")),
+                "bytes_up": self.bytes_up,
+                "bytes_down": self.bytes_down,
+                "rate_limited": self.rate_limited,
+            }
+
+    def reset_stats(self) -> None:
+        """Zeroes the counters, e.g. between the phases of a benchmark."""
+        with self._lock:
+            self.calls.clear()
+            self.bytes_up = self.bytes_down = self.rate_limited = 0
+
+    def round_trip(
+        self, endpoint: str, up: int = 0, down: int = 0, limited: bool = True, over_http: bool = False
+    ) -> None:
+        """
+        Accounts for one request/response exchange, and sleeps for its latency and transfer time.
+
+        Args:
+            endpoint (str): The name the call is counted under.
+            up (int): Number of bytes sent.
+            down (int): Number of bytes received.
+            limited (bool): Whether the call counts against the rate limit.
+            over_http (bool): Whether the call came in as an HTTP request, which argsync reports itself.
+
+        Raises:
+            HttpError: 403 userRateLimitExceeded if the rate limit is exhausted.
+        """
+        status = 200
+        try:
+            self.admit(endpoint, up, down, limited)
+        except HttpError as e:
+            status = e.resp.status
+            raise
+        finally:
+            delay = self.latency
+            if self.bandwidth:
+                delay += (up + down) / self.bandwidth
+            if delay:
+                time.sleep(delay)
+            if not over_http:
+                metrics_for(self).record_call(endpoint, delay, status, up, down)
+
+    def admit(self, endpoint: str, up: int = 0, down: int = 0, limited: bool = True) -> None:
+        """
+        Counts a call and charges it against the rate limit, without any delay.
+
+        Args:
+            endpoint (str): The name the call is counted under.
+            up (int): Number of bytes sent.
+            down (int): Number of bytes received.
+            limited (bool): Whether the call counts against the rate limit.
+
+        Raises:
+            HttpError: 403 userRateLimitExceeded if the rate limit is exhausted.
+        """
+        with self._lock:
+            self.calls[endpoint] += 1
+            if self.rate_limit and limited:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.rate_limited += 1
+                    raise _error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+                self._tokens -= 1
+            self.bytes_up += up
+            self.bytes_down += down
+
+    def received(self, down: int) -> None:
+        """Counts response bytes whose size is only known after the call ran."""
+        with self._lock:
+            self.bytes_down += down
+
+    # Storage
+
+    def blob_path(self, file_id: str) -> str:
+        return os.path.join(self.root, file_id)
+
+    def get(self, file_id: str) -> Dict:
+        """
+        Returns the resource of a file.
+
+        Raises:
+            HttpError: 404 if there is no such file.
+        """
+        with self._lock:
+            resource = self._files.get(file_id)
+            if resource is None:
+                raise _error(404, "notFound", f"File not found: {file_id}")
+            return json.loads(json.dumps(resource))
+
+    def put(self, metadata: Dict, content_path: Optional[str] = None, file_id: Optional[str] = None) -> Dict:
+        """
+        Creates a file, or updates it when file_id is given, and records the change.
+
+        Args:
+            metadata (dict): The fields to set, e.g. title, parents and mimeType.
+            content_path (str): A local file holding the new content, moved into the store. None keeps the content.
+            file_id (str): The ID of the file to update.
+
+        Returns:
+            dict: The resulting file resource.
+        """
+        if content_path is not None:
+            md5 = hashlib.md5()
+            with open(content_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(chunk)
+        with self._lock:
+            if file_id is None:
+                file_id = f"fake{next(self._ids):08d}"
+                resource = self._new_resource(file_id)
+                self._files[file_id] = resource
+            else:
+                resource = self._files.get(file_id)
+                if resource is None:
+                    raise _error(404, "notFound", f"File not found: {file_id}")
+            resource.update({k: v for k, v in metadata.items() if k not in ("id", "labels")})
+            if content_path is not None:
+                shutil.move(content_path, self.blob_path(file_id))
+                resource["fileSize"] = str(os.path.getsize(self.blob_path(file_id)))
+                resource["md5Checksum"] = md5.hexdigest()
+            resource["modifiedDate"] = _now()
+            self._record_change(file_id)
+            return json.loads(json.dumps(resource))
+
+    def patch(self, file_id: str, body: Optional[Dict], add_parents: str = "", remove_parents: str = "") -> Dict:
+        with self._lock:
+            resource = self._files.get(file_id)
+            if resource is None:
+                raise _error(404, "notFound", f"File not found: {file_id}")
+            resource.update({k: v for k, v in (body or {}).items() if k not in ("id", "labels")})
+            if "labels" in (body or {}):
+                resource["labels"].update(body["labels"])
+            removed = set(filter(None, (remove_parents or "").split(",")))
+            parents = [p for p in resource["parents"] if p["id"] not in removed]
+            parents += [{"id": p} for p in filter(None, (add_parents or "").split(","))]
+            resource["parents"] = parents
+            resource["modifiedDate"] = _now()
+            self._record_change(file_id)
+            return json.loads(json.dumps(resource))
+
+    def trash(self, file_id: str) -> Dict:
+        return self.patch(file_id, {"labels": {"trashed": True}})
+
+    def copy(self, file_id: str, body: Optional[Dict]) -> Dict:
+        """
+        Creates a copy of a file, with the fields of body set on it, without any bytes going over the wire.
+
+        Raises:
+            HttpError: 404 if there is no such file.
+        """
+        with self._lock:
+            source = self._files.get(file_id)
+            if source is None:
+                raise _error(404, "notFound", f"File not found: {file_id}")
+            copy_id = f"fake{next(self._ids):08d}"
+            resource = self._new_resource(copy_id)
+            resource.update(
+                {k: source[k] for k in ("title", "mimeType", "parents", "fileSize", "md5Checksum") if k in source}
+            )
+            resource.update({k: v for k, v in (body or {}).items() if k not in ("id", "labels")})
+            if os.path.exists(self.blob_path(file_id)):
+                shutil.copyfile(self.blob_path(file_id), self.blob_path(copy_id))
+            self._files[copy_id] = resource
+            self._record_change(copy_id)
+            return json.loads(json.dumps(resource))
+
+    def query(self, q: Optional[str]) -> List[Dict]:
+        predicate = _parse_query(q) if q else (lambda r: True)
+        with self._lock:
+            return [json.loads(json.dumps(r)) for r in self._files.values() if predicate(r)]
+
+    def changes_since(self, change_id: int) -> Tuple[List[Tuple[int, str]], int]:
+        with self._lock:
+            return [c for c in self._changes if c[0] >= change_id], len(self._changes) + 1
+
+    def _new_resource(self, file_id: str) -> Dict:
+        # The fields that make a real resource a couple of KiB, so listings cost what they cost on Google Drive
+        return {
+            "kind": "drive#file",
+            "id": file_id,
+            "etag": f'"{file_id}"',
+            "selfLink": f"https://www.googleapis.com/drive/v2/files/{file_id}",
+            "alternateLink": f"https://drive.google.com/file/d/{file_id}/view",
+            "iconLink": "https://drive-thirdparty.googleusercontent.com/16/type/application/octet-stream",
+            "title": "",
+            "mimeType": "application/octet-stream",
+            "labels": {"starred": False, "hidden": False, "trashed": False, "restricted": False, "viewed": True},
+            "createdDate": _now(),
+            "modifiedDate": _now(),
+            "parents": [{"kind": "drive#parentReference", "id": ROOT_ID, "isRoot": True}],
+            "userPermission": {"kind": "drive#permission", "role": "owner", "type": "user"},
+            "owners": [{"kind": "drive#user", "displayName": "Fake User", "emailAddress": "fake@example.com"}],
+            "lastModifyingUserName": "Fake User",
+            "editable": True,
+            "copyable": True,
+            "writersCanShare": True,
+            "shared": False,
+            "spaces": ["drive"],
+            "capabilities": {"canCopy": True, "canEdit": True},
+        }
+
+    def _record_change(self, file_id: str) -> None:
+        self._changes.append((len(self._changes) + 1, file_id))
+
+    # HTTP
+
+    @property
+    def api_url(self) -> str:
+        """The base URL of the HTTP server on 127.0.0.1, e.g. for argsync.aio. The server starts on first use."""
+        with self._lock:
+            if self._server is None:
+                self._server = _FakeServer(("127.0.0.1", 0), _FakeHandler)
+                self._server.drive = self
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    # Cleanup
+
+    def close(self) -> None:
+        """Stops the HTTP server, and removes the content directory if FakeDrive created it."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self) -> "FakeDrive":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _size(payload: Any) -> int:
+    return len(json.dumps(payload))
+
+
+class FakeFile(dict):
+    """The GoogleDriveFile counterpart of FakeDrive."""
+
+    def __init__(self, drive: FakeDrive, metadata: Optional[Dict] = None):
+        super().__init__(metadata or {})
+        self.drive = drive
+        self._content_path: Optional[str] = None
+
+    def SetContentFile(self, filename: str) -> None:
+        self._content_path = filename
+
+    def Upload(self, param: Optional[Dict] = None) -> None:
+        staged = None
+        up = _size(dict(self))
+        if self._content_path is not None:
+            fd, staged = tempfile.mkstemp(dir=self.drive.root)
+            os.close(fd)
+            shutil.copyfile(self._content_path, staged)
+            up += os.path.getsize(staged)
+        endpoint = "files.update" if "id" in self else "files.insert"
+        try:
+            self.drive.round_trip(endpoint, up=up)
+            resource = self.drive.put(dict(self), staged, self.get("id"))
+        except HttpError as e:
+            if staged is not None and os.path.exists(staged):
+                os.remove(staged)
+            raise ApiRequestError(e)
+        self.clear()
+        self.update(resource)
+
+    def Trash(self, param: Optional[Dict] = None) -> None:
+        try:
+            self.drive.round_trip("files.trash")
+            self.update(self.drive.trash(self["id"]))
+        except HttpError as e:
+            raise ApiRequestError(e)
+
+    def GetContentFile(self, filename: str, mimetype: Optional[str] = None, **kwargs) -> None:
+        try:
+            resource = self.drive.get(self["id"])
+            size = int(resource.get("fileSize", 0))
+            self.drive.round_trip("files.get_media", down=size)
+        except HttpError as e:
+            raise ApiRequestError(e)
+        blob = self.drive.blob_path(self["id"])
+        if os.path.exists(blob):
+            shutil.copyfile(blob, filename)
+        else:
+            open(filename, "wb").close()
+
+
+class FakeFileList:
+    """The GoogleDriveFileList counterpart of FakeDrive."""
+
+    def __init__(self, drive: FakeDrive, param: Optional[Dict] = None):
+        self.drive = drive
+        self.param = dict(param or {})
+
+    def GetList(self) -> List[FakeFile]:
+        # Like PyDrive2: without maxResults every page is fetched, 1000 items at a time.
+        # With maxResults only the first page is returned.
+        page_size = self.param.get("maxResults")
+        items = self.drive.query(self.param.get("q"))
+        pages = [
+            items[i : i + (page_size or GETLIST_PAGE_SIZE)]
+            for i in range(0, len(items), page_size or GETLIST_PAGE_SIZE)
+        ]
+        if page_size is not None:
+            pages = pages[:1]
+        result = []
+        for page in pages or [[]]:
+            page = [_project(item, self.param.get("fields")) for item in page]
+            try:
+                self.drive.round_trip("files.list", up=_size(self.param), down=_size(page))
+            except HttpError as e:
+                raise ApiRequestError(e)
+            result.extend(FakeFile(self.drive, item) for item in page)
+        return result
+
+
+class FakeRequest:
+    """A googleapiclient HttpRequest whose execute runs a function against FakeDrive."""
+
+    def __init__(self, drive: FakeDrive, endpoint: str, fn: Callable[[], Any], up: int = 0):
+        self.drive = drive
+        self.endpoint = endpoint
+        self.fn = fn
+        self.up = up
+
+    def run(self) -> Any:
+        response = self.fn()
+        self.drive.received(_size(response))
+        return response
+
+    def execute(self, http: Any = None, num_retries: int = 0) -> Any:
+        self.drive.round_trip(self.endpoint, up=self.up)
+        return self.run()
+
+
+class FakeBatch:
+    """A BatchHttpRequest that sends all its calls to FakeDrive in one round trip."""
+
+    def __init__(self, drive: FakeDrive, callback: Optional[Callable] = None):
+        self.drive = drive
+        self.callback = callback
+        self._requests: List[Tuple[str, FakeRequest, Optional[Callable]]] = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None, request_id: Optional[str] = None) -> None:
+        self._requests.append((request_id or str(len(self._requests)), request, callback))
+
+    def execute(self, http: Any = None) -> None:
+        # One round trip for the whole batch, but every call in it counts against the rate limit
+        self.drive.round_trip("batch", up=sum(r.up for _, r, _ in self._requests), limited=False)
+        for request_id, request, callback in self._requests:
+            callback = callback or self.callback
+            try:
+                self.drive.admit(f"batch.{request.endpoint}")
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class FakeFilesResource:
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def insert(self, body: Dict, **kwargs) -> FakeRequest:
+        return FakeRequest(self.drive, "files.insert", lambda: self.drive.put(body), _size(body))
+
+    def patch(
+        self, fileId: str, body: Optional[Dict] = None, addParents: str = "", removeParents: str = "", **kwargs
+    ) -> FakeRequest:
+        return FakeRequest(
+            self.drive, "files.patch", lambda: self.drive.patch(fileId, body, addParents, removeParents), _size(body)
+        )
+
+    def trash(self, fileId: str, **kwargs) -> FakeRequest:
+        return FakeRequest(self.drive, "files.trash", lambda: self.drive.trash(fileId))
+
+    def copy(self, fileId: str, body: Optional[Dict] = None, **kwargs) -> FakeRequest:
+        return FakeRequest(self.drive, "files.copy", lambda: self.drive.copy(fileId, body), _size(body))
+
+    def get(self, fileId: str, **kwargs) -> FakeRequest:
+        return FakeRequest(self.drive, "files.get", lambda: self.drive.get(fileId))
+
+
+class FakeChangesResource:
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def getStartPageToken(self, **kwargs) -> FakeRequest:
+        return FakeRequest(
+            self.drive, "changes.getStartPageToken", lambda: {"startPageToken": str(self.drive.changes_since(0)[1])}
+        )
+
+    def list(self, pageToken: str, maxResults: int = DEFAULT_PAGE_SIZE, **kwargs) -> FakeRequest:
+        return FakeRequest(self.drive, "changes.list", lambda: self._list(pageToken, maxResults))
+
+    def _list(self, page_token: str, max_results: int) -> Dict:
+        if not page_token.isdigit():
+            raise _error(400, "invalid", f"Invalid page token: {page_token}")
+        changes, next_id = self.drive.changes_since(int(page_token))
+        if not 0 < int(page_token) <= next_id:
+            raise _error(400, "invalid", f"Invalid page token: {page_token}")
+        page = changes[:max_results]
+        items = []
+        for change_id, file_id in page:
+            try:
+                resource = self.drive.get(file_id)
+            except HttpError:
+                resource = None
+            items.append({"id": str(change_id), "fileId": file_id, "deleted": resource is None, "file": resource})
+        if len(changes) > max_results:
+            return {"items": items, "nextPageToken": str(changes[max_results][0])}
+        return {"items": items, "newStartPageToken": str(next_id)}
+
+
+class FakeService:
+    """The drive.auth.service counterpart of FakeDrive."""
+
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def files(self) -> FakeFilesResource:
+        return FakeFilesResource(self.drive)
+
+    def changes(self) -> FakeChangesResource:
+        return FakeChangesResource(self.drive)
+
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatch:
+        return FakeBatch(self.drive, callback)
+
+
+class FakeHttp:
+    """
+    The authorized httplib2.Http counterpart of FakeDrive, serving resumable uploads and ranged downloads,
+    and the files list, insert, get, trash and multipart upload calls of the async transport.
+    """
+
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def request(
+        self, uri: str, method: str = "GET", body: Any = None, headers: Optional[Dict] = None, **kwargs
+    ) -> Tuple[httplib2.Response, bytes]:
+        headers = headers or {}
+        if isinstance(body, str):
+            body = body.encode()
+        parsed = urllib.parse.urlsplit(uri)
+        path, query = parsed.path, dict(urllib.parse.parse_qsl(parsed.query))
+        file_id = re.match(r"(?:/upload)?/drive/v2/files/([^/]+)", path)
+        file_id = file_id.group(1) if file_id else None
+        try:
+            if "upload_id" in query:
+                if query["upload_id"] in self.drive._sessions:
+                    return self._upload_chunk(query["upload_id"], body or b"", headers)
+            elif query.get("uploadType") == "resumable":
+                return self._start_session(uri, file_id, body, headers)
+            elif query.get("uploadType") == "multipart":
+                return self._multipart_upload(file_id, body or b"", headers)
+            elif query.get("alt") == "media":
+                return self._download_range(file_id, headers)
+            elif path == "/drive/v2/files":
+                if method == "GET":
+                    return self._list(uri, query)
+                if method == "POST":
+                    self.drive.round_trip("files.insert", up=len(body or b""), over_http=True)
+                    return _json_response(self.drive.put(json.loads(body or b"{}")))
+            elif path == f"/drive/v2/files/{file_id}/trash" and method == "POST":
+                self.drive.round_trip("files.trash", over_http=True)
+                return _json_response(self.drive.trash(file_id))
+            elif path == f"/drive/v2/files/{file_id}" and method == "GET":
+                self.drive.round_trip("files.get", over_http=True)
+                return _json_response(self.drive.get(file_id))
+        except HttpError as e:
+            return e.resp, e.content
+        return httplib2.Response({"status": 404}), b""
+
+    def _list(self, uri: str, query: Dict) -> Tuple[httplib2.Response, bytes]:
+        items = self.drive.query(query.get("q"))
+        offset, page_size = int(query.get("pageToken", 0)), int(query.get("maxResults", DEFAULT_PAGE_SIZE))
+        page = [_project(item, query.get("fields")) for item in items[offset : offset + page_size]]
+        self.drive.round_trip("files.list", up=len(uri), down=_size(page), over_http=True)
+        response = {"kind": "drive#fileList", "items": page}
+        if offset + page_size < len(items):
+            response["nextPageToken"] = str(offset + page_size)
+        return _json_response(response)
+
+    def _start_session(
+        self, uri: str, file_id: Optional[str], body: bytes, headers: Dict
+    ) -> Tuple[httplib2.Response, bytes]:
+        self.drive.round_trip("upload.session", up=len(body or b""), over_http=True)
+        fd, staged = tempfile.mkstemp(dir=self.drive.root)
+        os.close(fd)
+        upload_id = os.path.basename(staged)
+        parsed = urllib.parse.urlsplit(uri)
+        location = f"{parsed.scheme}://{parsed.netloc}/upload/drive/v2/files?uploadType=resumable&upload_id={upload_id}"
+        with self.drive._lock:
+            self.drive._sessions[upload_id] = {
+                "metadata": json.loads(body or b"{}"),
+                "file_id": file_id,
+                "size": int(headers["X-Upload-Content-Length"]),
+                "staged": staged,
+                "received": 0,
+            }
+        return httplib2.Response({"status": 200, "location": location}), b""
+
+    def _multipart_upload(self, file_id: Optional[str], body: bytes, headers: Dict) -> Tuple[httplib2.Response, bytes]:
+        self.drive.round_trip("files.update" if file_id else "files.insert", up=len(body), over_http=True)
+        boundary = re.search(r"boundary=\"?([^\";]+)", headers.get("Content-Type", "")).group(1).encode()
+        parts = [part.partition(b"\r\n\r\n")[2][: -len(b"\r\n")] for part in body.split(b"--" + boundary)[1:3]]
+        fd, staged = tempfile.mkstemp(dir=self.drive.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(parts[1])
+        return _json_response(self.drive.put(json.loads(parts[0]), staged, file_id))
+
+    def _upload_chunk(self, upload_id: str, body: bytes, headers: Dict) -> Tuple[httplib2.Response, bytes]:
+        session = self.drive._sessions[upload_id]
+        self.drive.round_trip("upload.chunk", up=len(body), over_http=True)
+        content_range = headers.get("Content-Range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", content_range)
+        if match and int(match.group(1)) == session["received"]:
+            with open(session["staged"], "ab") as f:
+                f.write(body)
+            session["received"] += len(body)
+        if session["received"] < session["size"]:
+            response = {"status": 308}
+            if session["received"]:
+                response["range"] = f"bytes=0-{session['received'] - 1}"
+            return httplib2.Response(response), b""
+        with self.drive._lock:
+            del self.drive._sessions[upload_id]
+        resource = self.drive.put(session["metadata"], session["staged"], session["file_id"])
+        return httplib2.Response({"status": 200}), json.dumps(resource).encode()
+
+    def _download_range(self, file_id: str, headers: Dict) -> Tuple[httplib2.Response, bytes]:
+        size = int(self.drive.get(file_id).get("fileSize", 0))
+        match = re.match(r"bytes=(\d+)-(\d+)", headers.get("Range", ""))
+        start, end = (int(match.group(1)), min(int(match.group(2)), size - 1)) if match else (0, size - 1)
+        self.drive.round_trip("files.get_media", down=end - start + 1, over_http=True)
+        with open(self.drive.blob_path(file_id), "rb") as f:
+            f.seek(start)
+            content = f.read(end - start + 1)
+        return httplib2.Response({"status": 206 if match else 200}), content
+
+
+def _json_response(resource: Dict) -> Tuple[httplib2.Response, bytes]:
+    return httplib2.Response({"status": 200, "content-type": "application/json"}), json.dumps(resource).encode()
+
+
+class _FakeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # The async transport opens hundreds of connections at once
+    request_queue_size = 1024
+
+
+class _FakeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves FakeHttp over HTTP, with keep-alive connections like Google's endpoints."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _serve(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        drive = self.server.drive
+        resp, content = FakeHttp(drive).request(drive.api_url + self.path, self.command, body, self.headers)
+        self.send_response(resp.status)
+        for name, value in resp.items():
+            if name not in ("status", "content-length"):
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeAuth:
+    """The GoogleAuth counterpart of FakeDrive."""
+
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+        self.service = FakeService(drive)
+        self.thread_local = threading.local()
+
+    def Get_Http_Object(self) -> FakeHttp:
+        return FakeHttp(self.drive)
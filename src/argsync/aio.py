@@ -0,0 +1,629 @@
+"""
+An asyncio transport for push and pull, as an alternative to one blocking PyDrive2 call per thread.
+
+Listing, folder creation, uploads, downloads and trashing run as coroutines on a single event loop, over a
+pool of keep-alive connections, so hundreds of requests can be in flight without hundreds of threads. The
+loop lives in a background thread for the lifetime of an AsyncEngine, and the engine's methods block until
+their coroutines are done, so push and pull keep their synchronous flow and share the sync plan.
+
+Needs aiohttp, installed with `pip install argsync[async]`.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+import click
+import httplib2
+import tqdm
+from googleapiclient.errors import HttpError
+from pydrive2.drive import GoogleDrive
+
+from argsync.credentials import expires_soon, refresh_credentials
+from argsync.hashing import file_md5
+from argsync.metrics import RunMetrics, call_kind, metrics_for
+from argsync.ranged import PART_SUFFIX
+from argsync.resumable import CHUNK_SIZE, RESUMABLE_THRESHOLD
+from argsync.throttle import MAX_RETRIES, backoff_delay, is_retryable, may_have_run
+from argsync.tree import FOLDER_MIME_TYPE, LIST_FIELDS, PARENTS_PER_QUERY, RemoteTree
+
+# Imported by the first AsyncEngine, so runs on the threads transport never pay for loading it
+aiohttp = None
+
+API_URL = "https://www.googleapis.com"
+# The largest page files.list returns
+LIST_PAGE_SIZE = 1000
+# Size of the pieces downloads are streamed to disk in
+READ_SIZE = 1024 * 1024
+# Seconds a response may stall before the request fails and is retried
+READ_TIMEOUT = 120
+
+
+class AsyncDriveClient:
+    """
+    The Drive v2 REST calls argsync makes, as coroutines on one aiohttp session.
+
+    At most max_in_flight requests run at once. Every request carries the access token of the drive's
+    credentials. On a 401 the token is refreshed once for all requests that carried it, and retryable
+    failures are retried with jittered exponential backoff like call_with_retries does.
+    """
+
+    def __init__(self, drive: GoogleDrive, max_in_flight: int, api_url: Optional[str] = None):
+        self.drive = drive
+        self.api_url = (api_url or getattr(drive, "api_url", None) or API_URL).rstrip("/")
+        self._max_in_flight = max_in_flight
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._token: Optional[str] = None
+
+    async def open(self) -> None:
+        connector = aiohttp.TCPConnector(limit=self._max_in_flight, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)
+        )
+        self._slots = asyncio.Semaphore(self._max_in_flight)
+        self._refresh_lock = asyncio.Lock()
+        credentials = getattr(self.drive.auth, "credentials", None)
+        if credentials is not None and expires_soon(credentials):
+            await asyncio.get_running_loop().run_in_executor(None, refresh_credentials, self.drive.auth)
+        self._token = self._access_token()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    def _access_token(self) -> Optional[str]:
+        return getattr(getattr(self.drive.auth, "credentials", None), "access_token", None)
+
+    async def _refresh(self, stale: Optional[str]) -> None:
+        async with self._refresh_lock:
+            # Requests that failed with the same token wait here, and only the first one refreshes it
+            if self._token == stale:
+                await asyncio.get_running_loop().run_in_executor(None, refresh_credentials, self.drive.auth)
+                self._token = self._access_token()
+
+    async def request(
+        self,
+        kind: str,
+        method: str,
+        url: str,
+        params: Optional[Dict] = None,
+        body: Any = None,
+        headers: Optional[Dict] = None,
+        sink: Optional[str] = None,
+        lookup: Optional[Callable[[], Awaitable[Optional[Dict]]]] = None,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Sends one API request, retrying it while it fails with a retryable error.
+
+        Requests that create something pass lookup, like they do for call_with_retries: a request that may have
+        been carried out despite its error is first looked up, and only sent again if its result is not there.
+
+        Args:
+            kind (str): The kind of call, e.g. "files.list", for the retry counts.
+            method (str): The HTTP method.
+            url (str): The URL, or a path below the API URL.
+            params (dict): The query parameters.
+            body: The request body. A dict is sent as JSON.
+            headers (dict): Extra request headers.
+            sink (str): Stream the response body into this file instead of returning it.
+            lookup (function): Coroutine function called when a failed request may have run. Returns the resource
+                the request would have returned if its result exists, None otherwise.
+
+        Returns:
+            tuple: The status, headers and body of the response. 308 responses of resumable uploads are returned
+                as they are.
+
+        Raises:
+            HttpError: If the call fails with an error status after all retries.
+        """
+        if not url.startswith("http"):
+            url = self.api_url + url
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers = dict(headers or {}, **{"Content-Type": "application/json; charset=UTF-8"})
+        metrics = metrics_for(self.drive)
+        attempt, refreshed = 0, False
+        while True:
+            credentials = getattr(self.drive.auth, "credentials", None)
+            if credentials is not None and expires_soon(credentials):
+                await self._refresh(self._token)
+            token = self._token
+            request_headers = dict(headers or {})
+            if token is not None:
+                request_headers["Authorization"] = f"Bearer {token}"
+            status, response_headers, content, received, error = 0, {}, b"", 0, None
+            async with self._slots:
+                start = time.perf_counter()
+                try:
+                    async with self._session.request(
+                        method, url, params=params, data=body, headers=request_headers
+                    ) as response:
+                        status, response_headers = response.status, dict(response.headers)
+                        if sink is not None and status < 300:
+                            received = await _stream_to(response, sink)
+                        else:
+                            content = await response.read()
+                            received = len(content)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                metrics.record_call(
+                    call_kind(method, str(url)), time.perf_counter() - start, status, len(body or b""), received
+                )
+            if status == 401 and not refreshed:
+                refreshed = True
+                await self._refresh(token)
+                continue
+            if error is None and (status < 400 or status == 308):
+                return status, response_headers, content
+            # Transport errors, and timeouts in particular, may hit a request that Google Drive carried out
+            retryable = ran = error is not None
+            if error is None:
+                error = HttpError(httplib2.Response(dict(response_headers, status=status)), content, uri=str(url))
+                retryable, ran = is_retryable(error), may_have_run(error)
+            attempt += 1
+            if not retryable or attempt > MAX_RETRIES:
+                raise error
+            if lookup is not None and ran:
+                existing = await lookup()
+                if existing is not None:
+                    return 200, {}, json.dumps(existing).encode()
+            metrics.retried(kind)
+            await asyncio.sleep(backoff_delay(attempt))
+
+    async def list_children(self, parent_ids: List[str]) -> List[Dict]:
+        """
+        Lists folders and files directly inside any of the given folders, across all result pages.
+
+        Args:
+            parent_ids (list): The IDs of the parent folders.
+
+        Returns:
+            list: The file resources of all children.
+        """
+        parents = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+        params = {"q": f"({parents}) and trashed=false", "maxResults": str(LIST_PAGE_SIZE), "fields": LIST_FIELDS}
+        items = []
+        while True:
+            _, _, content = await self.request("files.list", "GET", "/drive/v2/files", params=params)
+            page = json.loads(content)
+            items.extend(page.get("items", []))
+            if not page.get("nextPageToken"):
+                return items
+            params = dict(params, pageToken=page["nextPageToken"])
+
+    async def find_child(self, title: str, parent_id: str, mime_type: Optional[str] = None) -> Optional[Dict]:
+        """
+        Looks up an item by title in a folder, like argsync.batch.find_child.
+
+        Args:
+            title (str): The title of the item.
+            parent_id (str): The ID of the folder.
+            mime_type (str): Only match items of this MIME type.
+
+        Returns:
+            dict or None: The id and md5Checksum of the most recently modified match, None if there is none.
+        """
+        escaped = title.replace("\\", "\\\\").replace("'", "\\'")
+        query = f"'{parent_id}' in parents and title='{escaped}' and trashed=false"
+        if mime_type is not None:
+            query += f" and mimeType='{mime_type}'"
+        params = {"q": query, "fields": LIST_FIELDS}
+        _, _, content = await self.request("files.list", "GET", "/drive/v2/files", params=params)
+        items = json.loads(content).get("items", [])
+        if not items:
+            return None
+        item = max(items, key=lambda item: item.get("modifiedDate", ""))
+        return {"id": item["id"], "md5Checksum": item.get("md5Checksum")}
+
+    async def create_folder(self, title: str, parent_id: str) -> str:
+        """
+        Creates a folder. When the creation fails in a way it may have succeeded, a folder of the same name in the
+        parent is used instead of creating a second one.
+
+        Args:
+            title (str): The name of the folder.
+            parent_id (str): The ID of the folder to create it in.
+
+        Returns:
+            str: The ID of the new folder.
+        """
+        body = {"title": title, "parents": [{"id": parent_id}], "mimeType": FOLDER_MIME_TYPE}
+        lookup = functools.partial(self.find_child, title, parent_id, FOLDER_MIME_TYPE)
+        _, _, content = await self.request(
+            "files.insert", "POST", "/drive/v2/files", {"fields": "id"}, body, lookup=lookup
+        )
+        return json.loads(content)["id"]
+
+    async def trash(self, file_id: str) -> None:
+        """
+        Moves a file or folder to the trash.
+
+        Args:
+            file_id (str): The ID of the file or folder.
+        """
+        await self.request("files.trash", "POST", f"/drive/v2/files/{file_id}/trash", {"fields": "id"})
+
+    async def upload(
+        self,
+        file_metadata: Dict,
+        file_path: str,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> Dict:
+        """
+        Uploads a file, in one multipart request or in resumable chunks from resumable_threshold bytes up.
+
+        Args:
+            file_metadata (dict): The metadata of the file. If it has an id, that file is updated.
+            file_path (str): The path of the local file.
+            resumable_threshold (int): Files of at least this many bytes are uploaded in resumable chunks.
+            chunk_size (int): Size of the chunks of resumable uploads in bytes, a multiple of 256 KiB.
+
+        Returns:
+            dict: The uploaded file resource.
+        """
+        file_id = file_metadata.get("id")
+        metadata = {k: v for k, v in file_metadata.items() if k != "id"}
+        path = f"/upload/drive/v2/files/{file_id}" if file_id else "/upload/drive/v2/files"
+        method = "PUT" if file_id else "POST"
+        kind = "files.update" if file_id else "files.insert"
+        mime_type = metadata.get("mimeType", "application/octet-stream")
+        size = os.path.getsize(file_path)
+        loop = asyncio.get_running_loop()
+
+        if size < resumable_threshold:
+            content = await loop.run_in_executor(None, _read, file_path, 0, size)
+            boundary = uuid.uuid4().hex
+            body = b"".join(
+                [
+                    f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(),
+                    json.dumps(metadata).encode(),
+                    f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n\r\n".encode(),
+                    content,
+                    f"\r\n--{boundary}--".encode(),
+                ]
+            )
+            headers = {"Content-Type": f"multipart/related; boundary={boundary}"}
+            lookup = None if file_id else functools.partial(self._find_upload, metadata, file_path)
+            _, _, response = await self.request(
+                kind, method, path, {"uploadType": "multipart"}, body, headers, lookup=lookup
+            )
+            return json.loads(response)
+
+        headers = {"X-Upload-Content-Type": mime_type, "X-Upload-Content-Length": str(size)}
+        _, response_headers, _ = await self.request(
+            "upload.session", method, path, {"uploadType": "resumable"}, metadata, headers
+        )
+        session_url = response_headers.get("Location") or response_headers["location"]
+        offset = 0
+        while True:
+            end = min(offset + chunk_size, size) - 1
+            chunk = await loop.run_in_executor(None, _read, file_path, offset, end - offset + 1)
+            headers = {"Content-Range": f"bytes {offset}-{end}/{size}" if size else f"bytes */{size}"}
+            status, response_headers, response = await self.request(
+                "upload.chunk", "PUT", session_url, None, chunk, headers
+            )
+            if status != 308:
+                return json.loads(response)
+            received = response_headers.get("Range") or response_headers.get("range")
+            offset = int(received.rsplit("-", 1)[1]) + 1 if received else 0
+
+    async def download(self, drive_file: Dict, file_path: str, export_mime_type: Optional[str] = None) -> None:
+        """
+        Downloads a file next to file_path and renames it into place once complete. A failed download cannot be
+        resumed, so its partial file is removed.
+
+        Args:
+            drive_file (dict): The file resource.
+            file_path (str): The local path of the file.
+            export_mime_type (str): The type to export Google Docs, Sheets and Slides to.
+        """
+        if export_mime_type is not None:
+            url = drive_file["exportLinks"][export_mime_type]
+        else:
+            url = f"/drive/v2/files/{drive_file['id']}"
+        params = None if export_mime_type is not None else {"alt": "media"}
+        part_path = file_path + PART_SUFFIX
+        try:
+            await self.request("files.get_media", "GET", url, params, sink=part_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, file_path)
+
+    async def _find_upload(self, metadata: Dict, file_path: str) -> Optional[Dict]:
+        # The async counterpart of argsync.push.find_upload
+        existing = await self.find_child(metadata["title"], metadata["parents"][0]["id"])
+        if existing is None:
+            return None
+        md5 = await asyncio.get_running_loop().run_in_executor(None, file_md5, file_path)
+        return existing if existing["md5Checksum"] == md5 else None
+
+
+async def _stream_to(response: "aiohttp.ClientResponse", file_path: str) -> int:
+    received = 0
+    with open(file_path, "wb") as f:
+        async for chunk in response.content.iter_chunked(READ_SIZE):
+            f.write(chunk)
+            received += len(chunk)
+    return received
+
+
+def _read(file_path: str, offset: int, size: int) -> bytes:
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+async def list_tree_async(
+    client: AsyncDriveClient, folder_name: str, folder_id: str, batch_size: int = PARENTS_PER_QUERY
+) -> RemoteTree:
+    """
+    The coroutine counterpart of argsync.tree.list_tree. All queries of a level are in flight at once.
+
+    Args:
+        client (AsyncDriveClient): The client to list with.
+        folder_name (str): The name of the root folder.
+        folder_id (str): The ID of the root folder on Google Drive.
+        batch_size (int): Maximum number of parent IDs per query.
+
+    Returns:
+        RemoteTree: The index of all folders and files under the root folder.
+    """
+    tree = RemoteTree(folder_name, folder_id)
+    level = {folder_id: folder_name}
+    while level:
+        next_level = {}
+        level_ids = list(level)
+        batches = [level_ids[i : i + batch_size] for i in range(0, len(level_ids), batch_size)]
+        for items in await asyncio.gather(*(client.list_children(batch) for batch in batches)):
+            for item in items:
+                parent_path = next(level[p["id"]] for p in item["parents"] if p["id"] in level)
+                path = parent_path + os.path.sep + item["title"]
+                if item["mimeType"] == FOLDER_MIME_TYPE:
+                    tree.add_folder(path, item["id"])
+                    next_level[item["id"]] = path
+                else:
+                    tree.files[parent_path].append(item)
+        level = next_level
+    return tree
+
+
+class AsyncTransferPipeline:
+    """
+    The event-loop counterpart of TransferPipeline, with the same submit/write/close surface.
+
+    Tasks are coroutine functions. They are queued from the calling thread and run by num_of_workers
+    coroutines on the engine's loop. submit blocks while the queue is full, and the first failing task
+    stops the pipeline: queued tasks are skipped, and the error is raised from the next submit or from close.
+    """
+
+    def __init__(self, engine: "AsyncEngine", num_of_workers: int, desc: str, metrics: Optional[RunMetrics] = None):
+        self._engine = engine
+        self._metrics = metrics
+        self._error: Optional[BaseException] = None
+        self._bytes_done = 0
+        self._started = time.monotonic()
+        self._progress = tqdm.tqdm(total=0, desc=desc, unit="file")
+        self._queue: asyncio.Queue = engine.run(self._make_queue(4 * num_of_workers))
+        self._workers = [engine.submit(self._work()) for _ in range(max(num_of_workers, 1))]
+
+    @staticmethod
+    async def _make_queue(size: int) -> asyncio.Queue:
+        # Queues must be created on the loop that uses them
+        return asyncio.Queue(maxsize=size)
+
+    async def _work(self) -> None:
+        while True:
+            task = await self._queue.get()
+            if task is None:
+                return
+            fn, args, size, on_done = task
+            if self._error is not None:
+                continue
+            try:
+                start = time.perf_counter()
+                result = await fn(args)
+                if on_done is not None:
+                    on_done(result)
+                if self._metrics is not None:
+                    self._metrics.transferred(size, time.perf_counter() - start)
+                self._completed(size)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+
+    def _completed(self, size: int) -> None:
+        self._bytes_done += size
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        self._progress.set_postfix_str(
+            tqdm.tqdm.format_sizeof(self._bytes_done / elapsed, "B/s", divisor=1024), refresh=False
+        )
+        self._progress.update()
+
+    def submit(self, fn: Callable, args: Any, size: int = 0, on_done: Optional[Callable] = None) -> None:
+        """
+        Queues a task, blocking while the queue is full.
+
+        Args:
+            fn (function): The coroutine function of the task, called with args as its only argument.
+            args: The argument for fn.
+            size (int): Number of bytes the task transfers, used for the bytes/s display.
+            on_done (function): Called on the loop with the result of fn after it succeeded.
+
+        Raises:
+            Exception: The error of a previously failed task.
+        """
+        if self._error is not None:
+            raise self._error
+        self._progress.total += 1
+        self._progress.refresh()
+        self._engine.run(self._queue.put((fn, args, size, on_done)))
+
+    def write(self, message: str) -> None:
+        """
+        Prints a message without breaking the progress bar.
+
+        Args:
+            message (str): The message to print.
+        """
+        self._progress.write(message)
+
+    def close(self) -> None:
+        """
+        Waits for all queued tasks and stops the workers.
+
+        Raises:
+            Exception: The error of the first failed task, if any.
+        """
+        for _ in self._workers:
+            self._engine.run(self._queue.put(None))
+        for worker in self._workers:
+            worker.result()
+        self._progress.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "AsyncTransferPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            if self._error is None:
+                self._error = exc
+            try:
+                self.close()
+            except BaseException:
+                pass
+            return
+        self.close()
+
+
+def _import_aiohttp() -> None:
+    global aiohttp
+    if aiohttp is not None:
+        return
+    try:
+        import aiohttp as module
+    except ImportError:
+        raise click.ClickException("The async transport needs aiohttp. Install it with `pip install argsync[async]`.")
+    aiohttp = module
+
+
+class AsyncEngine:
+    """
+    Owns an event loop in a background thread and an AsyncDriveClient on it, for one push or pull.
+
+    Use it as a context manager. Its methods are called from the main thread and block until done.
+    """
+
+    def __init__(
+        self,
+        drive: GoogleDrive,
+        max_in_flight: int,
+        resumable_threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        _import_aiohttp()
+        self.drive = drive
+        self.max_in_flight = max_in_flight
+        self.resumable_threshold = resumable_threshold
+        self.chunk_size = chunk_size
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self.client = AsyncDriveClient(drive, max_in_flight)
+
+    def submit(self, coro) -> Future:
+        """Schedules a coroutine on the loop and returns its future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro) -> Any:
+        """Runs a coroutine on the loop and returns its result."""
+        return self.submit(coro).result()
+
+    def pipeline(self, desc: str, metrics: Optional[RunMetrics] = None) -> AsyncTransferPipeline:
+        """
+        Returns a transfer pipeline whose tasks run on the loop.
+
+        Args:
+            desc (str): The label of the progress bar.
+            metrics (RunMetrics): Collects the timings of the transfers.
+
+        Returns:
+            AsyncTransferPipeline: The pipeline, to be used as a context manager.
+        """
+        return AsyncTransferPipeline(self, self.max_in_flight, desc, metrics)
+
+    def list_tree(self, folder_name: str, folder_id: str) -> RemoteTree:
+        """
+        Indexes a Google Drive subtree like argsync.tree.list_tree.
+
+        Args:
+            folder_name (str): The name of the root folder.
+            folder_id (str): The ID of the root folder on Google Drive.
+
+        Returns:
+            RemoteTree: The index of all folders and files under the root folder.
+        """
+        return self.run(list_tree_async(self.client, folder_name, folder_id))
+
+    def create_folder_tree(self, folder_dirs: List[str], parents_id: Dict[str, str]) -> Iterator[Tuple[str, str]]:
+        """
+        Creates folders one depth level at a time, with all folders of a level in flight at once.
+
+        Args:
+            folder_dirs (list): The paths of the folders to create. The parent path of each must either be in
+                parents_id or be one of folder_dirs.
+            parents_id (dict): Maps folder paths to their Google Drive IDs. New folders are added to it.
+
+        Yields:
+            tuple: The path of a created folder and its Google Drive ID.
+        """
+        levels = {}
+        for folder_dir in folder_dirs:
+            levels.setdefault(folder_dir.count(os.path.sep), []).append(folder_dir)
+
+        async def create_level(level: List[str]) -> List[str]:
+            return await asyncio.gather(
+                *(self.client.create_folder(os.path.basename(d), parents_id[os.path.dirname(d)]) for d in level)
+            )
+
+        for depth in sorted(levels):
+            for folder_dir, folder_id in zip(levels[depth], self.run(create_level(levels[depth]))):
+                parents_id[folder_dir] = folder_id
+                yield folder_dir, folder_id
+
+    def trash(self, file_ids: List[str]) -> None:
+        """
+        Moves many files and folders to the trash at once.
+
+        Args:
+            file_ids (list): The IDs of the files and folders.
+        """
+
+        async def trash_all() -> None:
+            await asyncio.gather(*(self.client.trash(file_id) for file_id in file_ids))
+
+        self.run(trash_all())
+
+    def __enter__(self) -> "AsyncEngine":
+        self._thread.start()
+        self.run(self.client.open())
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            self.run(self.client.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
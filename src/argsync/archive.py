@@ -0,0 +1,393 @@
+"""
+Archive mode: folders full of tiny files kept on Google Drive as a few compressed chunks instead of file by file.
+
+A folder packed by push is stored next to where it would be, in a folder with ARCHIVE_SUFFIX added to its name.
+That folder holds tar.gz chunks of the files and INDEX_NAME, the gzipped JSON list of every file's path, size
+and md5, grouped by chunk.
+
+Files are sorted by path and a chunk ends after a file whose path hashes to a boundary, or once it holds
+CHUNK_BYTES. Boundaries depend on the paths, not on the position of a file in the list, so adding, changing or
+removing a file only changes the chunk it belongs to. A chunk is named after the md5 of its list of files, so a
+push uploads only the chunks whose name is not on gdrive yet, and a pull downloads only the chunks holding a file
+that differs locally.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pydrive2.drive import GoogleDrive
+
+from argsync.hashing import HashEngine
+from argsync.metrics import metrics_for
+from argsync.plan import SyncPlan, index_by_title
+from argsync.ranged import PART_SUFFIX, is_partial
+from argsync.state import FileStateCache
+from argsync.throttle import call_with_retries
+from argsync.tree import RemoteTree
+
+ARCHIVE_SUFFIX = ".argsync-archive"
+INDEX_NAME = "index.json.gz"
+CHUNK_SUFFIX = ".tar.gz"
+# A chunk ends after one path in CHUNK_FILES on average, or once it holds CHUNK_BYTES
+CHUNK_FILES = 256
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# (path relative to the archived folder, size, md5)
+Entry = Tuple[str, int, str]
+
+
+class Archive:
+    """
+    One folder kept on Google Drive in archive mode.
+
+    Attributes:
+        path (str): The path of the local folder, relative to the parent of the synced folder.
+        remote_path (str): The path of the folder holding the chunks on Google Drive, also relative.
+        chunks (dict): Maps the name of every chunk to the entries of its files.
+        remote (dict): The files in the archive folder on Google Drive by title, chunks and index.
+    """
+
+    def __init__(self, path: str, chunks: Dict[str, List[Entry]], remote: Optional[Dict[str, Dict]] = None):
+        self.path = path
+        self.remote_path = path + ARCHIVE_SUFFIX
+        self.chunks = chunks
+        self.remote = remote or {}
+
+    def stale(self) -> List[Dict]:
+        """Returns the chunks on Google Drive that the index no longer lists."""
+        return [f for title, f in self.remote.items() if title != INDEX_NAME and title not in self.chunks]
+
+
+def is_archive_folder(path: str) -> bool:
+    """
+    Tells whether a Google Drive folder path is the folder of an archive.
+
+    Args:
+        path (str): The path of the folder.
+
+    Returns:
+        bool: True if the folder name ends with ARCHIVE_SUFFIX.
+    """
+    return path.endswith(ARCHIVE_SUFFIX)
+
+
+def find_archived(src_full_path: str, ignore_dirs: Iterable[str], archive_dirs: Iterable[str]) -> List[str]:
+    """
+    Finds the folders to push in archive mode.
+
+    Args:
+        src_full_path (str): The local path to push from.
+        ignore_dirs (list): Names of directories to skip, with everything below them.
+        archive_dirs (list): Names of directories to archive. Folders below an archived one are part of its archive.
+
+    Returns:
+        list: The paths of the archived folders, relative to the parent of src_full_path.
+    """
+    parent = os.path.dirname(src_full_path)
+    archived = []
+    for root, dirs, _ in os.walk(src_full_path, topdown=True):
+        archived.extend(os.path.relpath(os.path.join(root, d), parent) for d in dirs if d in archive_dirs)
+        dirs[:] = [d for d in dirs if d not in ignore_dirs and d not in archive_dirs]
+    return sorted(archived)
+
+
+def index_files(folder_path: str, ignore_dirs: Iterable[str] = ()) -> Dict[str, int]:
+    """
+    Lists every file below a folder.
+
+    Args:
+        folder_path (str): The local folder.
+        ignore_dirs (iterable): Names of directories to skip, with everything below them.
+
+    Returns:
+        dict: Maps the path of every file, relative to folder_path, to its size.
+    """
+    files = {}
+    for root, dirs, names in os.walk(folder_path, topdown=True):
+        dirs[:] = [d for d in dirs if d not in ignore_dirs]
+        for name in names:
+            if is_partial(name):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                files[os.path.relpath(file_path, folder_path)] = os.path.getsize(file_path)
+            except OSError:
+                continue
+    return files
+
+
+def _is_boundary(path: str) -> bool:
+    return int(hashlib.md5(path.encode()).hexdigest()[:8], 16) % CHUNK_FILES == 0
+
+
+def _chunk_name(entries: List[Entry]) -> str:
+    return hashlib.md5(json.dumps(entries, separators=(",", ":")).encode()).hexdigest() + CHUNK_SUFFIX
+
+
+def split_chunks(entries: Iterable[Entry]) -> Dict[str, List[Entry]]:
+    """
+    Groups the files of a folder into chunks.
+
+    Args:
+        entries (iterable): The (path, size, md5) of every file.
+
+    Returns:
+        dict: Maps the name of every chunk to its entries, sorted by path.
+    """
+    chunks, current, size = {}, [], 0
+    for entry in sorted(entries):
+        current.append(list(entry))
+        size += entry[1]
+        if size >= CHUNK_BYTES or _is_boundary(entry[0]):
+            chunks[_chunk_name(current)] = current
+            current, size = [], 0
+    if current:
+        chunks[_chunk_name(current)] = current
+    return chunks
+
+
+def encode_index(chunks: Dict[str, List[Entry]]) -> bytes:
+    """
+    Serializes the index of an archive.
+
+    Args:
+        chunks (dict): The chunks of the archive, as made by split_chunks.
+
+    Returns:
+        bytes: The gzipped JSON index.
+    """
+    data = {"version": 1, "chunks": chunks}
+    return gzip.compress(json.dumps(data, separators=(",", ":")).encode(), mtime=0)
+
+
+def decode_index(content: bytes) -> Dict[str, List[Entry]]:
+    """
+    Reads the index of an archive.
+
+    Args:
+        content (bytes): The gzipped JSON index.
+
+    Returns:
+        dict: Maps the name of every chunk to the entries of its files.
+
+    Raises:
+        ValueError: If the index is damaged or of an unknown version.
+    """
+    try:
+        data = json.loads(gzip.decompress(content))
+    except (OSError, EOFError) as e:
+        raise ValueError(f"Damaged archive index: {e}")
+    if data.get("version") != 1:
+        raise ValueError(f"Unknown archive index version {data.get('version')}.")
+    return {name: [tuple(entry) for entry in entries] for name, entries in data["chunks"].items()}
+
+
+def pack_chunk(folder_path: str, entries: List[Entry]) -> str:
+    """
+    Writes the files of a chunk into a temporary tar.gz file.
+
+    Args:
+        folder_path (str): The local archived folder.
+        entries (list): The entries of the chunk.
+
+    Returns:
+        str: The path of the temporary file. The caller removes it.
+    """
+    fd, chunk_path = tempfile.mkstemp(suffix=CHUNK_SUFFIX)
+    os.close(fd)
+    try:
+        with tarfile.open(chunk_path, "w:gz", dereference=True) as tar:
+            for path, _, _ in entries:
+                tar.add(os.path.join(folder_path, path), arcname=path, recursive=False)
+    except BaseException:
+        os.remove(chunk_path)
+        raise
+    return chunk_path
+
+
+def unpack_chunk(chunk_path: str, folder_path: str, entries: List[Entry], state: FileStateCache) -> int:
+    """
+    Extracts the files of a chunk into the local archived folder, replacing each file atomically.
+
+    Only regular files listed in entries are extracted, so a chunk cannot write outside folder_path.
+
+    Args:
+        chunk_path (str): The downloaded tar.gz file.
+        folder_path (str): The local archived folder.
+        entries (list): The entries of the chunk, from the index.
+        state (FileStateCache): The local file-state cache, given the md5 of every extracted file.
+
+    Returns:
+        int: The number of files extracted.
+    """
+    md5s = {path: md5 for path, _, md5 in entries}
+    extracted = 0
+    with tarfile.open(chunk_path, "r:gz") as tar:
+        for member in tar:
+            if not member.isfile() or member.name not in md5s:
+                continue
+            file_path = os.path.join(folder_path, member.name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with tar.extractfile(member) as src, open(file_path + PART_SUFFIX, "wb") as dst:
+                while True:
+                    data = src.read(1024 * 1024)
+                    if not data:
+                        break
+                    dst.write(data)
+            os.utime(file_path + PART_SUFFIX, (member.mtime, member.mtime))
+            os.replace(file_path + PART_SUFFIX, file_path)
+            state.record(file_path, md5s[member.name])
+            extracted += 1
+    return extracted
+
+
+def download_index(drive_file: Dict, drive: GoogleDrive) -> Dict[str, List[Entry]]:
+    """
+    Downloads and reads the index of an archive.
+
+    Args:
+        drive_file (dict): The index file on Google Drive.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        dict: Maps the name of every chunk to the entries of its files.
+    """
+    fd, index_path = tempfile.mkstemp(suffix=".json.gz")
+    os.close(fd)
+    try:
+        file = drive.CreateFile({"id": drive_file["id"]})
+        call_with_retries(lambda: file.GetContentFile(index_path), drive, "files.get_media")
+        with open(index_path, "rb") as f:
+            return decode_index(f.read())
+    finally:
+        os.remove(index_path)
+
+
+def plan_archive_push(
+    src_full_path: str,
+    archived: List[str],
+    tree: Optional[RemoteTree],
+    ignore_dirs: Iterable[str],
+    drive: GoogleDrive,
+    state: FileStateCache,
+    hasher: HashEngine,
+    plan: SyncPlan,
+) -> List[Archive]:
+    """
+    Works out which chunks a push has to upload for every archived folder.
+
+    Their archive folders are taken out of tree, so plan_push leaves them alone.
+
+    Args:
+        src_full_path (str): The local path to push from.
+        archived (list): The archived folders, as found by find_archived.
+        tree (RemoteTree): The index of the matching folder on Google Drive, None if it does not exist yet.
+        ignore_dirs (list): Names of directories to skip inside archived folders.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        state (FileStateCache): The local file-state cache.
+        hasher (HashEngine): The engine used to hash local files.
+        plan (SyncPlan): The plan the actions are added to.
+
+    Returns:
+        list: The archives, for execute_archive_push.
+    """
+    metrics = metrics_for(drive)
+    parent_folder = os.path.dirname(src_full_path)
+    archives = []
+    for path in archived:
+        folder_path = os.path.join(parent_folder, path)
+        files = index_files(folder_path, ignore_dirs)
+        paths = {os.path.join(folder_path, p): p for p in files}
+        entries = [
+            (paths[f], files[paths[f]], md5) for f, md5 in metrics.timed("hashing", state.md5_many(paths, hasher))
+        ]
+        archive = Archive(path, split_chunks(entries))
+        drive_files = tree.files.pop(archive.remote_path, None) if tree is not None else None
+        if drive_files is None:
+            plan.add("mkdir", archive.remote_path)
+        else:
+            archive.remote, _ = index_by_title(drive_files)
+        for name, chunk in archive.chunks.items():
+            if name not in archive.remote:
+                plan.add(
+                    "pack",
+                    os.path.join(archive.remote_path, name),
+                    sum(e[1] for e in chunk),
+                    parent=archive.remote_path,
+                )
+        stale = archive.stale()
+        if stale:
+            plan.note(f"{len(stale)} chunks of {archive.remote_path} are no longer used and will be trashed.")
+        metrics.count_files("unchanged", sum(len(c) for n, c in archive.chunks.items() if n in archive.remote))
+        archives.append(archive)
+    return archives
+
+
+def plan_archive_pull(
+    tree: RemoteTree,
+    dest_dir: str,
+    drive: GoogleDrive,
+    state: FileStateCache,
+    hasher: HashEngine,
+    plan: SyncPlan,
+) -> List[Archive]:
+    """
+    Works out which chunks a pull has to download and unpack for every archive folder on Google Drive.
+
+    Their archive folders are taken out of tree, so plan_pull neither downloads them file by file nor creates
+    them locally. Local files of an archived folder that the index does not list are planned for deletion.
+
+    Args:
+        tree (RemoteTree): The index of the pulled Google Drive folder.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        state (FileStateCache): The local file-state cache.
+        hasher (HashEngine): The engine used to hash local files.
+        plan (SyncPlan): The plan the actions are added to.
+
+    Returns:
+        list: The archives, for execute_archive_pull and for plan_pull to leave their local folders alone.
+    """
+    metrics = metrics_for(drive)
+    archives = []
+    for remote_path in [p for p in tree.files if is_archive_folder(p)]:
+        remote, _ = index_by_title(tree.files[remote_path])
+        if INDEX_NAME not in remote:
+            # Not made by push, or never finished: pulled like any folder
+            continue
+        del tree.files[remote_path]
+        archive = Archive(remote_path[: -len(ARCHIVE_SUFFIX)], download_index(remote[INDEX_NAME], drive), remote)
+        folder_path = os.path.join(dest_dir, archive.path)
+        local = index_files(folder_path) if os.path.isdir(folder_path) else {}
+        if not os.path.isdir(folder_path):
+            plan.add("mkdir", archive.path)
+
+        expected = {path: (name, size, md5) for name, chunk in archive.chunks.items() for path, size, md5 in chunk}
+        outdated = {name for path, (name, size, _) in expected.items() if local.get(path) != size}
+        candidates = {
+            os.path.join(folder_path, path): path
+            for path, (name, size, _) in expected.items()
+            if local.get(path) == size and name not in outdated
+        }
+        for file_path, md5 in metrics.timed("hashing", state.md5_many(candidates, hasher)):
+            name, _, expected_md5 = expected[candidates[file_path]]
+            if md5 != expected_md5:
+                outdated.add(name)
+        for name, chunk in archive.chunks.items():
+            if name not in remote:
+                raise ValueError(f"Chunk {name} of {remote_path} is missing on gdrive.")
+            if name in outdated:
+                size = sum(e[1] for e in chunk)
+                plan.add("unpack", archive.path, size, remote=remote[name], source=os.path.join(remote_path, name))
+            else:
+                metrics.count_files("unchanged", len(chunk))
+        for path, size in local.items():
+            if path not in expected:
+                plan.add("delete", os.path.join(archive.path, path), size)
+        archives.append(archive)
+    return archives
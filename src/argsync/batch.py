@@ -0,0 +1,279 @@
+import functools
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from pydrive2.drive import GoogleDrive
+
+from argsync.gdrive import pooled_http
+from argsync.metrics import metrics_for
+from argsync.throttle import (
+    MAX_RETRIES,
+    backoff_delay,
+    call_slot,
+    call_with_retries,
+    is_overloaded,
+    is_retryable,
+    may_have_run,
+    report_outcome,
+)
+from argsync.tree import FOLDER_MIME_TYPE, LIST_FIELDS
+
+# Google Drive accepts at most 100 calls in one batch request.
+BATCH_SIZE = 100
+
+
+class BatchError(Exception):
+    """
+    Raised when some calls of a batch still fail after all retries.
+
+    Attributes:
+        failures (dict): Maps the key of every failed call to its error.
+    """
+
+    def __init__(self, failures: Dict[Hashable, Exception]):
+        self.failures = failures
+        lines = [f"{len(failures)} batched call(s) failed:"]
+        lines += [f"  {key}: {error}" for key, error in failures.items()]
+        super().__init__("\n".join(lines))
+
+
+def _collect(
+    keys: List[Hashable],
+    results: Dict,
+    errors: Dict,
+    request_id: str,
+    response: Any,
+    exception: Optional[Exception],
+) -> None:
+    key = keys[int(request_id)]
+    if exception is None:
+        results[key] = response
+    else:
+        errors[key] = exception
+
+
+def find_child(title: str, parent_id: str, drive: GoogleDrive, mime_type: Optional[str] = None) -> Optional[Dict]:
+    """
+    Looks up an item by title in a Google Drive folder.
+
+    Args:
+        title (str): The title of the item.
+        parent_id (str): The ID of the folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        mime_type (str): Only match items of this MIME type.
+
+    Returns:
+        dict or None: The id and md5Checksum of the most recently modified match, None if there is none.
+    """
+    escaped = title.replace("\\", "\\\\").replace("'", "\\'")
+    query = f"'{parent_id}' in parents and title='{escaped}' and trashed=false"
+    if mime_type is not None:
+        query += f" and mimeType='{mime_type}'"
+    items = call_with_retries(
+        lambda: drive.ListFile({"q": query, "fields": LIST_FIELDS}).GetList(), drive, "files.list"
+    )
+    if not items:
+        return None
+    item = max(items, key=lambda item: item.get("modifiedDate", ""))
+    return {"id": item["id"], "md5Checksum": item.get("md5Checksum")}
+
+
+def execute_batched(
+    requests: Dict[Hashable, Callable[[], HttpRequest]],
+    drive: GoogleDrive,
+    batch_size: int = BATCH_SIZE,
+    max_retries: int = MAX_RETRIES,
+    lookup: Optional[Callable[[Hashable], Optional[Any]]] = None,
+) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Exception]]:
+    """
+    Runs many metadata-only calls as multipart batch requests.
+
+    Calls that fail with a rate limit or server error are retried with jittered exponential backoff. Only
+    the failed calls are sent again, never the whole batch.
+
+    Sending a call again is only safe for idempotent calls, like trashing and patching. Calls that create
+    something, like inserts and copies, pass lookup: a call that may have been carried out despite its error
+    is first looked up, and only sent again if its result is not on Google Drive.
+
+    Args:
+        requests (dict): Maps a key of your choice to a function building the call.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request, at most 100.
+        max_retries (int): Number of times a failed call is retried.
+        lookup (function): Called with the key of a failed call that may have run. Returns the response the call
+            would have given if its result exists, None otherwise.
+
+    Returns:
+        tuple: The responses of the successful calls, and the errors of the failed ones, both by key.
+    """
+    results, failures = {}, {}
+    pending = dict(requests)
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(backoff_delay(attempt))
+        errors = {}
+        keys = list(pending)
+        for i in range(0, len(keys), batch_size):
+            chunk = keys[i : i + batch_size]
+            batch = drive.auth.service.new_batch_http_request(
+                callback=functools.partial(_collect, chunk, results, errors)
+            )
+            for n, key in enumerate(chunk):
+                batch.add(pending[key](), request_id=str(n))
+            with call_slot(drive), pooled_http(drive) as http:
+                start = time.perf_counter()
+                try:
+                    batch.execute(http=http)
+                except HttpError as e:
+                    errors.update({key: e for key in chunk if key not in results})
+                overloaded = next((errors[key] for key in chunk if key in errors and is_overloaded(errors[key])), None)
+                report_outcome(drive, "batch", time.perf_counter() - start, overloaded)
+
+        pending = {}
+        for key, error in errors.items():
+            if not (is_retryable(error) and attempt < max_retries):
+                failures[key] = error
+                continue
+            if lookup is not None and may_have_run(error):
+                existing = lookup(key)
+                if existing is not None:
+                    results[key] = existing
+                    continue
+            pending[key] = requests[key]
+        if not pending:
+            break
+        metrics_for(drive).retried("batch", len(pending))
+
+    return results, failures
+
+
+def trash_files(file_ids: List[str], drive: GoogleDrive, batch_size: int = BATCH_SIZE) -> None:
+    """
+    Moves files and folders to the trash in Google Drive, batch_size at a time.
+
+    Args:
+        file_ids (list): The IDs of the files and folders to trash.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request.
+
+    Raises:
+        BatchError: If some items could not be trashed.
+    """
+    service = drive.auth.service
+    requests = {file_id: functools.partial(service.files().trash, fileId=file_id, fields="id") for file_id in file_ids}
+    _, failures = execute_batched(requests, drive, batch_size)
+    if failures:
+        raise BatchError(failures)
+
+
+def create_folders(
+    folders: Dict[Hashable, Tuple[str, str]], drive: GoogleDrive, batch_size: int = BATCH_SIZE
+) -> Dict[Hashable, str]:
+    """
+    Creates many folders in Google Drive, batch_size at a time.
+
+    A creation that failed in a way it may have succeeded is only retried when no folder of its name is in the
+    parent, so a folder is never created twice.
+
+    Args:
+        folders (dict): Maps a key of your choice to the (name, parent ID) of a folder to create.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request.
+
+    Returns:
+        dict: The ID of every created folder, by key.
+
+    Raises:
+        BatchError: If some folders could not be created.
+    """
+    service = drive.auth.service
+    requests = {
+        key: functools.partial(
+            service.files().insert,
+            body={"title": name, "parents": [{"id": parent_id}], "mimeType": FOLDER_MIME_TYPE},
+            fields="id",
+        )
+        for key, (name, parent_id) in folders.items()
+    }
+
+    def lookup(key: Hashable) -> Optional[Dict]:
+        name, parent_id = folders[key]
+        return find_child(name, parent_id, drive, FOLDER_MIME_TYPE)
+
+    results, failures = execute_batched(requests, drive, batch_size, lookup=lookup)
+    if failures:
+        raise BatchError(failures)
+    return {key: response["id"] for key, response in results.items()}
+
+
+def copy_files(
+    copies: Dict[Hashable, Tuple[str, str, str]], drive: GoogleDrive, batch_size: int = BATCH_SIZE
+) -> Dict[Hashable, Dict]:
+    """
+    Copies many files on Google Drive, batch_size at a time. The content is copied server-side, nothing is uploaded.
+
+    The copies go to titles that are not taken in their folders. A copy that failed in a way it may have
+    succeeded is only retried when its title is still free, so no file is copied twice.
+
+    Args:
+        copies (dict): Maps a key of your choice to the (ID of the file to copy, title, parent ID) of the copy.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request.
+
+    Returns:
+        dict: The id and md5Checksum of every copy, by key.
+
+    Raises:
+        BatchError: If some files could not be copied.
+    """
+    service = drive.auth.service
+    requests = {
+        key: functools.partial(
+            service.files().copy,
+            fileId=file_id,
+            body={"title": title, "parents": [{"id": parent_id}]},
+            fields="id,md5Checksum",
+        )
+        for key, (file_id, title, parent_id) in copies.items()
+    }
+
+    def lookup(key: Hashable) -> Optional[Dict]:
+        _, title, parent_id = copies[key]
+        return find_child(title, parent_id, drive)
+
+    results, failures = execute_batched(requests, drive, batch_size, lookup=lookup)
+    if failures:
+        raise BatchError(failures)
+    return results
+
+
+def update_metadata(
+    updates: Dict[str, Dict[str, Any]], drive: GoogleDrive, batch_size: int = BATCH_SIZE
+) -> Dict[str, Dict]:
+    """
+    Patches the metadata of many files in Google Drive, batch_size at a time.
+
+    Args:
+        updates (dict): Maps file IDs to the arguments of files.patch, e.g. {"body": {"title": ...},
+            "addParents": ..., "removeParents": ...}.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request.
+
+    Returns:
+        dict: The updated file resources, by file ID.
+
+    Raises:
+        BatchError: If some files could not be updated.
+    """
+    service = drive.auth.service
+    requests = {
+        file_id: functools.partial(service.files().patch, fileId=file_id, **kwargs)
+        for file_id, kwargs in updates.items()
+    }
+    results, failures = execute_batched(requests, drive, batch_size)
+    if failures:
+        raise BatchError(failures)
+    return results
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import pathlib
+from typing import Dict, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+from pydrive2.drive import GoogleDrive
+
+from argsync.gdrive import thread_http
+from argsync.state import get_cache_dir, write_json_atomic
+from argsync.throttle import call_with_retries
+from argsync.tree import ITEM_FIELDS
+
+# What pull_changes reads of a change: the file fields of a listing, and whether the file was trashed
+CHANGE_FIELDS = f"nextPageToken,newStartPageToken,items(fileId,deleted,file({ITEM_FIELDS},labels/trashed))"
+
+
+class InvalidPageToken(Exception):
+    """Raised when Google Drive no longer accepts a stored changes page token."""
+
+
+def get_start_page_token(drive: GoogleDrive) -> str:
+    """
+    Returns the page token for changes that happen from now on.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        str: The start page token of the changes feed.
+    """
+    request = drive.auth.service.changes().getStartPageToken()
+    response = call_with_retries(lambda: request.execute(http=thread_http(drive)), drive, "changes.getStartPageToken")
+    return response["startPageToken"]
+
+
+def list_changes(page_token: str, drive: GoogleDrive) -> Tuple[List[Dict], str]:
+    """
+    Fetches every change since a page token, across all result pages.
+
+    Args:
+        page_token (str): The token saved after the previous pull.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        tuple: The change resources, and the token to store for the next pull.
+
+    Raises:
+        InvalidPageToken: If the token is malformed or has expired.
+    """
+    changes = []
+    while True:
+        try:
+            request = drive.auth.service.changes().list(
+                pageToken=page_token,
+                maxResults=1000,
+                includeDeleted=True,
+                includeSubscribed=False,
+                fields=CHANGE_FIELDS,
+            )
+            response = call_with_retries(lambda: request.execute(http=thread_http(drive)), drive, "changes.list")
+        except HttpError as e:
+            if e.resp.status in (400, 404, 410):
+                raise InvalidPageToken(page_token) from e
+            raise
+        changes.extend(response.get("items", []))
+        if "newStartPageToken" in response:
+            return changes, response["newStartPageToken"]
+        page_token = response["nextPageToken"]
+
+
+class PullIndex:
+    """
+    What an incremental pull needs to remember between runs: the changes page token, and where every folder
+    and file of the pulled tree lives locally.
+
+    Attributes:
+        token (str): The changes page token, or None before the first full pull.
+        folder_id (str): The ID of the pulled folder on Google Drive.
+        folders (dict): Maps folder IDs to paths relative to the destination directory.
+        files (dict): Maps file IDs to paths relative to the destination directory.
+    """
+
+    def __init__(self, src_full_path: str, dest_full_path: str, index_file: Optional[pathlib.Path] = None):
+        if index_file is None:
+            key = hashlib.md5(f"{src_full_path}\n{dest_full_path}".encode()).hexdigest()
+            index_dir = get_cache_dir() / "changes"
+            index_dir.mkdir(exist_ok=True)
+            index_file = index_dir / f"{key}.json"
+        self.index_file = pathlib.Path(index_file)
+        self.token: Optional[str] = None
+        self.folder_id: Optional[str] = None
+        self.folders: Dict[str, str] = {}
+        self.files: Dict[str, str] = {}
+        try:
+            with open(self.index_file, "r") as f:
+                saved = json.load(f)
+            self.token = saved["token"]
+            self.folder_id = saved["folder_id"]
+            self.folders = saved["folders"]
+            self.files = saved["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def rebase(self, old_path: str, new_path: str) -> None:
+        """
+        Rewrites the paths of everything at or below old_path after a local move.
+
+        Args:
+            old_path (str): The previous relative path.
+            new_path (str): The new relative path.
+        """
+        prefix = old_path + os.path.sep
+        for mapping in (self.folders, self.files):
+            for item_id, path in mapping.items():
+                if path == old_path:
+                    mapping[item_id] = new_path
+                elif path.startswith(prefix):
+                    mapping[item_id] = new_path + path[len(old_path) :]
+
+    def drop(self, path: str) -> None:
+        """
+        Forgets everything at or below a relative path after it was removed locally.
+
+        Args:
+            path (str): The removed relative path.
+        """
+        prefix = path + os.path.sep
+        for mapping in (self.folders, self.files):
+            for item_id in [i for i, p in mapping.items() if p == path or p.startswith(prefix)]:
+                del mapping[item_id]
+
+    def save(self) -> None:
+        """
+        Writes the index to disk, replacing the previous one atomically.
+        """
+        write_json_atomic(
+            self.index_file,
+            {"token": self.token, "folder_id": self.folder_id, "folders": self.folders, "files": self.files},
+            separators=(",", ":"),
+        )
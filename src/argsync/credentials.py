@@ -0,0 +1,243 @@
+"""
+The saved OAuth credentials, shared safely by concurrent argsync processes.
+
+The credentials live outside the package directory, at $ARGSYNC_CREDENTIALS if it is set, else in
+$XDG_CONFIG_HOME/argsync/credentials.json (~/.config/argsync/credentials.json by default). Every read and write
+holds an exclusive lock on a sibling .lock file. A process about to refresh the token first re-reads the file
+under that lock, so when many processes find the token expiring at once, only the first refreshes it and the
+others pick up its token.
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import threading
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from oauth2client.client import Credentials
+    from pydrive2.auth import GoogleAuth
+
+# oauth2client, pydrive2 and argsync.state are imported where they are used, so removing a profile stays as fast
+# as --help
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl only the threads of one process are kept from racing
+    fcntl = None
+
+# Where versions before the credential store saved the credentials, moved to the store on first use
+LEGACY_PATH = pathlib.Path(__file__).parent / "credentials.json"
+# Tokens are refreshed this many seconds before they expire, so no request goes out with a token that
+# expires in flight
+REFRESH_MARGIN = 300
+
+
+def get_config_dir() -> pathlib.Path:
+    """
+    Returns the directory where argsync keeps its configuration, creating it if needed.
+
+    Returns:
+        pathlib.Path: $XDG_CONFIG_HOME/argsync, or ~/.config/argsync when the variable is not set.
+    """
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    config_dir = pathlib.Path(base) / "argsync"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    return config_dir
+
+
+def credentials_path() -> pathlib.Path:
+    """
+    Returns the path of the saved credentials.
+
+    Returns:
+        pathlib.Path: $ARGSYNC_CREDENTIALS, or credentials.json in the config directory when it is not set.
+    """
+    path = os.environ.get("ARGSYNC_CREDENTIALS")
+    return pathlib.Path(path).expanduser() if path else get_config_dir() / "credentials.json"
+
+
+def expires_soon(credentials: "Credentials", margin: float = REFRESH_MARGIN) -> bool:
+    """
+    Checks if an access token is expired or expires within margin seconds.
+
+    Args:
+        credentials (Credentials): The credentials holding the token.
+        margin (float): How many seconds before the expiry a token counts as expiring.
+
+    Returns:
+        bool: True if the token should be refreshed before it is used.
+    """
+    if credentials.access_token_expired:
+        return True
+    expiry = getattr(credentials, "token_expiry", None)
+    if expiry is None:
+        return False
+    # oauth2client keeps naive UTC datetimes
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return expiry - now < datetime.timedelta(seconds=margin)
+
+
+class CredentialStore:
+    """
+    A credentials file guarded by a lock file, so several processes can read, refresh and save it concurrently.
+
+    The file is replaced atomically and only written when the credentials actually changed. It implements the
+    interface of oauth2client.client.Storage, which credentials use to save their refreshed tokens. The lock is
+    reentrant, since credentials take it again to refresh while refresh holds it.
+    """
+
+    def __init__(self, path: Optional[pathlib.Path] = None, margin: float = REFRESH_MARGIN):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self.path = pathlib.Path(path) if path else credentials_path()
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.margin = margin
+        self._lock_fd: Optional[int] = None
+
+    def acquire_lock(self) -> None:
+        self._lock.acquire()
+        self._depth += 1
+        if fcntl is None or self._depth > 1:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        except BaseException:
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+            self._depth -= 1
+            self._lock.release()
+            raise
+
+    def release_lock(self) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self._lock.release()
+
+    def get(self) -> Optional["Credentials"]:
+        self.acquire_lock()
+        try:
+            return self.locked_get()
+        finally:
+            self.release_lock()
+
+    def put(self, credentials: "Credentials") -> None:
+        self.acquire_lock()
+        try:
+            self.locked_put(credentials)
+        finally:
+            self.release_lock()
+
+    def delete(self) -> None:
+        self.acquire_lock()
+        try:
+            self.locked_delete()
+        finally:
+            self.release_lock()
+
+    def locked_get(self) -> Optional["Credentials"]:
+        from oauth2client.client import Credentials
+
+        try:
+            content = self.path.read_text()
+        except FileNotFoundError:
+            content = self._migrate()
+        if content is None:
+            return None
+        try:
+            credentials = Credentials.new_from_json(content)
+        except (ValueError, KeyError, TypeError):
+            # A file damaged by an older version is treated as missing, so the user authorizes again
+            return None
+        credentials.set_store(self)
+        return credentials
+
+    def locked_put(self, credentials: "Credentials") -> None:
+        from argsync.state import write_json_atomic
+
+        content = credentials.to_json()
+        try:
+            if json.loads(self.path.read_text()) == json.loads(content):
+                return
+        except (OSError, ValueError):
+            pass
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # mkstemp creates the file readable by the user only
+        write_json_atomic(self.path, json.loads(content))
+
+    def locked_delete(self) -> None:
+        for path in (self.path, LEGACY_PATH):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _migrate(self) -> Optional[str]:
+        try:
+            content = LEGACY_PATH.read_text()
+        except OSError:
+            return None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        try:
+            LEGACY_PATH.unlink()
+        except OSError:
+            # A read-only install keeps its copy, which is no longer read once the store has one
+            pass
+        return content
+
+    def refresh(self, credentials: "Credentials", http) -> None:
+        """
+        Refreshes the access token of credentials, unless another process already saved one that is still fresh.
+
+        Credentials re-read the store under its lock before they refresh, and take over a token another process
+        saved if it has not expired yet. One that expires within margin is refreshed once more.
+
+        Args:
+            credentials (Credentials): The credentials loaded from this store.
+            http (httplib2.Http): An unauthorized http object for the token request.
+        """
+        self.acquire_lock()
+        try:
+            # Saves the new token through locked_put
+            credentials.refresh(http)
+            if expires_soon(credentials, self.margin):
+                # The token taken over from the store is about to expire, and now matches the saved one
+                credentials.refresh(http)
+        finally:
+            self.release_lock()
+
+
+def refresh_credentials(auth: "GoogleAuth") -> None:
+    """
+    Refreshes the access token of an authorized GoogleAuth, through its credential store if it has one.
+
+    Args:
+        auth (GoogleAuth): The GoogleAuth whose credentials to refresh.
+
+    Raises:
+        RefreshError: If the token cannot be refreshed.
+    """
+    import httplib2
+    from pydrive2.auth import RefreshError
+
+    credentials = auth.credentials
+    store = getattr(credentials, "store", None)
+    http = httplib2.Http(timeout=auth.http_timeout)
+    try:
+        if isinstance(store, CredentialStore):
+            store.refresh(credentials, http)
+        else:
+            credentials.refresh(http)
+    except Exception as e:
+        raise RefreshError(f"Access token refresh failed: {e}")
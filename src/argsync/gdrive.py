@@ -1,28 +1,234 @@
+import contextlib
 import pathlib
+import threading
+from typing import Iterator, List, Optional
 
+import httplib2
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
 
+from argsync.credentials import CredentialStore, expires_soon, refresh_credentials
+from argsync.metrics import timed_request
+
 
 def load_authorized_gdrive() -> GoogleDrive:
 
-    creds = pathlib.Path(__file__).parent / "credentials.json"
     settings = pathlib.Path(__file__).parent / "settings.yaml"
 
     gauth = GoogleAuth(settings_file=settings)
+    # Credentials are saved by the store only, under its lock
+    gauth.settings["save_credentials"] = False
+    store = CredentialStore()
     # Try to load saved client credentials
-    gauth.LoadCredentialsFile(creds)
+    gauth.credentials = store.get()
     if gauth.credentials is None:
-        # Authenticate if they're not there
-        print("No credentials found. You will be redirect to the authorization page.")
-        gauth.LocalWebserverAuth()
-    elif gauth.access_token_expired:
-        # Refresh them if expired
-        gauth.Refresh()
-    else:
+        store.acquire_lock()
+        try:
+            # Another process may have authorized while this one waited for the lock
+            gauth.credentials = store.locked_get()
+            if gauth.credentials is None:
+                print("No credentials found. You will be redirect to the authorization page.")
+                gauth.LocalWebserverAuth()
+                gauth.credentials.set_store(store)
+                store.locked_put(gauth.credentials)
+        finally:
+            store.release_lock()
+    if expires_soon(gauth.credentials):
+        # Refresh them ahead of expiry, or pick up the token another process just refreshed
+        refresh_credentials(gauth)
+    if gauth.service is None:
         # Initialize the saved creds
         gauth.Authorize()
-    # Save the current credentials to a file
-    gauth.SaveCredentialsFile(creds)
 
     return GoogleDrive(gauth)
+
+
+def thread_http(drive: GoogleDrive) -> httplib2.Http:
+    """
+    Returns the authorized http object of the current thread, creating it on first use.
+
+    PyDrive2 keeps one http object per thread for its own calls. Requests built directly on
+    drive.auth.service must be executed with it too, since httplib2 objects are not thread-safe.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        httplib2.Http: The http object of the current thread.
+    """
+    if not getattr(drive.auth.thread_local, "http", None):
+        drive.auth.thread_local.http = drive.auth.Get_Http_Object()
+    return drive.auth.thread_local.http
+
+
+class ConnectionPool:
+    """
+    A bounded pool of authorized keep-alive http objects, shared by every thread of a run.
+
+    Threads lease a connection for each API call through pooled_http, so a run never holds more than size
+    connections however many threads come and go, and the short-lived executors of listing and folder
+    creation reuse warm connections instead of opening new ones.
+
+    All connections are authorized with the one credentials object of the drive, which adds its token to every
+    request and refreshes it on a 401 through the credential store. A connection is also refreshed before it is
+    leased when the token is about to expire, once for all threads that find it expiring.
+    """
+
+    def __init__(self, drive: GoogleDrive, size: int, shared: bool = False):
+        self.drive = drive
+        self.size = max(size, 1)
+        self.shared = shared
+        self._cond = threading.Condition()
+        self._idle: List[httplib2.Http] = []
+        self._opened = 0
+        self._refresh_lock = threading.Lock()
+
+    def _connect(self) -> httplib2.Http:
+        auth = self.drive.auth
+        if getattr(auth, "credentials", None) is None:
+            # Nothing to authorize, e.g. the FakeDrive of the benchmarks
+            return auth.Get_Http_Object()
+        http = httplib2.Http(timeout=auth.http_timeout)
+        # Resumable uploads answer 308, which is not a redirect to follow
+        http.redirect_codes = http.redirect_codes - {308}
+        http = auth.credentials.authorize(http)
+        http.request = timed_request(http.request, self.drive)
+        return http
+
+    def refresh_ahead(self) -> None:
+        """
+        Refreshes the access token if it expires soon, unless another thread just did.
+
+        Through the credential store, another process may have refreshed it too, and then its token is used.
+
+        Raises:
+            RefreshError: If the token cannot be refreshed.
+        """
+        credentials = getattr(self.drive.auth, "credentials", None)
+        if credentials is None or not expires_soon(credentials):
+            return
+        with self._refresh_lock:
+            if expires_soon(credentials):
+                refresh_credentials(self.drive.auth)
+
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[httplib2.Http]:
+        """Holds one connection for the with block, waiting while all of them are in use."""
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                self._cond.wait()
+            if self._idle:
+                http = self._idle.pop()
+            else:
+                self._opened += 1
+                http = None
+        if http is None:
+            try:
+                http = self._connect()
+            except BaseException:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+        try:
+            self.refresh_ahead()
+            yield http
+        finally:
+            with self._cond:
+                self._idle.append(http)
+                self._cond.notify()
+
+    def close(self) -> None:
+        """Closes the idle connections. Leased ones are closed by the garbage collector."""
+        with self._cond:
+            for http in self._idle:
+                for connection in getattr(http, "connections", {}).values():
+                    connection.close()
+            self._opened -= len(self._idle)
+            self._idle = []
+
+
+def pool_for(drive: GoogleDrive) -> Optional[ConnectionPool]:
+    """
+    Returns the connection pool of a drive, if any.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        ConnectionPool or None: The pool set up with ensure_pool.
+    """
+    return getattr(drive, "argsync_pool", None)
+
+
+def ensure_pool(drive: GoogleDrive, size: int) -> ConnectionPool:
+    """
+    Makes API calls on a drive lease their connection from a pool of at least size connections.
+
+    A pool that is already big enough is kept, so runs that share a drive share its warm connections. A pool set
+    up with share_pool is always kept.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        size (int): The number of connections the run needs at most.
+
+    Returns:
+        ConnectionPool: The pool of the drive.
+    """
+    pool = pool_for(drive)
+    if pool is None or (pool.size < size and not pool.shared):
+        if pool is not None:
+            pool.close()
+        pool = ConnectionPool(drive, size)
+        drive.argsync_pool = pool
+    return pool
+
+
+def share_pool(drive: GoogleDrive, size: int) -> ConnectionPool:
+    """
+    Gives a drive a pool of size connections that the runs sharing the drive cannot grow.
+
+    Every API call holds a connection of the pool, so size caps the calls in flight across all those runs,
+    whatever number of workers each of them asks for.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        size (int): The number of calls in flight across all runs.
+
+    Returns:
+        ConnectionPool: The pool of the drive.
+    """
+    pool = pool_for(drive)
+    if pool is not None:
+        pool.close()
+    pool = ConnectionPool(drive, size, shared=True)
+    drive.argsync_pool = pool
+    return pool
+
+
+@contextlib.contextmanager
+def pooled_http(drive: GoogleDrive) -> Iterator[httplib2.Http]:
+    """
+    Leases a connection from the drive's pool for the with block and makes it the http object of the current
+    thread, so PyDrive2 calls and thread_http both use it. Nested blocks reuse the outer lease.
+
+    Without a pool, this yields the per-thread http object of thread_http.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Yields:
+        httplib2.Http: The http object to make requests with.
+    """
+    pool = pool_for(drive)
+    local = drive.auth.thread_local
+    if pool is None or getattr(local, "argsync_leased", False):
+        yield thread_http(drive)
+        return
+    with pool.lease() as http:
+        previous = getattr(local, "http", None)
+        local.http, local.argsync_leased = http, True
+        try:
+            yield http
+        finally:
+            local.http, local.argsync_leased = previous, False
@@ -0,0 +1,99 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def file_md5(file_path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Computes the md5 of a file by streaming it through a fixed-size buffer.
+
+    Args:
+        file_path (str): The path of the local file.
+        chunk_size (int): The size of the read buffer in bytes.
+
+    Returns:
+        str: The md5 hex digest of the file content.
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+class HashEngine:
+    """
+    Hashes files on a process pool sized to the cores and yields digests as they finish.
+
+    Files smaller than one chunk are hashed inline, since shipping them to another process costs more than
+    hashing them. Memory stays bounded by max_workers * chunk_size, and at most max_pending paths are queued
+    on the pool at any time. The pool is only started when a large file actually needs hashing.
+
+    One engine can serve several threads at once, e.g. the jobs of a manifest sharing one pool.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE, max_pending: int = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * self.max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn, since forking a process that already runs transfer threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def imap_unordered(self, paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        """
+        Hashes files and yields (path, md5) pairs in completion order.
+
+        Args:
+            paths (iterable): The paths of the local files to hash.
+
+        Yields:
+            tuple: The path of a file and its md5 hex digest.
+        """
+        pending: Dict[Future, str] = {}
+        for path in paths:
+            if os.path.getsize(path) <= self.chunk_size:
+                yield path, file_md5(path, self.chunk_size)
+                continue
+            pending[self._get_executor().submit(file_md5, path, self.chunk_size)] = path
+            if len(pending) >= self.max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+    def close(self) -> None:
+        """
+        Shuts down the process pool if it was started.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self) -> "HashEngine":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
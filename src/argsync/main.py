@@ -1,18 +1,100 @@
 import os
 import pathlib
-import re
 import warnings
 
 import click
-import yaml
 
-from argsync.pull import pull as pulling
-from argsync.push import push as pushing
+from argsync.paths import is_valid_gdrive_path
 
+# Subcommands import what they need when they run: the sync modules pull in pydrive2, googleapiclient and tqdm,
+# which would slow down every invocation, including --help.
 
-def is_valid_gdrive_path(path: str) -> bool:
-    pattern = r"^gdrive:([a-zA-Z0-9 _\.\-\u4E00-\u9FFF]*)$"
-    return bool(re.match(pattern, path))
+
+def run_with_stats(command: str, stats: bool, stats_json: str, fn, *args, **kwargs) -> None:
+    from argsync.metrics import RunMetrics
+
+    metrics = RunMetrics(command)
+    error = None
+    try:
+        fn(*args, metrics=metrics, **kwargs)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        metrics.finish(error)
+        if stats:
+            print(metrics.summary())
+        if stats_json:
+            metrics.write_json(stats_json)
+
+
+stats_options = [
+    click.option("--stats", is_flag=True, help="Print timings, API calls and transfer totals when done."),
+    click.option(
+        "--stats-json",
+        type=click.Path(dir_okay=False, writable=True),
+        help="Write the run stats to this JSON file, also when the run fails.",
+    ),
+]
+
+
+concurrency_options = [
+    click.option(
+        "--adaptive",
+        is_flag=True,
+        help="Start at --workers concurrent calls, then go up while gdrive keeps up and down on rate limits.",
+    ),
+    click.option(
+        "--max-workers", default=32, type=click.IntRange(min=1), help="Upper bound of concurrent calls with --adaptive."
+    ),
+    click.option(
+        "--transport",
+        default="threads",
+        type=click.Choice(["threads", "async"]),
+        help="Make API calls from worker threads, or from one event loop with --workers requests in flight. "
+        "async needs `pip install argsync[async]`.",
+    ),
+]
+
+
+transfer_options = [
+    click.option(
+        "--batch-size",
+        default=100,
+        type=click.IntRange(1, 100),
+        help="Number of folder creations or trashes sent in one batch request.",
+    ),
+    click.option(
+        "--resumable-threshold",
+        default=32,
+        type=click.IntRange(min=1),
+        help="Upload files of at least this many MiB in resumable chunks.",
+    ),
+    click.option(
+        "--chunk-size", default=8, type=click.IntRange(min=1), help="Size of the chunks of resumable uploads in MiB."
+    ),
+]
+
+
+plan_options = [
+    click.option(
+        "--dry-run", is_flag=True, help="Print what would be transferred and removed, without changing anything."
+    ),
+    click.option(
+        "--plan-json",
+        type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+        help="Write the sync plan to this JSON file, or to stdout with -.",
+    ),
+]
+
+
+def add_options(options):
+    def decorator(fn):
+        for option in reversed(options):
+            fn = option(fn)
+        return fn
+
+    return decorator
 
 
 @click.group()
@@ -25,9 +107,41 @@ def cli():
 @click.option(
     "-d", "--dest", default=None, help="Push into this gdrive folder. Should be formatted as gdrive:path/to/folder."
 )
-@click.option("-w", "--workers", default=5, type=int, help="Number of workers to upload asynchronously.")
+@click.option(
+    "-w",
+    "--workers",
+    default=5,
+    type=int,
+    help="Number of workers to upload asynchronously, or of requests in flight with --transport async.",
+)
 @click.option("-i", "--ignore", multiple=True, help="Set the dirs to ignore when pushing.")
-def push(src, dest, ignore, workers):
+@click.option(
+    "-a",
+    "--archive",
+    multiple=True,
+    help="Set the dirs to push as a few compressed chunks instead of file by file, e.g. for many tiny files.",
+)
+@add_options(transfer_options)
+@add_options(concurrency_options)
+@add_options(plan_options)
+@add_options(stats_options)
+def push(
+    src,
+    dest,
+    ignore,
+    archive,
+    workers,
+    batch_size,
+    resumable_threshold,
+    chunk_size,
+    adaptive,
+    max_workers,
+    transport,
+    dry_run,
+    plan_json,
+    stats,
+    stats_json,
+):
     """Push to gdrive folder.
 
     SRC: Absolute path to the source dir.
@@ -39,11 +153,33 @@ def push(src, dest, ignore, workers):
         raise click.BadParameter(f"{src} is not a valid directory.")
     if not os.path.isabs(src):
         raise click.BadParameter("SRC must be an absolute path.")
+    if adaptive and transport == "async":
+        raise click.BadParameter("--adaptive only works with --transport threads.")
     if dest is None:
         dest = "gdrive:"
     if not is_valid_gdrive_path(dest):
         raise click.BadParameter("The path to Google Drive folder should be like `gdrive:path/to/folder`.")
-    pushing(src, dest, ignore, workers)
+    from argsync.push import push as pushing
+
+    run_with_stats(
+        "push",
+        stats,
+        stats_json,
+        pushing,
+        src,
+        dest,
+        ignore,
+        workers,
+        batch_size,
+        resumable_threshold * 1024 * 1024,
+        chunk_size * 1024 * 1024,
+        adaptive=adaptive,
+        max_workers=max_workers,
+        transport=transport,
+        dry_run=dry_run,
+        plan_json=plan_json,
+        archive_dirs=archive,
+    )
 
 
 @cli.command()
@@ -55,8 +191,51 @@ def push(src, dest, ignore, workers):
     type=click.Path(exists=True),
     help="Pull folder to this directory. Must be an absolute path.",
 )
-@click.option("-w", "--workers", default=5, type=int, help="Number of workers to download asynchronously.")
-def pull(src, dest, workers):
+@click.option(
+    "-w",
+    "--workers",
+    default=5,
+    type=int,
+    help="Number of workers to download asynchronously, or of requests in flight with --transport async.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only apply changes made on gdrive since the last incremental pull. Falls back to a full scan when needed.",
+)
+@click.option(
+    "--archive",
+    is_flag=True,
+    help="Unpack the dirs pushed with --archive, downloading only the chunks with changed files.",
+)
+@click.option(
+    "--ranged-threshold",
+    default=64,
+    type=click.IntRange(min=1),
+    help="Download files of at least this many MiB as parallel ranged segments.",
+)
+@click.option(
+    "--connections", default=4, type=click.IntRange(min=1), help="Number of concurrent connections per large file."
+)
+@add_options(concurrency_options)
+@add_options(plan_options)
+@add_options(stats_options)
+def pull(
+    src,
+    dest,
+    workers,
+    incremental,
+    archive,
+    ranged_threshold,
+    connections,
+    adaptive,
+    max_workers,
+    transport,
+    dry_run,
+    plan_json,
+    stats,
+    stats_json,
+):
     """Pull from gdrive folder.
 
     SRC: A path to gdrive folder, formatted as gdrive:path/to/folder.
@@ -66,23 +245,130 @@ def pull(src, dest, workers):
         raise click.ClickException("Google Drive API not setup. Please run `argsync setup` to resolve it.")
     if not is_valid_gdrive_path(src):
         raise click.BadParameter("The path to Google Drive folder should be like `gdrive:path/to/folder`.")
+    if adaptive and transport == "async":
+        raise click.BadParameter("--adaptive only works with --transport threads.")
+    if archive and incremental:
+        raise click.BadParameter("--archive compares the whole folder and does not work with --incremental.")
     if dest is None:
         dest = os.path.expanduser("~")
     if not (os.path.exists(dest) and os.path.isdir(dest)):
         raise click.BadParameter(f"{dest} is not a valid directory.")
     if not os.path.isabs(dest):
         raise click.BadParameter("DEST must be an absolute path.")
-    pulling(src, dest, workers)
+    from argsync.pull import pull as pulling
+
+    run_with_stats(
+        "pull",
+        stats,
+        stats_json,
+        pulling,
+        src,
+        dest,
+        workers,
+        incremental,
+        ranged_threshold * 1024 * 1024,
+        connections,
+        adaptive=adaptive,
+        max_workers=max_workers,
+        transport=transport,
+        dry_run=dry_run,
+        plan_json=plan_json,
+        archive=archive,
+    )
+
+
+@cli.command()
+@click.argument("src", type=click.Path(exists=True))
+@click.option(
+    "-d", "--dest", default=None, help="Push into this gdrive folder. Should be formatted as gdrive:path/to/folder."
+)
+@click.option("-w", "--workers", default=5, type=int, help="Number of workers to upload asynchronously.")
+@click.option("-i", "--ignore", multiple=True, help="Set the dirs to ignore when pushing.")
+@add_options(transfer_options)
+@click.option(
+    "--debounce",
+    default=2.0,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    help="Seconds without changes before they are pushed.",
+)
+@click.option(
+    "--max-delay",
+    default=30.0,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    help="Push changes after this many seconds even while more keep coming.",
+)
+@click.option("--stats", is_flag=True, help="Print timings, API calls and transfer totals after every push.")
+def watch(src, dest, workers, ignore, batch_size, resumable_threshold, chunk_size, debounce, max_delay, stats):
+    """Push to gdrive folder, then keep pushing changes as they happen.
+
+    Only the folders that changed are compared with gdrive. Needs Linux (inotify).
+
+    SRC: Absolute path to the source dir.
+    """
+    settings_path = pathlib.Path(__file__).parent / "settings.yaml"
+    if not os.path.exists(settings_path):
+        raise click.ClickException("Google Drive API not setup. Please run `argsync setup` to resolve it.")
+    if not (os.path.exists(src) and os.path.isdir(src)):
+        raise click.BadParameter(f"{src} is not a valid directory.")
+    if not os.path.isabs(src):
+        raise click.BadParameter("SRC must be an absolute path.")
+    if dest is None:
+        dest = "gdrive:"
+    if not is_valid_gdrive_path(dest):
+        raise click.BadParameter("The path to Google Drive folder should be like `gdrive:path/to/folder`.")
+    from argsync.watch import watch as watching
+
+    watching(
+        src,
+        dest,
+        ignore,
+        workers,
+        batch_size,
+        resumable_threshold * 1024 * 1024,
+        chunk_size * 1024 * 1024,
+        debounce,
+        max_delay,
+        stats=stats,
+    )
+
+
+@cli.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-j", "--parallel", default=None, type=click.IntRange(min=1), help="Number of jobs running at the same time."
+)
+@click.option(
+    "-w", "--workers", default=None, type=click.IntRange(min=1), help="Number of API calls in flight across all jobs."
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Print what every job would transfer and remove, without changing anything."
+)
+@add_options(stats_options)
+def run(manifest, parallel, workers, dry_run, stats, stats_json):
+    """Run the push and pull jobs of a manifest in one process.
+
+    MANIFEST: A YAML file listing the jobs, see `argsync.manifest`. --parallel and --workers override its
+    parallel and workers settings.
+    """
+    settings_path = pathlib.Path(__file__).parent / "settings.yaml"
+    if not os.path.exists(settings_path):
+        raise click.ClickException("Google Drive API not setup. Please run `argsync setup` to resolve it.")
+    from argsync.manifest import run_manifest
+
+    run_with_stats("run", stats, stats_json, run_manifest, manifest, parallel, workers, dry_run=dry_run)
 
 
 @cli.command()
 def remove_profile():
     """Remove user's credentials."""
+    from argsync.credentials import LEGACY_PATH, CredentialStore
 
-    creds = pathlib.Path(__file__).parent / "credentials.json"
+    store = CredentialStore()
 
-    if os.path.exists(creds):
-        os.remove(creds)
+    if store.path.exists() or LEGACY_PATH.exists():
+        store.delete()
         print("Profile removed successfully.")
     else:
         print("No profile found.")
@@ -91,6 +377,8 @@ def remove_profile():
 @cli.command()
 def setup():
     """Setup Google Drive API."""
+    import yaml
+
     settings_path = pathlib.Path(__file__).parent / "settings.yaml"
     if os.path.exists(settings_path):
         click.confirm("Setup file exists. Overwrite?", abort=True)
@@ -101,9 +389,8 @@ def setup():
     settings_yaml = {
         "client_config_backend": "settings",
         "client_config": {"client_id": client_id, "client_secret": client_secret},
-        "save_credentials": True,
-        "save_credentials_backend": "file",
-        "save_credentials_file": str(pathlib.Path(__file__).parent / "credentials.json"),
+        # argsync saves the credentials itself, see argsync.credentials
+        "save_credentials": False,
         "get_refresh_token": True,
         "oauth_scope": ["https://www.googleapis.com/auth/drive"],
     }
@@ -0,0 +1,280 @@
+"""
+Runs many pushes and pulls, listed in a manifest, in one process.
+
+The jobs share one authorized drive, one pool of connections, one pool of hashing processes, the local file-state,
+folder ID and upload-session caches, and one set of metrics. The pool caps the API calls in flight across all jobs, however many jobs run at
+once. A manifest is a YAML (or JSON) file like:
+
+    workers: 16      # API calls in flight across all jobs
+    parallel: 4      # jobs running at the same time
+    jobs:
+      - push: /home/me/projects
+        dest: gdrive:backups
+        ignore: [.git]
+        archive: [node_modules]
+      - pull: gdrive:photos/2023
+        dest: /home/me/pictures
+        incremental: true
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+import click
+import yaml
+from pydrive2.drive import GoogleDrive
+
+from argsync.batch import BATCH_SIZE
+from argsync.gdrive import load_authorized_gdrive, share_pool
+from argsync.hashing import HashEngine
+from argsync.metrics import RunMetrics, instrument
+from argsync.paths import is_valid_gdrive_path
+from argsync.plan import SyncPlan
+from argsync.pull import pull
+from argsync.push import push
+from argsync.resumable import UploadSessions
+from argsync.state import FileStateCache, FolderIdCache
+
+WORKERS = 16
+PARALLEL = 4
+JOB_WORKERS = 5
+# The keys a job may have besides its command
+JOB_KEYS = {
+    "push": {"name", "dest", "ignore", "archive", "workers", "batch_size"},
+    "pull": {"name", "dest", "workers", "incremental", "archive"},
+}
+
+
+class Job:
+    """
+    One push or pull of a manifest, and its outcome once it ran.
+
+    Attributes:
+        command (str): "push" or "pull".
+        src (str): The absolute local folder to push, or the gdrive:path/to/folder to pull.
+        dest (str): The gdrive folder to push into, or the absolute local directory to pull into.
+        options (dict): The other keys of the job, e.g. ignore, archive or incremental.
+        name (str): The name of the job in the output.
+        plan (SyncPlan): The plan of the job, once it ran.
+        seconds (float): How long the job took.
+        error (Exception): The error the job failed with, if any.
+    """
+
+    def __init__(self, command: str, src: str, dest: str, options: Dict[str, Any]):
+        self.command = command
+        self.src = src
+        self.dest = dest
+        self.options = options
+        self.name = options.get("name") or f"{command} {src}"
+        self.plan: Optional[SyncPlan] = None
+        self.seconds = 0.0
+        self.error: Optional[Exception] = None
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Any]:
+    """
+    Reads and checks a manifest.
+
+    Args:
+        manifest_path (str): The path of the manifest.
+
+    Returns:
+        dict: The workers and parallel settings, and the list of jobs.
+
+    Raises:
+        click.ClickException: If the manifest cannot be read or a job is not valid.
+    """
+    try:
+        with open(manifest_path, "r") as f:
+            data = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise click.ClickException(f"Cannot read the manifest {manifest_path}: {e}")
+    if not isinstance(data, dict) or not isinstance(data.get("jobs"), list) or not data["jobs"]:
+        raise click.ClickException(f"The manifest {manifest_path} should have a non-empty list of jobs.")
+
+    jobs = []
+    for number, entry in enumerate(data["jobs"], 1):
+        where = f"Job {number} of {manifest_path}"
+        commands = [command for command in JOB_KEYS if command in (entry if isinstance(entry, dict) else {})]
+        if len(commands) != 1:
+            raise click.ClickException(f"{where} should have exactly one of push or pull.")
+        command = commands[0]
+        options = {key: value for key, value in entry.items() if key != command}
+        unknown = set(options) - JOB_KEYS[command]
+        if unknown:
+            raise click.ClickException(f"{where} has unknown keys: {', '.join(sorted(unknown))}.")
+        src = str(entry[command])
+        if command == "push":
+            dest = str(options.get("dest", "gdrive:"))
+            if not (os.path.isabs(src) and os.path.isdir(src)):
+                raise click.ClickException(f"{where}: {src} is not an absolute path to a directory.")
+            if not is_valid_gdrive_path(dest):
+                raise click.ClickException(f"{where}: dest should be like `gdrive:path/to/folder`.")
+        else:
+            dest = str(options.get("dest", os.path.expanduser("~")))
+            if not is_valid_gdrive_path(src):
+                raise click.ClickException(f"{where}: pull should be like `gdrive:path/to/folder`.")
+            if not (os.path.isabs(dest) and os.path.isdir(dest)):
+                raise click.ClickException(f"{where}: {dest} is not an absolute path to a directory.")
+        jobs.append(Job(command, src, dest, options))
+
+    return {
+        "workers": int(data.get("workers", WORKERS)),
+        "parallel": int(data.get("parallel", PARALLEL)),
+        "jobs": jobs,
+    }
+
+
+def run_job(
+    job: Job,
+    drive: GoogleDrive,
+    metrics: RunMetrics,
+    budget: int,
+    state: FileStateCache,
+    folder_ids: FolderIdCache,
+    sessions: UploadSessions,
+    hasher: HashEngine,
+    dry_run: bool = False,
+) -> None:
+    """
+    Runs one job on the shared drive and caches, and records its plan, time and error on it.
+
+    Args:
+        job (Job): The job.
+        drive (GoogleDrive): The drive shared by all jobs.
+        metrics (RunMetrics): The metrics shared by all jobs.
+        budget (int): The number of API calls in flight across all jobs. A job never asks for more workers.
+        state (FileStateCache): The shared local file-state cache.
+        folder_ids (FolderIdCache): The shared folder ID cache.
+        sessions (UploadSessions): The shared unfinished resumable uploads.
+        hasher (HashEngine): The shared engine hashing local files.
+        dry_run (bool): Only plan the job.
+    """
+    workers = min(int(job.options.get("workers", JOB_WORKERS)), budget)
+    start = time.perf_counter()
+    print(f"[{job.name}] started.")
+    try:
+        if job.command == "push":
+            job.plan = push(
+                job.src.rstrip(os.path.sep),
+                job.dest,
+                tuple(job.options.get("ignore", ())),
+                workers,
+                int(job.options.get("batch_size", BATCH_SIZE)),
+                drive=drive,
+                metrics=metrics,
+                dry_run=dry_run,
+                state=state,
+                folder_ids=folder_ids,
+                sessions=sessions,
+                archive_dirs=tuple(job.options.get("archive", ())),
+                hasher=hasher,
+            )
+        else:
+            job.plan = pull(
+                job.src,
+                job.dest,
+                workers,
+                bool(job.options.get("incremental", False)),
+                drive=drive,
+                metrics=metrics,
+                dry_run=dry_run,
+                state=state,
+                folder_ids=folder_ids,
+                archive=bool(job.options.get("archive", False)),
+                hasher=hasher,
+            )
+    except Exception as e:
+        job.error = e
+    job.seconds = time.perf_counter() - start
+    outcome = f"failed: {job.error}" if job.error else f"done in {job.seconds:.2f}s"
+    print(f"[{job.name}] {outcome}")
+
+
+def run_manifest(
+    manifest_path: str,
+    parallel: Optional[int] = None,
+    workers: Optional[int] = None,
+    drive: Optional[GoogleDrive] = None,
+    metrics: Optional[RunMetrics] = None,
+    dry_run: bool = False,
+) -> List[Job]:
+    """
+    Runs the jobs of a manifest in one process, and prints a summary of all of them.
+
+    Args:
+        manifest_path (str): The path of the manifest.
+        parallel (int): The number of jobs running at the same time. Overrides the manifest.
+        workers (int): The number of API calls in flight across all jobs. Overrides the manifest.
+        drive (GoogleDrive): The Google Drive to use, e.g. the FakeDrive of the benchmarks. Loads the saved credentials when None.
+        metrics (RunMetrics): Collects timings and call counts of all jobs.
+        dry_run (bool): Print the plan of every job instead of carrying it out.
+
+    Returns:
+        list: The jobs, with their plans, times and errors.
+
+    Raises:
+        click.ClickException: If the manifest is not valid, or when any job failed.
+    """
+    manifest = load_manifest(manifest_path)
+    jobs = manifest["jobs"]
+    parallel = max(parallel or manifest["parallel"], 1)
+    budget = max(workers or manifest["workers"], 1)
+    if drive is None:
+        drive = load_authorized_gdrive()
+    if metrics is None:
+        metrics = RunMetrics("run")
+    # Before any job starts, so concurrent jobs find the drive instrumented already
+    instrument(drive, metrics)
+    share_pool(drive, budget)
+    state, folder_ids, sessions = FileStateCache(), FolderIdCache(), UploadSessions()
+    # One pool of hashing processes for all jobs, rather than one per job
+    hasher = HashEngine()
+
+    print(f"Running {len(jobs)} jobs, {parallel} at a time, with up to {budget} API calls in flight.")
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(run_job, job, drive, metrics, budget, state, folder_ids, sessions, hasher, dry_run)
+                for job in jobs
+            ]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        hasher.close()
+        if not dry_run:
+            state.save()
+            folder_ids.save()
+
+    print(summarize_jobs(jobs))
+    failed = [job for job in jobs if job.error is not None]
+    if failed:
+        raise click.ClickException(f"{len(failed)} of {len(jobs)} jobs failed.")
+    return jobs
+
+
+def summarize_jobs(jobs: List[Job]) -> str:
+    """
+    Formats the outcome of every job for the terminal.
+
+    Args:
+        jobs (list): The jobs after they ran.
+
+    Returns:
+        str: A multi-line summary, one line per job.
+    """
+    width = max(len(job.name) for job in jobs)
+    lines = [f"Summary of {len(jobs)} jobs:"]
+    for job in jobs:
+        if job.error is not None:
+            outcome = f"failed: {job.error}"
+        elif job.plan:
+            outcome = ", ".join(f"{kind} {t['count']}" for kind, t in job.plan.totals().items())
+        else:
+            outcome = "up to date"
+        lines.append(f"  {job.name:<{width}}  {job.seconds:7.2f}s  {outcome}")
+    done = sum(job.error is None for job in jobs)
+    lines.append(f"Total: {done} succeeded, {len(jobs) - done} failed.")
+    return "\n".join(lines)
@@ -0,0 +1,391 @@
+import bisect
+import collections
+import contextlib
+import datetime
+import json
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from pydrive2.drive import GoogleDrive
+
+# Upper bounds of the latency histogram buckets, in seconds. Slower calls land in a final "inf" bucket.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def call_kind(method: str, uri: str) -> str:
+    """
+    Names the Drive API endpoint an HTTP request goes to, e.g. "files.list" or "upload.chunk".
+
+    Args:
+        method (str): The HTTP method.
+        uri (str): The request URI.
+
+    Returns:
+        str: The endpoint name, or "other" for requests that are not Drive API calls.
+    """
+    parsed = urllib.parse.urlsplit(uri)
+    path, query = parsed.path, urllib.parse.parse_qs(parsed.query)
+    if "oauth2" in parsed.netloc or path.endswith("/token"):
+        return "auth.refresh"
+    if path.startswith("/batch"):
+        return "batch"
+    if path.startswith("/upload/drive/"):
+        if "upload_id" in query:
+            return "upload.chunk"
+        if query.get("uploadType") == ["resumable"]:
+            return "upload.session"
+        return "files.update" if method == "PUT" else "files.insert"
+    if path.startswith("/drive/v2/changes"):
+        return "changes.getStartPageToken" if path.endswith("/startPageToken") else "changes.list"
+    if path.startswith("/drive/v2/files"):
+        parts = path[len("/drive/v2/files") :].strip("/").split("/")
+        if parts[0] == "":
+            return "files.list" if method == "GET" else "files.insert"
+        if len(parts) > 1:
+            return f"files.{parts[1]}"
+        if query.get("alt") == ["media"]:
+            return "files.get_media"
+        return {"GET": "files.get", "PATCH": "files.patch", "PUT": "files.update", "DELETE": "files.delete"}.get(
+            method, "other"
+        )
+    return "other"
+
+
+class RunMetrics:
+    """
+    Counters and timings of one push or pull.
+
+    Phases are wall-clock time the main thread spent in each step, e.g. listing or hashing. Transfers run on
+    the pipeline workers concurrently with those steps, so their time is reported separately as the summed
+    duration of all transfer tasks.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.error: Optional[str] = None
+        self._start = time.perf_counter()
+        self._seconds: Optional[float] = None
+        self._lock = threading.Lock()
+        self.phases: Dict[str, float] = collections.defaultdict(float)
+        self.calls: Dict[str, Dict[str, Any]] = {}
+        self.retries: Dict[str, int] = collections.Counter()
+        self.files: Dict[str, int] = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.transfer_seconds = 0.0
+        self.bytes_transferred = 0
+        self.bytes_deduplicated = 0
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Adds the time spent in the with block to a phase.
+
+        Args:
+            name (str): The name of the phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def timed(self, name: str, items: Iterable) -> Iterator:
+        """
+        Passes through the items of an iterator, adding the time spent waiting for each one to a phase.
+
+        Useful for generators like FileStateCache.md5_many, whose work happens between the yields.
+
+        Args:
+            name (str): The name of the phase.
+            items (iterable): The items to pass through.
+
+        Yields:
+            The items of the iterable.
+        """
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(name, time.perf_counter() - start)
+                return
+            self.add_phase(name, time.perf_counter() - start)
+            yield item
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[name] += seconds
+
+    def record_call(self, kind: str, seconds: float, status: int = 200, sent: int = 0, received: int = 0) -> None:
+        """
+        Records one API request.
+
+        Args:
+            kind (str): The endpoint, as named by call_kind.
+            seconds (float): The latency of the request.
+            status (int): The HTTP status of the response, 0 if no response arrived.
+            sent (int): Number of bytes in the request body.
+            received (int): Number of bytes in the response body.
+        """
+        with self._lock:
+            call = self.calls.get(kind)
+            if call is None:
+                call = {"count": 0, "errors": 0, "seconds": 0.0, "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+                self.calls[kind] = call
+            call["count"] += 1
+            call["seconds"] += seconds
+            call["histogram"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            if not 200 <= status < 400:
+                call["errors"] += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def retried(self, kind: str, count: int = 1) -> None:
+        """
+        Counts calls that are sent again after failing.
+
+        Args:
+            kind (str): What was retried, e.g. "batch" or "upload.chunk".
+            count (int): Number of calls retried.
+        """
+        with self._lock:
+            self.retries[kind] += count
+
+    def count_files(self, outcome: str, count: int = 1) -> None:
+        """
+        Counts files by what happened to them.
+
+        Args:
+            outcome (str): E.g. "transferred", "unchanged" or "removed".
+            count (int): Number of files.
+        """
+        with self._lock:
+            self.files[outcome] += count
+
+    def transferred(self, size: int, seconds: float) -> None:
+        """
+        Records a finished transfer task.
+
+        Args:
+            size (int): Number of bytes of the file.
+            seconds (float): How long the task took on its worker.
+        """
+        with self._lock:
+            self.transfer_seconds += seconds
+            self.bytes_transferred += size
+            self.files["transferred"] += 1
+
+    def deduplicated(self, size: int) -> None:
+        """
+        Records a file created by a server-side copy of content already on Google Drive, instead of an upload.
+
+        Args:
+            size (int): Number of bytes of the file, which did not have to be sent.
+        """
+        with self._lock:
+            self.bytes_deduplicated += size
+            self.files["copied"] += 1
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Stops the run clock.
+
+        Args:
+            error (Exception): The error that ended the run, if any.
+        """
+        self._seconds = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def seconds(self) -> float:
+        return self._seconds if self._seconds is not None else time.perf_counter() - self._start
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Returns all metrics as JSON-serializable data.
+
+        Returns:
+            dict: The metrics of the run.
+        """
+        bucket_names = [f"le_{int(b * 1000)}ms" for b in LATENCY_BUCKETS] + ["inf"]
+        with self._lock:
+            return {
+                "command": self.command,
+                "started": self.started.isoformat(),
+                "seconds": round(self.seconds, 3),
+                "error": self.error,
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "transfer": {
+                    "worker_seconds": round(self.transfer_seconds, 3),
+                    "bytes": self.bytes_transferred,
+                },
+                "dedup": {
+                    "bytes_saved": self.bytes_deduplicated,
+                    # Bytes the synced files hold over bytes that were sent, None when nothing was sent
+                    "ratio": (
+                        round((self.bytes_transferred + self.bytes_deduplicated) / self.bytes_transferred, 3)
+                        if self.bytes_transferred
+                        else None
+                    ),
+                },
+                "calls": {
+                    kind: {
+                        "count": call["count"],
+                        "errors": call["errors"],
+                        "seconds": round(call["seconds"], 3),
+                        "histogram": dict(zip(bucket_names, call["histogram"])),
+                    }
+                    for kind, call in sorted(self.calls.items())
+                },
+                "bytes": {"sent": self.bytes_sent, "received": self.bytes_received},
+                "files": dict(self.files),
+                "retries": dict(self.retries),
+            }
+
+    def write_json(self, path: str) -> None:
+        """
+        Writes the metrics to a JSON file.
+
+        Args:
+            path (str): The file to write.
+        """
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self) -> str:
+        """
+        Formats the metrics for the terminal.
+
+        Returns:
+            str: A multi-line summary.
+        """
+        data = self.as_dict()
+        lines = [f"Stats for {data['command']} ({data['seconds']:.2f}s):"]
+        if data["phases"]:
+            lines.append("  Phases:    " + ", ".join(f"{n} {s:.2f}s" for n, s in data["phases"].items()))
+        transfer = data["transfer"]
+        lines.append(
+            f"  Transfers: {data['files'].get('transferred', 0)} files, {_mib(transfer['bytes'])}"
+            f" in {transfer['worker_seconds']:.2f}s of worker time"
+        )
+        dedup = data["dedup"]
+        if dedup["bytes_saved"]:
+            ratio = f", dedup ratio {dedup['ratio']:.2f}x" if dedup["ratio"] else ""
+            lines.append(
+                f"  Copies:    {data['files'].get('copied', 0)} files copied on gdrive,"
+                f" {_mib(dedup['bytes_saved'])} not uploaded{ratio}"
+            )
+        if data["files"]:
+            lines.append("  Files:     " + ", ".join(f"{n} {c}" for n, c in sorted(data["files"].items())))
+        total = sum(call["count"] for call in data["calls"].values())
+        errors = sum(call["errors"] for call in data["calls"].values())
+        lines.append(
+            f"  API calls: {total} ({errors} failed), sent {_mib(data['bytes']['sent'])},"
+            f" received {_mib(data['bytes']['received'])}"
+        )
+        for kind, call in data["calls"].items():
+            histogram = list(call["histogram"].values())
+            lines.append(
+                f"    {kind:<26} {call['count']:>6}  mean {call['seconds'] / call['count'] * 1000:7.1f}ms"
+                f"  p50 {_percentile(histogram, 0.5):>7}  p95 {_percentile(histogram, 0.95):>7}"
+            )
+        if data["retries"]:
+            lines.append("  Retries:   " + ", ".join(f"{k} {n}" for k, n in sorted(data["retries"].items())))
+        if data["error"]:
+            lines.append(f"  Failed:    {data['error']}")
+        return "\n".join(lines)
+
+
+def _mib(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+def _percentile(histogram: list, fraction: float) -> str:
+    # Reports the upper bound of the bucket holding the percentile
+    target = fraction * sum(histogram)
+    seen = 0
+    for bound, count in zip(list(LATENCY_BUCKETS) + [None], histogram):
+        seen += count
+        if seen >= target and count:
+            return f"<{int(bound * 1000)}ms" if bound is not None else ">10s"
+    return "-"
+
+
+# Metrics of drives that were never instrumented go here and are never read
+_DISCARDED = RunMetrics("discarded")
+
+
+def metrics_for(drive: GoogleDrive) -> RunMetrics:
+    """
+    Returns the metrics a drive reports to, so code deep in a run can count retries and skipped files.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        RunMetrics: The metrics given to instrument, or a throwaway instance.
+    """
+    return getattr(drive, "argsync_metrics", _DISCARDED)
+
+
+def timed_request(request: Callable, drive: GoogleDrive) -> Callable:
+    """
+    Wraps the request method of an http object so every request reports to the drive's metrics.
+
+    Args:
+        request (function): The request method, e.g. of an httplib2.Http.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        function: The timed request method.
+    """
+
+    def timed(uri, method="GET", body=None, *args, **kwargs):
+        start = time.perf_counter()
+        status, received = 0, 0
+        try:
+            resp, content = request(uri, method, body, *args, **kwargs)
+            status, received = resp.status, len(content or b"")
+            return resp, content
+        finally:
+            sent = len(body) if isinstance(body, (bytes, str)) else 0
+            metrics_for(drive).record_call(call_kind(method, uri), time.perf_counter() - start, status, sent, received)
+
+    return timed
+
+
+def instrument(drive: GoogleDrive, metrics: RunMetrics) -> None:
+    """
+    Makes every API request of a drive, from PyDrive2 or made directly, report to metrics.
+
+    Instrumenting a drive again only switches the metrics it reports to.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        metrics (RunMetrics): The metrics of the run.
+    """
+    instrumented = hasattr(drive, "argsync_metrics")
+    drive.argsync_metrics = metrics
+    if instrumented:
+        return
+
+    auth = drive.auth
+    get_http_object = auth.Get_Http_Object
+
+    def instrumented_http():
+        http = get_http_object()
+        http.request = timed_request(http.request, drive)
+        return http
+
+    auth.Get_Http_Object = instrumented_http
+    if getattr(auth, "http", None) is not None:
+        # The http object drive.auth.service was built with
+        auth.http.request = timed_request(auth.http.request, drive)
+    if getattr(auth.thread_local, "http", None) not in (None, getattr(auth, "http", None)):
+        auth.thread_local.http.request = timed_request(auth.thread_local.http.request, drive)
@@ -0,0 +1,15 @@
+import re
+
+
+def is_valid_gdrive_path(path: str) -> bool:
+    """
+    Checks if a path is formatted as gdrive:path/to/folder.
+
+    Args:
+        path (str): The path to check.
+
+    Returns:
+        bool: True if the path points into Google Drive.
+    """
+    pattern = r"^gdrive:([a-zA-Z0-9 _\.\-\u4E00-\u9FFF]*)$"
+    return bool(re.match(pattern, path))
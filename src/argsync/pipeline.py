@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import tqdm
+
+from argsync.metrics import RunMetrics
+
+
+class TransferPipeline:
+    """
+    One persistent worker pool per run, fed through a bounded queue.
+
+    Discovery and diffing submit tasks from the main thread while workers consume them across all folders.
+    When the queue is full, submit blocks, so producers never run far ahead of the transfers. A single
+    progress bar reports files/s and bytes/s for the whole run.
+
+    The first failing task stops the pipeline: queued tasks are skipped, and the error is raised from the
+    next submit or from close.
+    """
+
+    def __init__(
+        self, num_of_workers: int, desc: str, max_queued: Optional[int] = None, metrics: Optional[RunMetrics] = None
+    ):
+        self._metrics = metrics
+        self._queue = queue.Queue(maxsize=max_queued or 4 * num_of_workers)
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+        self._bytes_done = 0
+        self._started = time.monotonic()
+        self._progress = tqdm.tqdm(total=0, desc=desc, unit="file")
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max(num_of_workers, 1))]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self) -> None:
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            fn, args, size, on_done = task
+            try:
+                if self._error is None:
+                    start = time.perf_counter()
+                    result = fn(args)
+                    if on_done is not None:
+                        on_done(result)
+                    if self._metrics is not None:
+                        self._metrics.transferred(size, time.perf_counter() - start)
+                    self._completed(size)
+            except BaseException as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _completed(self, size: int) -> None:
+        with self._lock:
+            self._bytes_done += size
+            elapsed = max(time.monotonic() - self._started, 1e-6)
+            self._progress.set_postfix_str(
+                tqdm.tqdm.format_sizeof(self._bytes_done / elapsed, "B/s", divisor=1024), refresh=False
+            )
+            self._progress.update()
+
+    def submit(self, fn: Callable, args: Any, size: int = 0, on_done: Optional[Callable] = None) -> None:
+        """
+        Queues a task, blocking while the queue is full.
+
+        Args:
+            fn (function): The task function, called with args as its only argument.
+            args: The argument for fn, e.g. the task tuple of file_upload or file_download.
+            size (int): Number of bytes the task transfers, used for the bytes/s display.
+            on_done (function): Called in the worker thread with the result of fn after it succeeded.
+
+        Raises:
+            Exception: The error of a previously failed task.
+        """
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            self._progress.total += 1
+            self._progress.refresh()
+        self._queue.put((fn, args, size, on_done))
+
+    def write(self, message: str) -> None:
+        """
+        Prints a message without breaking the progress bar.
+
+        Args:
+            message (str): The message to print.
+        """
+        self._progress.write(message)
+
+    def close(self) -> None:
+        """
+        Waits for all queued tasks and stops the workers.
+
+        Raises:
+            Exception: The error of the first failed task, if any.
+        """
+        self._queue.join()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._progress.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "TransferPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            with self._lock:
+                if self._error is None:
+                    self._error = exc
+            try:
+                self.close()
+            except BaseException:
+                pass
+            return
+        self.close()
@@ -0,0 +1,396 @@
+import collections
+import json
+import os
+import pathlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pydrive2.drive import GoogleDriveFile
+
+# Order in which actions are listed, and in which the execution of a plan goes through them
+ACTION_KINDS = ("mkdir", "move", "upload", "copy", "pack", "download", "update", "unpack", "trash", "delete", "rmdir")
+
+
+class PlanAction:
+    """
+    One step of a sync plan.
+
+    Attributes:
+        kind (str): One of ACTION_KINDS. Push plans create folders (mkdir), upload new files, update changed
+            ones and trash what is gone locally. Pull plans create local folders (mkdir), download new files,
+            update changed ones, and delete local files and remove local folders (rmdir) that are gone on gdrive.
+            Both move files and folders whose content only changed place (move) instead of transferring it again.
+            Push copies new files whose content is already on gdrive server-side (copy) instead of uploading them.
+            In archive mode, push packs and uploads the chunks of archived folders that changed (pack), and pull
+            downloads and unpacks them (unpack).
+        path (str): The path of the file or folder, relative to the parent of the synced folder.
+        size (int): Number of bytes the action transfers, moves or removes. For folders, the size of the files below.
+        parent (str): The relative path of the folder the file goes into.
+        remote (dict): The file or folder on Google Drive the action reads, updates, moves or trashes, if any.
+        source (str): The relative path a moved file or folder comes from, the file a copy is made of, or the
+            chunk an archived folder is unpacked from.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        path: str,
+        size: int = 0,
+        parent: Optional[str] = None,
+        remote: Optional[Dict] = None,
+        source: Optional[str] = None,
+    ):
+        self.kind = kind
+        self.path = path
+        self.size = size
+        self.parent = parent
+        self.remote = remote
+        self.source = source
+
+    def as_dict(self) -> Dict[str, Any]:
+        data = {"kind": self.kind, "path": self.path, "size": self.size}
+        if self.source is not None:
+            data["from"] = self.source
+        if self.remote is not None:
+            data["id"] = self.remote["id"]
+        return data
+
+
+class SyncPlan:
+    """
+    Everything a push or pull is going to do, worked out before anything is changed.
+
+    Planning indexes the local and the remote side into dicts once, so comparing a folder takes time linear
+    in its size. Executing the plan only consumes its actions, and a dry run prints them instead.
+    """
+
+    def __init__(self, command: str, source: str, target: str):
+        self.command = command
+        self.source = source
+        self.target = target
+        self.actions: List[PlanAction] = []
+        self.notes: List[str] = []
+
+    def add(
+        self,
+        kind: str,
+        path: str,
+        size: int = 0,
+        parent: Optional[str] = None,
+        remote: Optional[Dict] = None,
+        source: Optional[str] = None,
+    ) -> None:
+        """
+        Appends an action to the plan.
+
+        Args:
+            kind (str): One of ACTION_KINDS.
+            path (str): The relative path of the file or folder.
+            size (int): Number of bytes involved.
+            parent (str): The relative path of the folder the file goes into.
+            remote (dict): The file or folder on Google Drive the action is about.
+            source (str): The relative path a moved file or folder comes from, or the file a copy is made of.
+        """
+        self.actions.append(PlanAction(kind, path, size, parent, remote, source))
+
+    def note(self, message: str) -> None:
+        """
+        Records something the plan cannot express as an action, e.g. files skipped because of duplicate titles.
+
+        Args:
+            message (str): The note.
+        """
+        self.notes.append(message)
+
+    def of_kind(self, kind: str) -> List[PlanAction]:
+        """
+        Returns the actions of one kind, in the order they were planned.
+
+        Args:
+            kind (str): One of ACTION_KINDS.
+
+        Returns:
+            list: The matching actions.
+        """
+        return [action for action in self.actions if action.kind == kind]
+
+    def totals(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns the number of actions and bytes of each kind.
+
+        Returns:
+            dict: Maps every planned kind to {"count": ..., "bytes": ...}.
+        """
+        totals = collections.OrderedDict()
+        for kind in ACTION_KINDS:
+            actions = self.of_kind(kind)
+            if actions:
+                totals[kind] = {"count": len(actions), "bytes": sum(action.size for action in actions)}
+        return totals
+
+    def __bool__(self) -> bool:
+        return bool(self.actions)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Returns the plan as JSON-serializable data.
+
+        Returns:
+            dict: The plan.
+        """
+        return {
+            "command": self.command,
+            "source": self.source,
+            "target": self.target,
+            "totals": self.totals(),
+            "actions": [action.as_dict() for action in sorted(self.actions, key=_action_order)],
+            "notes": self.notes,
+        }
+
+    def write_json(self, path: str) -> None:
+        """
+        Writes the plan to a JSON file.
+
+        Args:
+            path (str): The file to write, or "-" for standard output.
+        """
+        if path == "-":
+            print(json.dumps(self.as_dict(), indent=2))
+            return
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self) -> str:
+        """
+        Formats the plan for the terminal: one line per action, then the totals.
+
+        Returns:
+            str: A multi-line listing.
+        """
+        lines = [f"Plan for {self.command} from {self.source} to {self.target}:"]
+        for action in sorted(self.actions, key=_action_order):
+            path = action.path if action.source is None else f"{action.source} -> {action.path}"
+            lines.append(f"  {action.kind:<8} {_size(action.size):>10}  {path}")
+        for message in self.notes:
+            lines.append(f"  note: {message}")
+        totals = self.totals()
+        if totals:
+            lines.append(
+                "Total: " + ", ".join(f"{kind} {t['count']} ({_size(t['bytes'])})" for kind, t in totals.items())
+            )
+        else:
+            lines.append("Nothing to do.")
+        return "\n".join(lines)
+
+
+def _action_order(action: PlanAction) -> Tuple[int, str]:
+    return ACTION_KINDS.index(action.kind), action.path
+
+
+def _size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def index_by_title(
+    items: Iterable[GoogleDriveFile], key=lambda item: item["title"]
+) -> Tuple[Dict[str, GoogleDriveFile], List[GoogleDriveFile]]:
+    """
+    Indexes Google Drive items by name. Drive allows several items with the same title in a folder, and only
+    one of them can match a local path: the most recently modified one is kept.
+
+    Args:
+        items (iterable): The Google Drive file objects of one folder.
+        key (function): Returns the name to index an item by, e.g. its local file name.
+
+    Returns:
+        tuple: The index of name to item, and the items that lost to a newer item of the same name.
+    """
+    index: Dict[str, GoogleDriveFile] = {}
+    duplicates: List[GoogleDriveFile] = []
+    for item in items:
+        name = key(item)
+        kept = index.get(name)
+        if kept is None:
+            index[name] = item
+        elif item.get("modifiedDate", "") > kept.get("modifiedDate", ""):
+            index[name] = item
+            duplicates.append(kept)
+        else:
+            duplicates.append(item)
+    return index, duplicates
+
+
+def index_local(folder_path: str, ignore_dirs: Iterable[str] = (), recursive: bool = True) -> Dict[str, Dict[str, int]]:
+    """
+    Indexes a local folder tree in one walk.
+
+    Args:
+        folder_path (str): The local folder.
+        ignore_dirs (iterable): Names of directories to skip, with everything below them.
+        recursive (bool): Index the folders below folder_path too. When False, only folder_path itself is indexed.
+
+    Returns:
+        dict: Maps every folder path, relative to the parent of folder_path, to {file name: size} of its files.
+    """
+    parent = os.path.dirname(folder_path)
+    index = {}
+    for root, dirs, files in os.walk(folder_path, topdown=True):
+        # Modify dirs in-place to skip ignored directories
+        dirs[:] = [d for d in dirs if d not in ignore_dirs]
+        sizes = {}
+        for name in files:
+            try:
+                sizes[name] = os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Dangling symlinks and files removed since the walk listed them
+                continue
+        index[os.path.relpath(root, parent)] = sizes
+        if not recursive:
+            break
+    return index
+
+
+def is_below(path: str, folder: str) -> bool:
+    """
+    Tells whether a relative path is a folder or lies anywhere below it.
+
+    Args:
+        path (str): The path to check.
+        folder (str): The folder path.
+
+    Returns:
+        bool: True if path is folder itself or inside it.
+    """
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def plan_moves(
+    plan: SyncPlan,
+    targets: Dict[str, str],
+    sources: Dict[str, Tuple[int, Optional[str], Optional[Dict]]],
+    removed_folders: Dict[str, List[str]],
+) -> None:
+    """
+    Turns the transfers of content that is about to be removed at another path into moves.
+
+    A moved or renamed file shows up as a new file plus a removed one. Matching the two by size and md5 lets
+    the existing copy be moved instead of transferred again. When a removed folder holds exactly the files of
+    a new folder, at the same relative paths, the whole folder is moved in one action.
+
+    Args:
+        plan (SyncPlan): The plan, with its uploads or downloads and its removals already added.
+        targets (dict): Maps the paths of planned uploads or downloads to the md5 of their content.
+        sources (dict): Maps the paths of the files about to be removed, on their own or with their folder, to
+            their (size, md5, Google Drive file). The file is None for local files.
+        removed_folders (dict): Maps the topmost folders about to be removed to all folder paths below them,
+            themselves included.
+    """
+    by_content = collections.defaultdict(list)
+    for path, (size, md5, _) in sources.items():
+        if md5 is not None:
+            by_content[size, md5].append(path)
+
+    moves, replaced = [], set()
+    for action in plan.actions:
+        if action.kind not in ("upload", "download") or action.path not in targets:
+            continue
+        paths = by_content.get((action.size, targets[action.path]))
+        if not paths:
+            continue
+        # A file with the same name elsewhere was moved, which is likelier than a copy being renamed
+        name = os.path.basename(action.path)
+        source = next((p for p in paths if os.path.basename(p) == name), paths[0])
+        paths.remove(source)
+        remote = sources[source][2]
+        moves.append(PlanAction("move", action.path, action.size, action.parent, remote or action.remote, source))
+        replaced.add(id(action))
+    if not moves:
+        return
+
+    def top_of(path: str) -> Optional[str]:
+        return next((str(p) for p in pathlib.PurePath(path).parents if str(p) in removed_folders), None)
+
+    moved_from = collections.defaultdict(list)
+    for move in moves:
+        moved_from[top_of(move.source)].append(move)
+    source_counts = collections.Counter(top_of(path) for path in sources)
+    mkdirs = {action.path for action in plan.actions if action.kind == "mkdir"}
+    folder_actions = {
+        action.path: action
+        for action in plan.actions
+        if action.kind in ("trash", "rmdir") and action.path in removed_folders
+    }
+    moved = {move.source for move in moves}
+    for action in plan.actions:
+        if action.kind in ("trash", "delete") and action.path in moved and action.path not in removed_folders:
+            replaced.add(id(action))
+
+    for folder, group in moved_from.items():
+        if folder is None:
+            continue
+        folder_action = folder_actions[folder]
+        folder_action.size -= sum(move.size for move in group)
+        if len(group) != source_counts[folder]:
+            continue
+        rel = os.path.relpath(group[0].source, folder)
+        if not group[0].path.endswith(os.sep + rel):
+            continue
+        new_folder = group[0].path[: -len(rel) - 1]
+        if new_folder not in mkdirs:
+            continue
+        if any(os.path.relpath(move.path, new_folder) != os.path.relpath(move.source, folder) for move in group):
+            continue
+        new_dirs = {d for d in mkdirs if is_below(d, new_folder)}
+        relative = {os.path.relpath(d, new_folder) for d in new_dirs}
+        if relative != {os.path.relpath(d, folder) for d in removed_folders[folder]}:
+            continue
+        members = {id(move) for move in group}
+        others = [action for action in plan.actions if id(action) not in replaced and action.kind != "mkdir"]
+        others += [move for move in moves if id(move) not in members]
+        if any(is_below(action.path, new_folder) for action in others):
+            continue
+        # Everything below the new folder is the old one, moved as a whole
+        moves = [move for move in moves if id(move) not in members]
+        moves.append(
+            PlanAction(
+                "move",
+                new_folder,
+                sum(move.size for move in group),
+                os.path.dirname(new_folder),
+                folder_action.remote,
+                folder,
+            )
+        )
+        replaced.update(id(action) for action in plan.actions if action.kind == "mkdir" and action.path in new_dirs)
+        replaced.add(id(folder_action))
+
+    plan.actions = [action for action in plan.actions if id(action) not in replaced] + moves
+
+
+def plan_copies(plan: SyncPlan, targets: Dict[str, str], remote: Dict[Tuple[int, str], Tuple[str, Dict]]) -> None:
+    """
+    Turns uploads of content that is already on Google Drive, or uploaded by another action, into copies.
+
+    Uploads are grouped by size and md5. A group whose content is in the destination already is copied from
+    that file. Otherwise the first file of the group is uploaded, and the others are copied from it server-side.
+
+    Args:
+        plan (SyncPlan): The plan, with its uploads already added.
+        targets (dict): Maps the paths of planned uploads to the md5 of their content.
+        remote (dict): Maps the (size, md5) of the files that stay unchanged on Google Drive to their relative
+            path and file.
+    """
+    originals = {}
+    for action in plan.actions:
+        # Empty files cost a call either way
+        if action.kind != "upload" or not action.size or action.path not in targets:
+            continue
+        key = action.size, targets[action.path]
+        if key in remote:
+            action.kind, action.source, action.remote = "copy", *remote[key]
+        elif key in originals:
+            action.kind, action.source = "copy", originals[key]
+        else:
+            originals[key] = action.path
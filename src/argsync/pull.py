@@ -1,15 +1,28 @@
-import hashlib
+import collections
+import contextlib
+import functools
 import os
 import pathlib
 import shutil
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Iterable, List, Tuple
+import tempfile
+from typing import Dict, List, Optional, Tuple
 
 import click
-import tqdm
 from pydrive2.drive import GoogleDrive, GoogleDriveFile
 
-from argsync.gdrive import load_authorized_gdrive
+from argsync.aio import AsyncEngine
+from argsync.archive import CHUNK_SUFFIX, Archive, Entry, plan_archive_pull, unpack_chunk
+from argsync.changes import InvalidPageToken, PullIndex, get_start_page_token, list_changes
+from argsync.gdrive import ensure_pool, load_authorized_gdrive
+from argsync.hashing import HashEngine
+from argsync.metrics import RunMetrics, instrument, metrics_for
+from argsync.pipeline import TransferPipeline
+from argsync.plan import SyncPlan, index_by_title, index_local, is_below, plan_moves
+from argsync.ranged import CONNECTIONS, PART_SUFFIX, RANGED_THRESHOLD, RangedDownloader, is_partial
+from argsync.resolve import resolve_folder
+from argsync.state import FileStateCache, FolderIdCache
+from argsync.throttle import MAX_WORKERS, AdaptiveLimiter, attach_limiter, call_with_retries
+from argsync.tree import FOLDER_MIME_TYPE, RemoteTree, list_tree
 
 GOOGLE_MIME_TYPES = {
     "application/vnd.google-apps.document": [
@@ -27,138 +40,145 @@ GOOGLE_MIME_TYPES = {
 }
 
 
-def list_folders(parents_id: str, drive: GoogleDrive) -> List[GoogleDriveFile]:
+def get_target_folder_id(
+    src_full_path: str, drive: GoogleDrive, cache: Optional[FolderIdCache] = None
+) -> Optional[str]:
     """
-    Lists all folders in the specified Google Drive directory.
-
-    Args:
-        parents_id (str): The ID of the parent directory in Google Drive.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
-
-    Returns:
-        list: A list of Google Drive file objects representing folders.
-    """
-    return drive.ListFile(
-        {"q": f"'{parents_id}' in parents and trashed=false and mimeType='application/vnd.google-apps.folder'"}
-    ).GetList()
-
-
-def list_files(parents_id: str, drive: GoogleDrive) -> List[GoogleDriveFile]:
-    """
-    Lists all files in the specified Google Drive directory excluding folders.
+    Retrieves the Google Drive folder ID based on the given path.
 
     Args:
-        parents_id (str): The ID of the parent directory in Google Drive.
+        src_full_path (str): The full path in Google Drive, formatted as 'gdrive:path/to/folder'.
         drive (GoogleDrive): An instance of the GoogleDrive class.
+        cache (FolderIdCache): The folder ID cache, None to list every level.
 
     Returns:
-        list: A list of Google Drive file objects representing files.
+        str or None: The folder ID if found, otherwise None.
     """
-    return drive.ListFile(
-        {"q": f"'{parents_id}' in parents and trashed=false and mimeType!='application/vnd.google-apps.folder'"}
-    ).GetList()
+    return resolve_folder(src_full_path, drive, cache)
 
 
-def get_target_folder_id(src_full_path: str, drive: GoogleDrive) -> str:
+def local_file_name(drive_file: GoogleDriveFile) -> str:
     """
-    Retrieves the Google Drive folder ID based on the given path.
+    Returns the name a Google Drive file gets locally. Google Docs, Sheets and Slides are exported
+    to Office formats and get the matching extension.
 
     Args:
-        src_full_path (str): The full path in Google Drive, formatted as 'gdrive:path/to/folder'.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
+        drive_file (GoogleDriveFile): The file information from Google Drive.
 
     Returns:
-        str or None: The folder ID if found, otherwise None.
+        str: The local file name.
     """
-    if src_full_path == "gdrive:":
-        return "root"
-
-    src_folder_list = src_full_path.split(":")[1].rstrip("/").split("/")
-    src_parents_id = []
-    for src in src_folder_list:
-        if not src_parents_id:
-            items = list_folders("root", drive)
-            if src in [item["title"] for item in items]:
-                new_folder_id = [item["id"] for item in items if item["title"] == src][0]
-            else:
-                return None
-        else:
-            items = list_folders(src_parents_id[-1], drive)
-            if src in [item["title"] for item in items]:
-                new_folder_id = [item["id"] for item in items if item["title"] == src][0]
-            else:
-                return None
-        src_parents_id.append(new_folder_id)
-    return src_parents_id[-1]
+    file_name = drive_file["title"]
+    if drive_file["mimeType"] in GOOGLE_MIME_TYPES.keys():
+        extension = GOOGLE_MIME_TYPES[drive_file["mimeType"]][1]
+        if not file_name.endswith(extension):
+            file_name += extension
+    return file_name
 
 
-def file_download(args: Tuple[str, GoogleDriveFile, GoogleDrive]) -> None:
+def file_download(
+    args: Tuple[str, GoogleDriveFile, GoogleDrive], downloader: Optional[RangedDownloader] = None
+) -> Tuple[str, str]:
     """
     Downloads a file from Google Drive and handles different types based on their MIME type.
 
+    Binary files of at least downloader.threshold bytes are fetched as parallel ranged segments. Everything
+    else is streamed in one request. Either way the file is written next to its target first and renamed
+    into place once complete, so an interrupted pull never leaves a truncated file behind.
+
     Args:
         args (tuple): A tuple containing the path where the file will be saved, the file information, and the Google Drive service instance.
+        downloader (RangedDownloader): The downloader for large files. None streams every file in one request.
+
+    Returns:
+        tuple: The path of the downloaded file and its md5 on Google Drive (None for exported Google files).
     """
     file_dir, drive_file, drive = args
     file_id = drive_file["id"]
-    file_name = drive_file["title"]
+    file_name = local_file_name(drive_file)
+    file_path = os.path.join(file_dir, file_name)
+
+    if (
+        downloader is not None
+        and drive_file["mimeType"] not in GOOGLE_MIME_TYPES.keys()
+        and "md5Checksum" in drive_file
+        and int(drive_file.get("fileSize", 0)) >= downloader.threshold
+    ):
+        downloader.download(drive_file, file_path, drive)
+        return file_path, drive_file["md5Checksum"]
 
     file = drive.CreateFile({"id": file_id})
 
     if drive_file["mimeType"] in GOOGLE_MIME_TYPES.keys():
-        if file_name.endswith(GOOGLE_MIME_TYPES[drive_file["mimeType"]][1]):
-            file_name = drive_file["title"]
-        else:
-            file_name = "{}{}".format(drive_file["title"], GOOGLE_MIME_TYPES[drive_file["mimeType"]][1])
-            file["title"] = file_name
+        file["title"] = file_name
         file["mimeType"] = GOOGLE_MIME_TYPES[drive_file["mimeType"]][0]
 
-    file.GetContentFile(os.path.join(file_dir, file_name))
+    part_path = file_path + PART_SUFFIX
+    try:
+        call_with_retries(lambda: file.GetContentFile(part_path), drive, "files.get_media")
+    except BaseException:
+        # Streamed downloads cannot be resumed, unlike ranged ones
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, file_path)
+    return file_path, drive_file.get("md5Checksum")
 
 
-def progress_bar_with_threading_executor(
-    fn: Callable, iterable: Iterable[Tuple], desc: str, num_of_downloader: int
-) -> None:
+async def file_download_async(args: Tuple[str, GoogleDriveFile, GoogleDrive], engine: AsyncEngine) -> Tuple[str, str]:
     """
-    Executes a function over an iterable with a progress bar, using multiple threads.
+    The async transport counterpart of file_download, run on the engine's event loop. Every file is streamed
+    in one request.
 
     Args:
-        fn (function): The function to apply to each item in the iterable.
-        iterable (iterable): An iterable where each item will be processed by the function.
-        desc (str): Description text for the progress bar.
-    """
-    disable_pbar = len(iterable) == 0
+        args (tuple): A tuple containing the path where the file will be saved, the file information, and the Google Drive service instance.
+        engine (AsyncEngine): The engine of the run.
 
-    with tqdm.tqdm(total=len(iterable), desc=desc, disable=disable_pbar) as progress:
-        with ThreadPoolExecutor(max_workers=num_of_downloader) as executor:
-            for _ in executor.map(fn, iterable):
-                progress.update()
+    Returns:
+        tuple: The path of the downloaded file and its md5 on Google Drive (None for exported Google files).
+    """
+    file_dir, drive_file, _ = args
+    file_path = os.path.join(file_dir, local_file_name(drive_file))
+    export_mime_type = GOOGLE_MIME_TYPES.get(drive_file["mimeType"], [None])[0]
+    await engine.client.download(drive_file, file_path, export_mime_type)
+    return file_path, drive_file.get("md5Checksum")
 
 
-def get_tree(folder_name: str, tree_list: List[str], root: str, parents_id: str, drive: GoogleDrive) -> None:
+def record_download(state: FileStateCache, result: Tuple[str, str]) -> None:
     """
-    Recursively builds a list of all folder paths under a specified Google Drive folder.
+    Stores the state of a downloaded file so it is not re-hashed on the next pull.
 
     Args:
-        folder_name (str): The name of the starting folder.
-        tree_list (list): Accumulator for storing folder paths.
-        root (str): Current path prefix.
-        parents_id (dict): A dictionary mapping folder names to their Google Drive IDs.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
+        state (FileStateCache): The local file-state cache.
+        result (tuple): The result of file_download.
+    """
+    file_path, md5 = result
+    state.record(file_path, md5)
 
-    Returns:
-        None. It will modify tree_list that was passed in.
+
+def submit_download(
+    pipeline: TransferPipeline,
+    task: Tuple[str, GoogleDriveFile, GoogleDrive],
+    state: FileStateCache,
+    downloader: Optional[RangedDownloader] = None,
+    engine: Optional[AsyncEngine] = None,
+) -> None:
     """
-    folder_id = parents_id[root + folder_name]
-    items = list_folders(folder_id, drive)
-    root += folder_name + os.path.sep
+    Queues a download on the pipeline and records the file state once it succeeded.
 
-    for item in items:
-        parents_id[root + item["title"]] = item["id"]
-        tree_list.append(root + item["title"])
-        folder_id = [i["id"] for i in items if i["title"] == item["title"]][0]
-        folder_name = item["title"]
-        get_tree(folder_name, tree_list, root, parents_id, drive)
+    Args:
+        pipeline (TransferPipeline): The pipeline running the downloads.
+        task (tuple): The download task for file_download.
+        state (FileStateCache): The local file-state cache.
+        downloader (RangedDownloader): The downloader for large files.
+        engine (AsyncEngine): Download through the async transport instead, on the pipeline of the engine.
+    """
+    size = int(task[1].get("fileSize", 0))
+    if engine is not None:
+        download = functools.partial(file_download_async, engine=engine)
+    else:
+        download = functools.partial(file_download, downloader=downloader)
+    pipeline.submit(download, task, size, functools.partial(record_download, state))
 
 
 def by_lines(input_str: str) -> int:
@@ -174,119 +194,573 @@ def by_lines(input_str: str) -> int:
     return input_str.count(os.path.sep)
 
 
-def pull(src_full_path: str, dest_dir: str, num_of_downloader: int) -> None:
+def plan_pull(
+    folder_name: str,
+    tree: RemoteTree,
+    dest_dir: str,
+    drive: GoogleDrive,
+    state: FileStateCache,
+    hasher: HashEngine,
+    plan: SyncPlan,
+    archived: Tuple[str] = (),
+) -> None:
     """
-    Synchronizes a local directory with the contents of a Google Drive directory.
+    Works out what a pull has to do to bring the local folder in line with its counterpart on Google Drive.
+
+    Both sides are indexed once, then every folder is compared through dict lookups. Remote files are matched
+    by their local name, so exported Google Docs match their .docx copy. Files present on both sides are hashed
+    in parallel across all folders, and only those whose md5 differs are planned as updates. Local files about
+    to be removed that hold the content of a new remote file are renamed into place instead of downloaded again.
 
     Args:
-        src_full_path (str): The Google Drive path to synchronize, formatted as 'gdrive:path/to/directory'.
-        dest_dir (str): The local directory path where files will be synchronized to.
+        folder_name (str): The name of the folder being pulled.
+        tree (RemoteTree): The index of the pulled Google Drive folder.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        state (FileStateCache): The local file-state cache.
+        hasher (HashEngine): The engine used to hash local files.
+        plan (SyncPlan): The plan the actions are added to.
+        archived (list): Local folders unpacked from archives by plan_archive_pull, left alone here.
+    """
+    metrics = metrics_for(drive)
+    dest_full_path = os.path.join(dest_dir, folder_name)
+    local = index_local(dest_full_path) if os.path.isdir(dest_full_path) else {}
+    local = {d: files for d, files in local.items() if not any(is_below(d, path) for path in archived)}
+    candidates = {}
+
+    for folder_dir, drive_files in tree.files.items():
+        # Unfinished downloads are kept so the next pull can resume them
+        local_files = {name: size for name, size in local.get(folder_dir, {}).items() if not is_partial(name)}
+        if folder_dir not in local:
+            plan.add("mkdir", folder_dir)
+        remote, duplicates = index_by_title(drive_files, key=local_file_name)
+        for drive_file in duplicates:
+            plan.note(
+                f"{os.path.join(folder_dir, drive_file['title'])} is on gdrive more than once, only the newest is pulled."
+            )
+        for name, drive_file in remote.items():
+            path = os.path.join(folder_dir, name)
+            if name in local_files:
+                candidates[os.path.join(dest_dir, path)] = (path, folder_dir, drive_file)
+            else:
+                plan.add("download", path, int(drive_file.get("fileSize", 0)), parent=folder_dir, remote=drive_file)
+        for name, size in local_files.items():
+            if name not in remote:
+                plan.add("delete", os.path.join(folder_dir, name), size)
+
+    # Removing a folder removes its content, so only the topmost removed folders need an action
+    removed = set(local).difference(tree.files)
+    sizes = {}
+    vanished = {action.path: action.size for action in plan.of_kind("delete")}
+    removed_folders = collections.defaultdict(list)
+    for folder_dir in removed:
+        ancestors = [str(p) for p in reversed(pathlib.Path(folder_dir).parents)]
+        top = next((p for p in ancestors if p in removed), folder_dir)
+        sizes[top] = sizes.get(top, 0) + sum(local[folder_dir].values())
+        removed_folders[top].append(folder_dir)
+        for name, size in local[folder_dir].items():
+            if not is_partial(name):
+                vanished[os.path.join(folder_dir, name)] = size
+    for folder_dir, size in sizes.items():
+        plan.add("rmdir", folder_dir, size)
+    for folder_dir in tree.duplicate_folders:
+        plan.note(f"{folder_dir} is on gdrive more than once, their content is pulled into one folder.")
+
+    for file_dir, os_file_md5 in metrics.timed("hashing", state.md5_many(candidates, hasher)):
+        path, folder_dir, drive_file = candidates[file_dir]
+        if drive_file.get("md5Checksum") != os_file_md5:
+            size = int(drive_file.get("fileSize", 0))
+            plan.add("update", path, size, parent=folder_dir, remote=drive_file)
+        else:
+            metrics.count_files("unchanged")
+
+    # Only local files the size of a new remote file can be moves, the others are not hashed
+    targets = {a.path: a.remote["md5Checksum"] for a in plan.of_kind("download") if a.remote.get("md5Checksum")}
+    target_sizes = {action.size for action in plan.of_kind("download") if action.path in targets}
+    files = {os.path.join(dest_dir, path): path for path, size in vanished.items() if size in target_sizes}
+    sources = {
+        files[f]: (vanished[files[f]], md5, None) for f, md5 in metrics.timed("hashing", state.md5_many(files, hasher))
+    }
+    plan_moves(plan, targets, sources, removed_folders)
+
+
+def execute_pull_plan(
+    plan: SyncPlan,
+    dest_dir: str,
+    drive: GoogleDrive,
+    pipeline: TransferPipeline,
+    state: FileStateCache,
+    downloader: Optional[RangedDownloader] = None,
+    engine: Optional[AsyncEngine] = None,
+) -> None:
+    """
+    Carries out a pull plan. Stale files stay in place until their new content replaces them. Moves are local
+    renames, done before the folders they come from are removed.
 
-    Raises:
-        click.BadParameter: If the specified paths are not valid or not found.
+    Args:
+        plan (SyncPlan): The plan made by plan_pull.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        pipeline (TransferPipeline): The pipeline running the downloads.
+        state (FileStateCache): The local file-state cache.
+        downloader (RangedDownloader): The downloader for large files.
+        engine (AsyncEngine): Download through the async transport instead.
     """
-    drive = load_authorized_gdrive()
+    metrics = metrics_for(drive)
+    for action in sorted(plan.of_kind("mkdir"), key=lambda action: by_lines(action.path)):
+        folder = os.path.join(dest_dir, action.path)
+        os.makedirs(folder, exist_ok=True)
+        pipeline.write(f"Created new folder {folder}")
+
+    moves = plan.of_kind("move")
+    for action in moves:
+        old_path, new_path = os.path.join(dest_dir, action.source), os.path.join(dest_dir, action.path)
+        os.rename(old_path, new_path)
+        state.move(old_path, new_path)
+        if action.remote is None:
+            pipeline.write(f"Moved folder {old_path} to {new_path}")
+    metrics.count_files("moved", len(moves))
+
+    for action in plan.of_kind("download") + plan.of_kind("update"):
+        submit_download(
+            pipeline, (os.path.join(dest_dir, action.parent), action.remote, drive), state, downloader, engine
+        )
 
-    # Get id of Google Drive folder and it's path (from other script)
-    # folder_id, full_path = initial_upload.check_upload(service)
-    print("Pull started.")
-    if num_of_downloader != 5:
-        print(f"Number of downloaders: {num_of_downloader}")
-    folder_id = get_target_folder_id(src_full_path, drive)
-    if folder_id is None:
-        raise click.BadParameter(f"{src_full_path} cannot be found.")
-    folder_name = src_full_path.split(":")[1].rstrip("/").split("/")[-1]
-    if not os.path.exists(os.path.join(dest_dir, folder_name)):
-        os.mkdir(os.path.join(dest_dir, folder_name))
-    tree_list, root, parents_id = [], "", {}
+    deleted = plan.of_kind("delete")
+    for action in deleted:
+        file_dir = os.path.join(dest_dir, action.path)
+        os.remove(file_dir)
+        state.forget(file_dir)
+    metrics.count_files("removed", len(deleted))
 
-    print("Comparing gdrive to local stroage...")
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, drive)
-    local_tree_list = []
-    dest_full_path = os.path.join(dest_dir, folder_name)
-    root_len = len(dest_full_path.split(os.path.sep)[0:-2])
-
-    # Get list of folders three paths on computer
-    for root, dirs, files in os.walk(dest_full_path, topdown=True):
-        for name in dirs:
-            var_path = (os.path.sep).join(root.split(os.path.sep)[root_len + 1 :])
-            local_tree_list.append(os.path.join(var_path, name))
-
-    # old folders on computer
-    download_folders = list(set(tree_list).difference(set(local_tree_list)))
-    # new folders on computer, which you dont have(i suppose heh)
-    remove_folders = list(set(local_tree_list).difference(set(tree_list)))
-    # foldes that match
-    exact_folders = list(set(local_tree_list).intersection(set(tree_list)))
-
-    exact_folders.append(folder_name)
-
-    parent_folder = pathlib.Path(dest_full_path).parent.resolve()
-
-    # Download folders from Drive
-    download_folders = sorted(download_folders, key=by_lines)
-
-    for folder_dir in download_folders:
-
-        folder = os.path.join(parent_folder, folder_dir)
-        os.makedirs(folder)
-        print(f"Created new folder {folder}")
-        last_dir = pathlib.Path(folder_dir)
-        folder_id = parents_id[str(last_dir)]
-        files = list_files(folder_id, drive)
-
-        download_tasks = []
-        for drive_file in files:
-            download_tasks.append((folder, drive_file, drive))
-        progress_bar_with_threading_executor(
-            file_download, download_tasks, f"Downloading files to {folder}", num_of_downloader
-        )
+    for action in plan.of_kind("rmdir"):
+        folder = os.path.join(dest_dir, action.path)
+        shutil.rmtree(folder)
+        pipeline.write(f"Deleted folder {folder}")
 
-    # Check and refresh files in existing folders
-    for folder_dir in exact_folders:
 
-        folder = os.path.join(parent_folder, folder_dir)
-        last_dir = pathlib.Path(folder_dir)
-        folder_id = parents_id[str(last_dir)]
-        local_files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
+def unpack_download(args: Tuple[str, GoogleDriveFile, List[Entry], GoogleDrive], state: FileStateCache) -> int:
+    """
+    Downloads an archive chunk into a temporary file and unpacks it into the local archived folder.
 
-        items = list_files(folder_id, drive)
+    Args:
+        args (tuple): Contains the local archived folder, the chunk on Google Drive, the entries of the chunk,
+            and the Google Drive instance.
+        state (FileStateCache): The local file-state cache, given the md5 of every unpacked file.
 
-        download_files = [f for f in items if f["title"] not in local_files]
-        update_files = [f for f in items if f["title"] in local_files]
-        remove_files = [f for f in local_files if f not in [i["title"] for i in items]]
+    Returns:
+        int: The number of files unpacked.
+    """
+    folder_path, drive_file, entries, drive = args
+    fd, chunk_path = tempfile.mkstemp(suffix=CHUNK_SUFFIX)
+    os.close(fd)
+    try:
+        file = drive.CreateFile({"id": drive_file["id"]})
+        call_with_retries(lambda: file.GetContentFile(chunk_path), drive, "files.get_media")
+        return unpack_chunk(chunk_path, folder_path, entries, state)
+    finally:
+        os.remove(chunk_path)
+
+
+def execute_archive_pull(
+    plan: SyncPlan,
+    archives: List[Archive],
+    dest_dir: str,
+    drive: GoogleDrive,
+    pipeline: TransferPipeline,
+    state: FileStateCache,
+) -> None:
+    """
+    Downloads and unpacks the chunks of a pull plan, after execute_pull_plan created their folders.
 
-        download_tasks = []
-        for drive_file in download_files:
-            download_tasks.append((folder, drive_file, drive))
-        progress_bar_with_threading_executor(
-            file_download, download_tasks, f"Downloading files to {folder}", num_of_downloader
+    Args:
+        plan (SyncPlan): The plan made by plan_archive_pull and plan_pull.
+        archives (list): The archives returned by plan_archive_pull.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        pipeline (TransferPipeline): The pipeline running the downloads.
+        state (FileStateCache): The local file-state cache.
+    """
+    metrics = metrics_for(drive)
+    by_path = {archive.path: archive for archive in archives}
+    for action in plan.of_kind("unpack"):
+        entries = by_path[action.path].chunks[os.path.basename(action.source)]
+        task = (os.path.join(dest_dir, action.path), action.remote, entries, drive)
+        pipeline.submit(
+            functools.partial(unpack_download, state=state),
+            task,
+            action.size,
+            functools.partial(metrics.count_files, "unpacked"),
         )
 
-        update_tasks = []
-        for drive_file in update_files:
 
-            file_dir = os.path.join(folder, drive_file["title"])
-            drive_md5 = drive_file["md5Checksum"]
-            os_file_md5 = hashlib.md5(open(file_dir, "rb").read()).hexdigest()
+def index_tree(index: PullIndex, tree: RemoteTree, folder_name: str, token: str) -> None:
+    """
+    Resets the incremental-pull index to the result of a full pull.
 
-            if drive_md5 != os_file_md5:
-                os.remove(os.path.join(folder, drive_file["title"]))
-                update_tasks.append((folder, drive_file, drive))
-        progress_bar_with_threading_executor(
-            file_download, update_tasks, f"Downloading files to {folder}", num_of_downloader
-        )
+    Args:
+        index (PullIndex): The index of the incremental pull.
+        tree (RemoteTree): The index of the pulled Google Drive folder.
+        folder_name (str): The name of the pulled folder.
+        token (str): The changes page token taken before the full pull started.
+    """
+    index.token = token
+    index.folder_id = tree.parents_id[folder_name]
+    index.folders = {folder_id: path for path, folder_id in tree.parents_id.items()}
+    index.files = {
+        drive_file["id"]: os.path.join(path, local_file_name(drive_file))
+        for path, drive_files in tree.files.items()
+        for drive_file in drive_files
+    }
 
-        for local_file in tqdm.tqdm(
-            remove_files, disable=(len(remove_files) == 0), desc=f"Removing files from {folder}"
-        ):
-            os.remove(os.path.join(folder, local_file))
 
-    # Delete old and unwanted folders from computer
-    remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
+def local_parent_path(item: Dict, index: PullIndex) -> Optional[str]:
+    """
+    Returns the local path of the first parent of a Google Drive item that belongs to the pulled tree.
 
-    for folder_dir in tqdm.tqdm(remove_folders, disable=(len(remove_folders) == 0), desc=f"Deleting unwanted folders"):
-        folder = os.path.join(parent_folder, folder_dir)
-        shutil.rmtree(folder)
+    Args:
+        item (dict): The file resource from Google Drive.
+        index (PullIndex): The index of the incremental pull.
+
+    Returns:
+        str or None: The parent path relative to the destination directory, or None if the item is outside the tree.
+    """
+    return next((index.folders[p["id"]] for p in item.get("parents", []) if p["id"] in index.folders), None)
+
+
+def remove_local(item_id: str, index: PullIndex, dest_dir: str, state: FileStateCache) -> None:
+    """
+    Removes the local copy of a Google Drive folder or file that was deleted, trashed or moved away.
+
+    Args:
+        item_id (str): The ID of the folder or file on Google Drive.
+        index (PullIndex): The index of the incremental pull.
+        dest_dir (str): The local directory containing the pulled folder.
+        state (FileStateCache): The local file-state cache.
+    """
+    if item_id in index.folders:
+        path = index.folders[item_id]
+        shutil.rmtree(os.path.join(dest_dir, path), ignore_errors=True)
+        index.drop(path)
+    elif item_id in index.files:
+        file_dir = os.path.join(dest_dir, index.files.pop(item_id))
+        if os.path.exists(file_dir):
+            os.remove(file_dir)
+            state.forget(file_dir)
+
+
+def list_new_folder(
+    path: str, folder_id: str, dest_dir: str, drive: GoogleDrive, index: PullIndex, engine: Optional[AsyncEngine] = None
+) -> List[GoogleDriveFile]:
+    """
+    Creates the local subfolders of a folder that entered the pulled tree, e.g. moved in from outside of it or
+    restored from the trash. The changes feed only lists the folder itself, not what it already holds.
+
+    Args:
+        path (str): The local path of the folder, relative to the destination directory.
+        folder_id (str): The ID of the folder on Google Drive.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        index (PullIndex): The index of the incremental pull. The subfolders are added to it.
+        engine (AsyncEngine): List through the async transport instead.
+
+    Returns:
+        list: The files anywhere below the folder, still to be pulled.
+    """
+    with metrics_for(drive).phase("listing"):
+        if engine is not None:
+            tree = engine.list_tree(path, folder_id)
+        else:
+            tree = list_tree(path, folder_id, drive)
+    for subfolder in tree.tree_list:
+        os.makedirs(os.path.join(dest_dir, subfolder), exist_ok=True)
+        index.folders[tree.parents_id[subfolder]] = subfolder
+    return [drive_file for drive_files in tree.files.values() for drive_file in drive_files]
+
+
+def pull_changes(
+    index: PullIndex,
+    dest_dir: str,
+    drive: GoogleDrive,
+    pipeline: TransferPipeline,
+    state: FileStateCache,
+    downloader: Optional[RangedDownloader] = None,
+    engine: Optional[AsyncEngine] = None,
+) -> bool:
+    """
+    Applies the changes since the stored page token to the local folder.
+
+    Args:
+        index (PullIndex): The index of the incremental pull. Updated in place, including its token.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        pipeline (TransferPipeline): The pipeline running the downloads.
+        state (FileStateCache): The local file-state cache.
+        downloader (RangedDownloader): The downloader for large files.
+        engine (AsyncEngine): Download through the async transport instead.
+
+    Returns:
+        bool: False if the changes cannot be applied incrementally and a full scan is needed.
+
+    Raises:
+        InvalidPageToken: If the stored token is no longer accepted.
+    """
+    metrics = metrics_for(drive)
+    with metrics.phase("changes"):
+        changes, new_token = list_changes(index.token, drive)
+    removed, folders, files = [], [], {}
+    for change in changes:
+        drive_file = change.get("file")
+        gone = change.get("deleted") or drive_file is None or drive_file["labels"]["trashed"]
+        if change["fileId"] == index.folder_id:
+            if gone:
+                return False
+        elif gone:
+            removed.append(change["fileId"])
+        elif drive_file["mimeType"] == FOLDER_MIME_TYPE:
+            folders.append(drive_file)
+        else:
+            files[drive_file["id"]] = drive_file
+
+    for item_id in removed:
+        remove_local(item_id, index, dest_dir, state)
+
+    # A folder can show up before its parent does, so keep placing folders until no more can be resolved.
+    # Whatever is left has no parent in the pulled tree, i.e. it was moved out of it or never belonged to it.
+    pending = folders
+    while pending:
+        unresolved = []
+        for folder in pending:
+            parent = local_parent_path(folder, index)
+            if parent is None:
+                unresolved.append(folder)
+                continue
+            path = os.path.join(parent, folder["title"])
+            old_path = index.folders.get(folder["id"])
+            if old_path is None:
+                os.makedirs(os.path.join(dest_dir, path), exist_ok=True)
+                pipeline.write(f"Created new folder {os.path.join(dest_dir, path)}")
+                index.folders[folder["id"]] = path
+                for drive_file in list_new_folder(path, folder["id"], dest_dir, drive, index, engine):
+                    files.setdefault(drive_file["id"], drive_file)
+            elif old_path != path:
+                os.rename(os.path.join(dest_dir, old_path), os.path.join(dest_dir, path))
+                pipeline.write(f"Moved folder {os.path.join(dest_dir, old_path)} to {os.path.join(dest_dir, path)}")
+                index.rebase(old_path, path)
+        if len(unresolved) == len(pending):
+            break
+        pending = unresolved
+    for folder in pending:
+        remove_local(folder["id"], index, dest_dir, state)
+
+    for drive_file in files.values():
+        parent = local_parent_path(drive_file, index)
+        if parent is None:
+            remove_local(drive_file["id"], index, dest_dir, state)
+            continue
+        path = os.path.join(parent, local_file_name(drive_file))
+        file_dir = os.path.join(dest_dir, path)
+        old_path = index.files.get(drive_file["id"])
+        if old_path is not None and old_path != path and os.path.exists(os.path.join(dest_dir, old_path)):
+            os.rename(os.path.join(dest_dir, old_path), file_dir)
+        index.files[drive_file["id"]] = path
+        drive_md5 = drive_file.get("md5Checksum")
+        with metrics.phase("hashing"):
+            unchanged = drive_md5 is not None and os.path.exists(file_dir) and state.md5(file_dir) == drive_md5
+        if unchanged:
+            metrics.count_files("unchanged")
+        else:
+            submit_download(pipeline, (os.path.dirname(file_dir), drive_file, drive), state, downloader, engine)
+
+    index.token = new_token
+    return True
+
+
+def scan_and_plan(
+    folder_name: str,
+    folder_id: str,
+    dest_dir: str,
+    drive: GoogleDrive,
+    num_of_downloader: int,
+    state: FileStateCache,
+    plan: SyncPlan,
+    engine: Optional[AsyncEngine] = None,
+    archive: bool = False,
+    hasher: Optional[HashEngine] = None,
+) -> Tuple[RemoteTree, List[Archive]]:
+    """
+    Lists the whole Google Drive folder and plans a full pull of it.
+
+    Args:
+        folder_name (str): The name of the folder being pulled.
+        folder_id (str): The ID of the folder on Google Drive.
+        dest_dir (str): The local directory containing the pulled folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        num_of_downloader (int): Number of concurrent requests while listing gdrive.
+        state (FileStateCache): The local file-state cache.
+        plan (SyncPlan): The plan the actions are added to.
+        engine (AsyncEngine): List through the async transport instead.
+        archive (bool): Unpack the archive folders made by push in archive mode instead of pulling them as is.
+        hasher (HashEngine): The engine hashing local files. Started for the comparison when None.
+
+    Returns:
+        tuple: The index of the pulled Google Drive folder, and its archives.
+    """
+    print("Comparing gdrive to local stroage...")
+    with metrics_for(drive).phase("listing"):
+        if engine is not None:
+            tree = engine.list_tree(folder_name, folder_id)
+        else:
+            tree = list_tree(folder_name, folder_id, drive, num_of_downloader)
+    with HashEngine() if hasher is None else contextlib.nullcontext(hasher) as hashing:
+        archives = plan_archive_pull(tree, dest_dir, drive, state, hashing, plan) if archive else []
+        plan_pull(folder_name, tree, dest_dir, drive, state, hashing, plan, tuple(a.path for a in archives))
+    return tree, archives
+
+
+def pull(
+    src_full_path: str,
+    dest_dir: str,
+    num_of_downloader: int,
+    incremental: bool = False,
+    ranged_threshold: int = RANGED_THRESHOLD,
+    connections: int = CONNECTIONS,
+    drive: Optional[GoogleDrive] = None,
+    metrics: Optional[RunMetrics] = None,
+    adaptive: bool = False,
+    max_workers: int = MAX_WORKERS,
+    dry_run: bool = False,
+    plan_json: Optional[str] = None,
+    transport: str = "threads",
+    state: Optional[FileStateCache] = None,
+    folder_ids: Optional[FolderIdCache] = None,
+    archive: bool = False,
+    hasher: Optional[HashEngine] = None,
+) -> SyncPlan:
+    """
+    Synchronizes a local directory with the contents of a Google Drive directory.
+
+    Args:
+        src_full_path (str): The Google Drive path to synchronize, formatted as 'gdrive:path/to/directory'.
+        dest_dir (str): The local directory path where files will be synchronized to.
+        incremental (bool): Apply only the changes since the previous incremental pull. The first pull, and any
+            pull whose stored token has become invalid, falls back to a full scan.
+        ranged_threshold (int): Files of at least this many bytes are downloaded as parallel ranged segments.
+        connections (int): Number of concurrent ranged requests per large file.
+        drive (GoogleDrive): The Google Drive to use, e.g. the FakeDrive of the benchmarks. Loads the saved credentials when None.
+        metrics (RunMetrics): Collects timings and call counts of the run.
+        adaptive (bool): Start at num_of_downloader concurrent calls and adapt to how Google Drive responds: more while
+            calls stay fast, fewer on rate limits and server errors.
+        max_workers (int): The most concurrent calls adaptive mode goes up to.
+        dry_run (bool): Print the plan of a full pull instead of carrying it out. Nothing is changed locally,
+            and the stored changes token of incremental pulls is left as it is.
+        plan_json (str): Also write the plan to this JSON file, "-" for standard output. Incremental pulls that
+            apply changes without a full scan write an empty plan.
+        transport (str): "threads" for one blocking call per worker thread, or "async" to list and download on
+            an event loop with num_of_downloader requests in flight. Needs aiohttp.
+        state (FileStateCache): The local file-state cache, shared by runs in one process. Loaded when None.
+        folder_ids (FolderIdCache): The folder ID cache, shared by runs in one process. Loaded when None.
+        archive (bool): Unpack the folders pushed in archive mode into the local folder, downloading only the
+            chunks holding files that differ. Needs a full scan, so it cannot be combined with incremental.
+        hasher (HashEngine): The engine hashing local files, shared by runs in one process. Started for the pull
+            when None.
+
+    Returns:
+        SyncPlan: The plan of the pull.
+
+    Raises:
+        click.BadParameter: If the specified paths are not valid or not found, or archive is combined with
+            incremental.
+    """
+    if archive and incremental:
+        raise click.BadParameter("Archive mode compares the whole folder and cannot be combined with incremental.")
+    if drive is None:
+        drive = load_authorized_gdrive()
+    if metrics is None:
+        metrics = RunMetrics("pull")
+    instrument(drive, metrics)
+    if state is None:
+        state = FileStateCache()
+    downloader = RangedDownloader(ranged_threshold, connections=connections)
+    engine = AsyncEngine(drive, num_of_downloader) if transport == "async" else None
+
+    # Get id of Google Drive folder and it's path (from other script)
+    # folder_id, full_path = initial_upload.check_upload(service)
+    print("Pull started." if not dry_run else "Dry run started, nothing will be changed.")
+    if engine is not None:
+        print(f"Async transport: up to {num_of_downloader} requests in flight.")
+    if adaptive:
+        print(f"Adaptive concurrency: starting at {num_of_downloader}, up to {max_workers}.")
+        attach_limiter(drive, AdaptiveLimiter(num_of_downloader, maximum=max_workers))
+        num_of_downloader = max(max_workers, num_of_downloader)
+    else:
+        attach_limiter(drive, None)
+        if num_of_downloader != 5 and engine is None:
+            print(f"Number of downloaders: {num_of_downloader}")
+    # Every downloader may fetch a large file over several connections
+    ensure_pool(drive, num_of_downloader * connections)
+    if folder_ids is None:
+        folder_ids = FolderIdCache()
+    with metrics.phase("resolve"):
+        folder_id = get_target_folder_id(src_full_path, drive, folder_ids)
+    if not dry_run:
+        folder_ids.save()
+    if folder_id is None:
+        raise click.BadParameter(f"{src_full_path} cannot be found.")
+    folder_name = src_full_path.split(":")[1].rstrip("/").split("/")[-1]
+    plan = SyncPlan("pull", src_full_path, os.path.join(dest_dir, folder_name))
+
+    with engine or contextlib.nullcontext():
+        if dry_run:
+            scan_and_plan(
+                folder_name, folder_id, dest_dir, drive, num_of_downloader, state, plan, engine, archive, hasher
+            )
+            print(plan.summary())
+            if plan_json:
+                plan.write_json(plan_json)
+            print("Dry run completed.")
+            return plan
+
+        if not os.path.exists(os.path.join(dest_dir, folder_name)):
+            os.mkdir(os.path.join(dest_dir, folder_name))
+
+        index = PullIndex(src_full_path, os.path.join(dest_dir, folder_name)) if incremental else None
+
+        def pipeline() -> TransferPipeline:
+            if engine is not None:
+                return engine.pipeline("Downloading", metrics)
+            return TransferPipeline(num_of_downloader, "Downloading", metrics=metrics)
+
+        try:
+            synced = False
+            if index is not None and index.token is not None and index.folder_id == folder_id:
+                print("Fetching changes from gdrive...")
+                try:
+                    with pipeline() as downloads:
+                        synced = pull_changes(index, dest_dir, drive, downloads, state, downloader, engine)
+                except InvalidPageToken:
+                    print("Stored changes token is no longer valid. Falling back to a full scan.")
+                if synced:
+                    plan.note("Changes were applied incrementally, without a full comparison.")
+                    if plan_json:
+                        plan.write_json(plan_json)
+            if not synced:
+                token = get_start_page_token(drive) if index is not None else None
+                tree, archives = scan_and_plan(
+                    folder_name, folder_id, dest_dir, drive, num_of_downloader, state, plan, engine, archive, hasher
+                )
+                if plan_json:
+                    plan.write_json(plan_json)
+                with pipeline() as downloads:
+                    execute_pull_plan(plan, dest_dir, drive, downloads, state, downloader, engine)
+                if archives:
+                    with TransferPipeline(num_of_downloader, "Unpacking", metrics=metrics) as unpacks:
+                        execute_archive_pull(plan, archives, dest_dir, drive, unpacks, state)
+                if index is not None:
+                    index_tree(index, tree, folder_name, token)
+            if index is not None:
+                index.save()
+        finally:
+            state.save()
     print("Pull completed.")
+    return plan
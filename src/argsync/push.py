@@ -1,52 +1,37 @@
-import hashlib
+import collections
+import contextlib
+import functools
 import mimetypes
 import os
 import pathlib
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Dict, List, Tuple
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
 
-import tqdm
 from pydrive2.drive import GoogleDrive, GoogleDriveFile
 
-from argsync.gdrive import load_authorized_gdrive
-
-
-def list_folders(parents_id: str, drive: GoogleDrive) -> List[GoogleDriveFile]:
-    """
-    Lists all folders in the specified Google Drive directory.
-
-    Args:
-        parents_id (str): The ID of the parent directory in Google Drive.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
-
-    Returns:
-        list: A list of Google Drive file objects representing folders.
-    """
-    return drive.ListFile(
-        {"q": f"'{parents_id}' in parents and trashed = false and mimeType = 'application/vnd.google-apps.folder'"}
-    ).GetList()
-
-
-def list_files(parents_id: str, drive: GoogleDrive) -> List[GoogleDriveFile]:
-    """
-    Lists all files in the specified Google Drive directory excluding folders.
-
-    Args:
-        parents_id (str): The ID of the parent directory in Google Drive.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
-
-    Returns:
-        list: A list of Google Drive file objects representing files.
-    """
-    return drive.ListFile(
-        {"q": f"'{parents_id}' in parents and trashed = false and mimeType != 'application/vnd.google-apps.folder'"}
-    ).GetList()
+from argsync.aio import AsyncEngine
+from argsync.archive import INDEX_NAME, Archive, Entry, encode_index, find_archived, pack_chunk, plan_archive_push
+from argsync.batch import BATCH_SIZE, copy_files, create_folders, find_child, trash_files, update_metadata
+from argsync.gdrive import ensure_pool, load_authorized_gdrive
+from argsync.hashing import HashEngine, file_md5
+from argsync.metrics import RunMetrics, instrument, metrics_for
+from argsync.pipeline import TransferPipeline
+from argsync.plan import PlanAction, SyncPlan, index_by_title, index_local, is_below, plan_copies, plan_moves
+from argsync.resolve import cache_key, resolve_folder
+from argsync.resumable import CHUNK_SIZE, RESUMABLE_THRESHOLD, ResumableUploader, UploadSessions
+from argsync.state import FileStateCache, FolderIdCache
+from argsync.throttle import MAX_WORKERS, AdaptiveLimiter, attach_limiter, call_with_retries
+from argsync.tree import FOLDER_MIME_TYPE, RemoteTree, list_tree
 
 
 def create_empty_folder(folder_name: str, parents_id: str, drive: GoogleDrive) -> str:
     """
     Creates a new folder in Google Drive under a specified parent directory.
 
+    When the creation fails in a way it may have succeeded, a folder of the same name in the parent is used
+    instead of creating a second one.
+
     Args:
         folder_name (str): The name of the folder to create.
         parents_id (str): The ID of the parent directory under which the folder will be created.
@@ -61,180 +46,258 @@ def create_empty_folder(folder_name: str, parents_id: str, drive: GoogleDrive) -
         "mimeType": "application/vnd.google-apps.folder",
     }
 
-    new_folder = drive.CreateFile(folder_metadata)
-    new_folder.Upload()
-    folder_id = new_folder["id"]
+    def insert() -> GoogleDriveFile:
+        new_folder = drive.CreateFile(folder_metadata)
+        new_folder.Upload()
+        return new_folder
+
+    lookup = functools.partial(find_child, folder_name, parents_id, drive, FOLDER_MIME_TYPE)
+    folder_id = call_with_retries(insert, drive, "files.insert", lookup=lookup)["id"]
 
     return folder_id
 
 
-def new_folder_upload(
-    src_full_path: str, target_parents_id: str, drive: GoogleDrive, ignore_dirs: Tuple[str], num_of_uploader: int
-) -> None:
+def create_folder_tree(
+    folder_dirs: List[str], parents_id: Dict[str, str], drive: GoogleDrive, num_of_workers: int, batch_size: int
+) -> Iterator[Tuple[str, str]]:
     """
-    Recursively uploads a folder and its content to Google Drive if it does not already exist.
+    Creates folders on Google Drive one depth level at a time. The folders of a level are grouped into batch
+    requests of batch_size, and the batches run concurrently.
+
+    Each folder is yielded as soon as its batch is done, so its files can be uploaded while the rest of the
+    level is still being created.
 
     Args:
-        src_full_path (str): The local path of the source folder to upload.
-        target_parents_id (str): The ID of the target parent folder on Google Drive.
+        folder_dirs (list): The paths of the folders to create. The parent path of each must either be in
+            parents_id or be one of folder_dirs.
+        parents_id (dict): Maps folder paths to their Google Drive IDs. New folders are added to it.
         drive (GoogleDrive): An instance of the GoogleDrive class.
-        ignore_dirs (list): A list of directory names to ignore during upload.
-    """
-    parents_id = {}
-
-    for root, dirs, files in os.walk(src_full_path, topdown=True):
-        # Modify dirs in-place to skip ignored directories
-        dirs[:] = [d for d in dirs if d not in ignore_dirs]
+        num_of_workers (int): Number of batch requests in flight at once.
+        batch_size (int): Number of folders per batch request.
 
-        last_dir = pathlib.Path(root)
-        pre_last_dir = pathlib.Path(root).parent
-        if str(pre_last_dir) not in parents_id:
-            pre_last_dir = target_parents_id
-        else:
-            pre_last_dir = parents_id[str(pre_last_dir)]
-
-        folder_id = create_empty_folder(last_dir.name, str(pre_last_dir), drive)
+    Yields:
+        tuple: The path of a created folder and its Google Drive ID.
+    """
+    levels = {}
+    for folder_dir in folder_dirs:
+        levels.setdefault(by_lines(folder_dir), []).append(folder_dir)
+
+    with ThreadPoolExecutor(max_workers=num_of_workers) as executor:
+        for depth in sorted(levels):
+            level = levels[depth]
+            futures = [
+                executor.submit(
+                    create_folders,
+                    {d: (os.path.basename(d), parents_id[os.path.dirname(d)]) for d in level[i : i + batch_size]},
+                    drive,
+                    batch_size,
+                )
+                for i in range(0, len(level), batch_size)
+            ]
+            for future in as_completed(futures):
+                for folder_dir, folder_id in future.result().items():
+                    parents_id[folder_dir] = folder_id
+                    yield folder_dir, folder_id
+
+
+def get_dest_dir_id(
+    dest_dir: str, drive: GoogleDrive, create: bool = True, cache: Optional[FolderIdCache] = None
+) -> Optional[str]:
+    """
+    Determines the Google Drive folder ID for a specified path, creating folders as needed.
 
-        upload_tasks = []
-        for name in files:
-            file_metadata = {
-                "title": name,
-                "parents": [{"id": folder_id}],
-                "mimeType": mimetypes.MimeTypes().guess_type(name)[0] or "application/octet-stream",
-            }
-            upload_tasks.append((file_metadata, os.path.join(root, name), drive))
-        progress_bar_with_threading_executor(file_upload, upload_tasks, f"Uploading files from {root}", num_of_uploader)
+    Args:
+        dest_dir (str): The Google Drive path where the folders should be checked or created.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        create (bool): Create the missing folders. When False, a missing folder ends the lookup.
+        cache (FolderIdCache): The folder ID cache, None to list every level.
 
-        parents_id[str(last_dir)] = folder_id
+    Returns:
+        str or None: The Google Drive folder ID corresponding to the specified path, or None if it does not exist
+            and create is False.
+    """
+    return resolve_folder(
+        dest_dir, drive, cache, functools.partial(create_empty_folder, drive=drive) if create else None
+    )
 
 
-def get_dest_dir_id(dest_dir: str, drive: GoogleDrive) -> str:
+def check_upload(
+    src_full_path: str, dest_dir: str, drive: GoogleDrive, cache: Optional[FolderIdCache] = None
+) -> Optional[str]:
     """
-    Determines the Google Drive folder ID for a specified path, creating folders as needed.
+    Checks if a folder is already uploaded to Google Drive.
 
     Args:
-        dest_dir (str): The Google Drive path where the folders should be checked or created.
+        src_full_path (str): The path of the source folder on the local system.
+        dest_dir (str): The Google Drive path of the destination directory.
         drive (GoogleDrive): An instance of the GoogleDrive class.
+        cache (FolderIdCache): The folder ID cache, None to list every level.
 
     Returns:
-        str: The Google Drive folder ID corresponding to the specified path.
+        str or None: The ID of the uploaded folder, or None if it is not there yet.
     """
-    dest_dir_id = "root"
-
-    if dest_dir != "gdrive:":
-        dest_folder_list = dest_dir.split(":")[1].rstrip(os.path.sep).split(os.path.sep)
-        dest_parents_id = []
+    folder_name = src_full_path.split(os.path.sep)[-1]
+    return resolve_folder(f"{dest_dir}/{folder_name}", drive, cache)
 
-        for dest in dest_folder_list:
-            if not dest_parents_id:
-                items = list_folders("root", drive)
-                if dest in [item["title"] for item in items]:
-                    new_folder_id = [item["id"] for item in items if item["title"] == dest][0]
 
-                else:
-                    new_folder_id = create_empty_folder(dest, "root", drive)
+def file_upload(
+    args: Tuple[Dict, str, GoogleDrive], uploader: Optional[ResumableUploader] = None
+) -> Tuple[str, os.stat_result, str, str]:
+    """
+    Uploads a file to Google Drive.
 
-            else:
-                items = list_folders(dest_parents_id[-1], drive)
-                if dest in [item["title"] for item in items]:
-                    new_folder_id = [item["id"] for item in items if item["title"] == dest][0]
+    Args:
+        args (tuple): Contains file metadata, the path of the file to upload, and the Google Drive instance.
+        uploader (ResumableUploader): Uploads files above its threshold in resumable chunks.
 
-                else:
-                    new_folder_id = create_empty_folder(dest, dest_parents_id[-1], drive)
+    Returns:
+        tuple: The path of the uploaded file, its stat before uploading, the md5 reported by Google Drive, and the
+            ID of the file on Google Drive, which copies of the same content are made from.
+    """
+    file_metadata, file_path, drive = args
+    st = os.stat(file_path)
+    if uploader is not None and st.st_size >= uploader.threshold:
+        resource = uploader.upload(file_metadata, file_path, drive)
+        return file_path, st, resource.get("md5Checksum"), resource["id"]
+    if "id" in file_metadata:
+        kind, lookup = "files.update", None
+    else:
+        kind, lookup = "files.insert", functools.partial(find_upload, file_metadata, file_path, drive)
+    file = call_with_retries(lambda: simple_upload(file_metadata, file_path, drive), drive, kind, lookup=lookup)
+    return file_path, st, file.get("md5Checksum"), file["id"]
+
+
+async def file_upload_async(
+    args: Tuple[Dict, str, GoogleDrive], engine: AsyncEngine
+) -> Tuple[str, os.stat_result, str, str]:
+    """
+    The async transport counterpart of file_upload, run on the engine's event loop.
 
-            dest_parents_id.append(new_folder_id)
-        dest_dir_id = dest_parents_id[-1]
+    Args:
+        args (tuple): Contains file metadata, the path of the file to upload, and the Google Drive instance.
+        engine (AsyncEngine): The engine of the run. Files above its resumable threshold are uploaded in chunks.
 
-    return dest_dir_id
+    Returns:
+        tuple: The path of the uploaded file, its stat before uploading, the md5 reported by Google Drive, and the
+            ID of the file on Google Drive, which copies of the same content are made from.
+    """
+    file_metadata, file_path, _ = args
+    st = os.stat(file_path)
+    resource = await engine.client.upload(file_metadata, file_path, engine.resumable_threshold, engine.chunk_size)
+    return file_path, st, resource.get("md5Checksum"), resource["id"]
 
 
-def check_upload(src_full_path: str, dest_dir_id: str, drive: GoogleDrive) -> str:
+def find_upload(file_metadata: Dict, file_path: str, drive: GoogleDrive) -> Optional[Dict]:
     """
-    Checks if a folder is already uploaded to Google Drive and uploads it if not.
+    Looks up the file a failed upload may have created anyway. Only a file with the content of the local file
+    counts, so an upload is never taken for done when it is not.
 
     Args:
-        src_full_path (str): The path of the source folder on the local system.
-        dest_dir_id (str): The ID of the destination directory on Google Drive.
+        file_metadata (dict): The metadata of the upload.
+        file_path (str): The path of the local file.
         drive (GoogleDrive): An instance of the GoogleDrive class.
 
     Returns:
-        str: The ID of the uploaded folder.
+        dict or None: The id and md5Checksum of the uploaded file, None if it is not on Google Drive.
     """
-    folder_name = src_full_path.split(os.path.sep)[-1]
-    items = list_folders(dest_dir_id, drive)
-    if folder_name in [item["title"] for item in items]:
-        folder_id = [item["id"] for item in items if item["title"] == folder_name][0]
-        return folder_id
-    return None
+    existing = find_child(file_metadata["title"], file_metadata["parents"][0]["id"], drive)
+    if existing is None or existing["md5Checksum"] != file_md5(file_path):
+        return None
+    return existing
 
 
-def file_upload(args: Tuple[Dict, str, GoogleDrive]) -> None:
+def simple_upload(file_metadata: Dict, file_path: str, drive: GoogleDrive) -> GoogleDriveFile:
     """
-    Uploads a file to Google Drive.
+    Uploads a file in a single request.
 
     Args:
-        args (tuple): Contains file metadata, the path of the file to upload, and the Google Drive instance.
+        file_metadata (dict): The metadata of the file. If it has an id, that file is updated.
+        file_path (str): The path of the local file.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        GoogleDriveFile: The uploaded file.
     """
-    file_metadata, file_path, drive = args
-    file = drive.CreateFile(file_metadata)
+    file = drive.CreateFile(dict(file_metadata))
     file.SetContentFile(file_path)
     file.Upload()
-    return file_path
+    return file
 
 
-def file_trash(args: Tuple[str, GoogleDrive]) -> None:
+def guess_mime_type(file_name: str) -> str:
     """
-    Moves a file to the trash in Google Drive.
+    Returns the MIME type Google Drive should store a local file under.
 
     Args:
-        args (tuple): Contains the ID of the file to trash and the Google Drive instance.
+        file_name (str): The name of the file.
+
+    Returns:
+        str: The type guessed from the extension, application/octet-stream if there is none.
     """
-    file_id, drive = args
-    file = drive.CreateFile({"id": file_id})
-    file.Trash()
+    return mimetypes.guess_type(file_name)[0] or "application/octet-stream"
 
 
-def progress_bar_with_threading_executor(fn: Callable, iterable: Tuple, desc: str, num_of_uploader: int) -> None:
+def record_upload(
+    state: FileStateCache, result: Tuple[str, os.stat_result, str, str], uploaded: Optional[Dict[str, str]] = None
+) -> None:
     """
-    Executes a function over an iterable with a progress bar, using multiple threads.
+    Stores the state of a successfully uploaded file so it is not re-hashed on the next push.
 
     Args:
-        fn (function): The function to apply to each item in the iterable.
-        iterable (iterable): An iterable where each item will be processed by the function.
-        desc (str): Description text for the progress bar.
+        state (FileStateCache): The local file-state cache.
+        result (tuple): The result of file_upload.
+        uploaded (dict): Collects the Google Drive ID of the file by local path, if given.
     """
-    disable_pbar = len(iterable) == 0
-
-    with tqdm.tqdm(total=len(iterable), desc=desc, disable=disable_pbar) as progress:
-        with ThreadPoolExecutor(max_workers=num_of_uploader) as executor:
-            for _ in executor.map(fn, iterable):
-                progress.update()
-
-
-def get_tree(folder_name: str, tree_list: List[str], root: str, parents_id: Dict, drive: GoogleDrive) -> None:
+    file_path, st, md5, file_id = result
+    state.record(file_path, md5, st)
+    if uploaded is not None:
+        uploaded[file_path] = file_id
+
+
+def submit_upload(
+    pipeline: TransferPipeline,
+    task: Tuple[Dict, str, GoogleDrive],
+    state: FileStateCache,
+    uploader: Optional[ResumableUploader] = None,
+    engine: Optional[AsyncEngine] = None,
+    uploaded: Optional[Dict[str, str]] = None,
+) -> None:
     """
-    Recursively builds a list of all folder paths under a specified Google Drive folder.
+    Queues an upload on the pipeline and records the file state once it succeeded.
 
     Args:
-        folder_name (str): The name of the starting folder.
-        tree_list (list): Accumulator for storing folder paths.
-        root (str): Current path prefix.
-        parents_id (dict): A dictionary mapping folder names to their Google Drive IDs.
-        drive (GoogleDrive): An instance of the GoogleDrive class.
-
-    Returns:
-        None. It will modify tree_list that was passed in.
+        pipeline (TransferPipeline): The pipeline running the uploads.
+        task (tuple): The upload task for file_upload.
+        state (FileStateCache): The local file-state cache.
+        uploader (ResumableUploader): Uploads large files in resumable chunks.
+        engine (AsyncEngine): Upload through the async transport instead, on the pipeline of the engine.
+        uploaded (dict): Collects the Google Drive ID of the uploaded file by local path.
     """
-    folder_id = parents_id[root + folder_name]
-    items = list_folders(folder_id, drive)
-    root += folder_name + os.path.sep
+    if engine is not None:
+        upload = functools.partial(file_upload_async, engine=engine)
+    else:
+        upload = functools.partial(file_upload, uploader=uploader)
+    pipeline.submit(
+        upload,
+        task,
+        os.path.getsize(task[1]),
+        functools.partial(record_upload, state, uploaded=uploaded),
+    )
+
+
+def rebase_folders(parents_id: Dict[str, str], old_path: str, new_path: Optional[str]) -> None:
+    """
+    Updates the folder IDs of a folder and everything below it after it was moved or trashed.
 
-    for item in items:
-        parents_id[root + item["title"]] = item["id"]
-        tree_list.append(root + item["title"])
-        folder_id = [i["id"] for i in items if i["title"] == item["title"]][0]
-        folder_name = item["title"]
-        get_tree(folder_name, tree_list, root, parents_id, drive)
+    Args:
+        parents_id (dict): Maps folder paths to their Google Drive IDs.
+        old_path (str): The path of the folder before.
+        new_path (str): The path of the folder after the move, None if it was trashed.
+    """
+    for folder_dir in [d for d in parents_id if is_below(d, old_path)]:
+        folder_id = parents_id.pop(folder_dir)
+        if new_path is not None:
+            parents_id[new_path + folder_dir[len(old_path) :]] = folder_id
 
 
 def by_lines(input_str: str) -> int:
@@ -250,167 +313,541 @@ def by_lines(input_str: str) -> int:
     return input_str.count(os.path.sep)
 
 
-def push(src_full_path: str, dest_dir: str, ignore_dirs: Tuple[str], num_of_uploader: int) -> None:
+def plan_push(
+    src_full_path: str,
+    tree: Optional[RemoteTree],
+    ignore_dirs: Tuple[str],
+    drive: GoogleDrive,
+    state: FileStateCache,
+    hasher: HashEngine,
+    plan: SyncPlan,
+    local: Optional[Dict[str, Dict[str, int]]] = None,
+) -> None:
     """
-    Pushes local files to Google Drive, creating folders and uploading files as necessary.
+    Works out what a push has to do to bring the folder on Google Drive in line with the local folder.
+
+    Both sides are indexed once, then every folder is compared through dict lookups. Files present on both
+    sides are hashed in parallel across all folders, and only those whose md5 differs are planned as updates.
+    New files with the size and md5 of a file about to be trashed are moved on gdrive instead of uploaded.
+    Files whose content is on gdrive already, or uploaded by the push anyway, are copied there server-side.
 
     Args:
         src_full_path (str): The local path to push from.
-        dest_dir (str): The destination directory path on Google Drive.
+        tree (RemoteTree): The index of the matching folder on Google Drive, None if it does not exist yet.
         ignore_dirs (list): A list of directories to ignore during the push.
-        num_of_uploader(int): Number of workers in threading executor.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        state (FileStateCache): The local file-state cache.
+        hasher (HashEngine): The engine used to hash local files.
+        plan (SyncPlan): The plan the actions are added to.
+        local (dict): The index of the local side as made by index_local, of the whole folder when None. Only the
+            folders in it and in tree are compared, so watch mode passes just the folders that changed.
+    """
+    metrics = metrics_for(drive)
+    parent_folder = os.path.dirname(src_full_path)
+    if local is None:
+        local = index_local(src_full_path, ignore_dirs)
+    remote_files = tree.files if tree is not None else {}
+    candidates = {}
+
+    for folder_dir, local_files in local.items():
+        remote = {}
+        if folder_dir not in remote_files:
+            plan.add("mkdir", folder_dir)
+        else:
+            remote, duplicates = index_by_title(remote_files[folder_dir])
+            for drive_file in duplicates:
+                plan.note(
+                    f"{os.path.join(folder_dir, drive_file['title'])} is on gdrive more than once, the older copies are left alone."
+                )
+            for title, drive_file in remote.items():
+                if title not in local_files:
+                    plan.add(
+                        "trash", os.path.join(folder_dir, title), int(drive_file.get("fileSize", 0)), remote=drive_file
+                    )
+        for name, size in local_files.items():
+            path = os.path.join(folder_dir, name)
+            if name in remote:
+                candidates[os.path.join(parent_folder, path)] = (path, folder_dir, remote[name], size)
+            else:
+                plan.add("upload", path, size, parent=folder_dir)
+
+    # Trashing a folder trashes its content, so only the topmost removed folders need an action
+    removed = set(remote_files).difference(local)
+    sizes = {}
+    sources = {
+        action.path: (action.size, action.remote.get("md5Checksum"), action.remote) for action in plan.of_kind("trash")
+    }
+    removed_folders = collections.defaultdict(list)
+    for folder_dir in removed:
+        ancestors = [str(p) for p in reversed(pathlib.Path(folder_dir).parents)]
+        top = next((p for p in ancestors if p in removed), folder_dir)
+        sizes[top] = sizes.get(top, 0) + sum(int(f.get("fileSize", 0)) for f in remote_files[folder_dir])
+        removed_folders[top].append(folder_dir)
+        for drive_file in remote_files[folder_dir]:
+            path = os.path.join(folder_dir, drive_file["title"])
+            sources[path] = (int(drive_file.get("fileSize", 0)), drive_file.get("md5Checksum"), drive_file)
+    for folder_dir, size in sizes.items():
+        remote = {"id": tree.parents_id[folder_dir], "title": os.path.basename(folder_dir)}
+        plan.add("trash", folder_dir, size, remote=remote)
+    for folder_dir in tree.duplicate_folders if tree is not None else []:
+        plan.note(f"{folder_dir} is on gdrive more than once, their content is compared as one folder.")
+
+    for file_dir, local_file_md5 in metrics.timed("hashing", state.md5_many(candidates, hasher)):
+        path, folder_dir, drive_file, size = candidates[file_dir]
+        if drive_file.get("md5Checksum") != local_file_md5:
+            plan.add("update", path, size, parent=folder_dir, remote=drive_file)
+        else:
+            metrics.count_files("unchanged")
+
+    # Only new files the size of another file can be moves or copies, the others are not hashed
+    upload_sizes = collections.Counter(action.size for action in plan.of_kind("upload"))
+    remote_sizes = {int(f.get("fileSize", 0)) for drive_files in remote_files.values() for f in drive_files}
+    uploads = {
+        os.path.join(parent_folder, action.path): action.path
+        for action in plan.of_kind("upload")
+        if action.size in remote_sizes or upload_sizes[action.size] > 1
+    }
+    targets = {uploads[f]: md5 for f, md5 in metrics.timed("hashing", state.md5_many(uploads, hasher))}
+    plan_moves(plan, targets, sources, removed_folders)
+
+    # Files that are trashed or updated cannot be copied from
+    changing = {action.path for action in plan.actions if action.kind in ("trash", "update")}
+    unchanged = {}
+    for folder_dir, drive_files in remote_files.items():
+        if any(str(p) in changing for p in [pathlib.Path(folder_dir), *pathlib.Path(folder_dir).parents]):
+            continue
+        for drive_file in drive_files:
+            path = os.path.join(folder_dir, drive_file["title"])
+            if path not in changing and drive_file.get("md5Checksum"):
+                key = int(drive_file.get("fileSize", 0)), drive_file["md5Checksum"]
+                unchanged.setdefault(key, (path, drive_file))
+    plan_copies(plan, targets, unchanged)
+
+
+def execute_push_plan(
+    plan: SyncPlan,
+    src_full_path: str,
+    parents_id: Dict[str, str],
+    drive: GoogleDrive,
+    num_of_uploader: int,
+    batch_size: int,
+    pipeline: TransferPipeline,
+    state: FileStateCache,
+    uploader: ResumableUploader,
+    engine: Optional[AsyncEngine] = None,
+) -> Dict[str, str]:
+    """
+    Carries out a push plan, except for its copies, which wait for the uploads (see execute_copies).
+
+    Files going into existing folders are queued first, so transfers start while the new folders are
+    created. The files of each new folder are queued as soon as its batch is done. Moves are metadata-only
+    patches, batched once all folders exist, and trashing comes last.
+
+    Args:
+        plan (SyncPlan): The plan made by plan_push.
+        src_full_path (str): The local path to push from.
+        parents_id (dict): Maps the folder paths that exist on Google Drive to their IDs. New folders are added to it.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        num_of_uploader(int): Number of folder batches created at once.
+        batch_size (int): Number of calls per batch request when creating, moving and trashing.
+        pipeline (TransferPipeline): The pipeline running the uploads.
+        state (FileStateCache): The local file-state cache, updated after each upload.
+        uploader (ResumableUploader): Uploads large files in resumable chunks.
+        engine (AsyncEngine): Create folders, upload and trash through the async transport instead.
 
     Returns:
-        None
+        dict: The Google Drive IDs of the new files by local path, filled in as their uploads finish.
     """
-    drive = load_authorized_gdrive()
-    dest_dir = dest_dir.rstrip("/")
+    metrics = metrics_for(drive)
+    parent_folder = os.path.dirname(src_full_path)
+    uploaded = {}
+    uploads = collections.defaultdict(list)
+    for action in plan.of_kind("upload"):
+        uploads[action.parent].append(action)
+
+    def submit_new(action: PlanAction) -> None:
+        file_name = os.path.basename(action.path)
+        file_metadata = {
+            "title": file_name,
+            "parents": [{"id": parents_id[action.parent]}],
+            "mimeType": guess_mime_type(file_name),
+        }
+        submit_upload(
+            pipeline,
+            (file_metadata, os.path.join(parent_folder, action.path), drive),
+            state,
+            uploader,
+            engine,
+            uploaded,
+        )
 
-    print("Push started.")
-    if ignore_dirs:
-        print(f"Ignoring dirs: {' '.join(ignore_dirs)}")
-    if num_of_uploader != 5:
-        print(f"Number of uploaders: {num_of_uploader}")
-    # Get id of Google Drive folder and it's path (from other script)
-    # folder_id, full_path = initial_upload.check_upload(service)
-    folder_name = src_full_path.split(os.path.sep)[-1]
-    dest_dir_id = get_dest_dir_id(dest_dir, drive)
-    folder_id = check_upload(src_full_path, dest_dir_id, drive)
+    for folder_dir in [d for d in uploads if d in parents_id]:
+        for action in uploads[folder_dir]:
+            submit_new(action)
+    for action in plan.of_kind("update"):
+        file_metadata = {
+            "id": action.remote["id"],
+            "title": action.remote["title"],
+            "parents": [{"id": parents_id[action.parent]}],
+            "mimeType": action.remote["mimeType"],
+        }
+        submit_upload(
+            pipeline, (file_metadata, os.path.join(parent_folder, action.path), drive), state, uploader, engine
+        )
 
-    if folder_id is None:
-        print(f"{os.path.join(dest_dir, folder_name)} does not exist. Uploading folder to gdrive...")
-        new_folder_upload(src_full_path, dest_dir_id, drive, ignore_dirs, num_of_uploader)
-        print("Push completed.")
-        return
+    folder_dirs = [action.path for action in plan.of_kind("mkdir")]
+    if engine is not None:
+        folders = engine.create_folder_tree(folder_dirs, parents_id)
+    else:
+        folders = create_folder_tree(folder_dirs, parents_id, drive, num_of_uploader, batch_size)
+    for folder_dir, _ in metrics.timed("folders", folders):
+        pipeline.write(f"Created new folder for {os.path.join(parent_folder, folder_dir)}")
+        for action in uploads.get(folder_dir, []):
+            submit_new(action)
+
+    moves = plan.of_kind("move")
+    if moves:
+        pipeline.write(f"Moving {len(moves)} files and folders on gdrive...")
+        updates = {}
+        for action in moves:
+            old_parent_id, new_parent_id = parents_id[os.path.dirname(action.source)], parents_id[action.parent]
+            update = {"body": {"title": os.path.basename(action.path)}, "fields": "id"}
+            if new_parent_id != old_parent_id:
+                update.update(addParents=new_parent_id, removeParents=old_parent_id)
+            updates[action.remote["id"]] = update
+        with metrics.phase("move"):
+            update_metadata(updates, drive, batch_size)
+        metrics.count_files("moved", len(moves))
+        for action in moves:
+            if parents_id.get(action.source) == action.remote["id"]:
+                rebase_folders(parents_id, action.source, action.path)
+
+    removal_ids = [action.remote["id"] for action in plan.of_kind("trash")]
+    if removal_ids:
+        pipeline.write(f"Trashing {len(removal_ids)} files and folders on gdrive...")
+        with metrics.phase("trash"):
+            if engine is not None:
+                engine.trash(removal_ids)
+            else:
+                trash_files(removal_ids, drive, batch_size)
+        metrics.count_files("trashed", len(removal_ids))
+        for action in plan.of_kind("trash"):
+            if parents_id.get(action.path) == action.remote["id"]:
+                rebase_folders(parents_id, action.path, None)
+    return uploaded
+
+
+def execute_copies(
+    plan: SyncPlan,
+    src_full_path: str,
+    parents_id: Dict[str, str],
+    uploaded: Dict[str, str],
+    drive: GoogleDrive,
+    batch_size: int,
+    state: FileStateCache,
+) -> None:
+    """
+    Creates the copies of a push plan on Google Drive, server-side and in batches, once the uploads are done.
 
-    tree_list = []
-    root = ""
-    parents_id = {}
-
-    print("Comparing local stroage to gdrive...")
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, drive)
-    local_tree_list = []
-    root_len = len(src_full_path.split(os.path.sep)[0:-2])
-
-    # Get list of folders three paths on computer
-    for root, dirs, files in os.walk(src_full_path, topdown=True):
-
-        for dir in ignore_dirs:
-            dirs[:] = [d for d in dirs if dir not in d.split(os.path.sep)]
-
-        for name in dirs:
-            var_path = (os.path.sep).join(root.split(os.path.sep)[root_len + 1 :])
-            local_tree_list.append(os.path.join(var_path, name))
-
-    # new folders on drive, which you dont have(i suppose hehe)
-    upload_folders = list(set(local_tree_list).difference(set(tree_list)))
-    # foldes that match
-    exact_folders = list(set(local_tree_list).intersection(set(tree_list)))
-    # old folders on drive
-    remove_folders = list(set(tree_list).difference(set(local_tree_list)))
-
-    # Add starting directory
-    exact_folders.append(folder_name)
-    # Sort uploadable folders
-    # so now in can be upload from top to down of tree
-    upload_folders = sorted(upload_folders, key=by_lines)
-
-    parent_folder = pathlib.Path(src_full_path).parent.resolve()
-
-    # Here we upload new (absent on Drive) folders
-    for folder_dir in upload_folders:
-        folder = os.path.join(parent_folder, folder_dir)
-        last_dir = pathlib.Path(folder_dir)
-        pre_last_dir = pathlib.Path(folder_dir).parent
-
-        folder_id = create_empty_folder(last_dir.name, parents_id[str(pre_last_dir)], drive)
-        print(f"Created new folder for {folder}")
-        parents_id[str(last_dir)] = folder_id
-
-        upload_tasks = []
-        files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
-        for local_file in files:
-            local_file_mimetype = (
-                mimetypes.MimeTypes().guess_type(os.path.join(folder, local_file))[0] or "application/octet-stream"
-            )
-            file_metadata = {
-                "title": local_file,
-                "parents": [{"id": folder_id}],
-                "mimeType": local_file_mimetype,
-            }
-            upload_tasks.append((file_metadata, os.path.join(folder, local_file), drive))
-        progress_bar_with_threading_executor(
-            file_upload, upload_tasks, f"Uploading files from {folder}", num_of_uploader
+    Args:
+        plan (SyncPlan): The plan made by plan_push.
+        src_full_path (str): The local path to push from.
+        parents_id (dict): Maps the folder paths on Google Drive to their IDs, new folders included.
+        uploaded (dict): The Google Drive IDs of the uploaded files by local path, as returned by execute_push_plan.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        batch_size (int): Number of calls per batch request.
+        state (FileStateCache): The local file-state cache, updated after the copies.
+    """
+    copies = plan.of_kind("copy")
+    if not copies:
+        return
+    metrics = metrics_for(drive)
+    parent_folder = os.path.dirname(src_full_path)
+    print(f"Copying {len(copies)} files already on gdrive...")
+    requests = {}
+    for action in copies:
+        file_id = (
+            action.remote["id"] if action.remote is not None else uploaded[os.path.join(parent_folder, action.source)]
         )
+        requests[action.path] = (file_id, os.path.basename(action.path), parents_id[action.parent])
+    with metrics.phase("copy"):
+        results = copy_files(requests, drive, batch_size)
+    for action in copies:
+        state.record(os.path.join(parent_folder, action.path), results[action.path].get("md5Checksum"))
+        metrics.deduplicated(action.size)
+
+
+def apply_push_plan(
+    plan: SyncPlan,
+    src_full_path: str,
+    parents_id: Dict[str, str],
+    drive: GoogleDrive,
+    num_of_uploader: int,
+    batch_size: int,
+    state: FileStateCache,
+    uploader: ResumableUploader,
+    metrics: RunMetrics,
+    engine: Optional[AsyncEngine] = None,
+) -> None:
+    """
+    Carries out a whole push plan on a pipeline of its own: execute_push_plan, then execute_copies.
 
-    # Check files in existed folders and replace them
-    # with newer versions if needed
-    for folder_dir in exact_folders:
-
-        folder = os.path.join(parent_folder, folder_dir)
-        last_dir = pathlib.Path(folder_dir)
-        local_files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
-        items = list_files(parents_id[str(last_dir)], drive)
-
-        upload_files = [f for f in local_files if f not in [i["title"] for i in items]]
-        update_files = [f for f in items if f["title"] in local_files]
-        remove_files = [f for f in items if f["title"] not in local_files]
-
-        upload_tasks = []
-        for local_file in upload_files:
-            local_file_mimetype = (
-                mimetypes.MimeTypes().guess_type(os.path.join(folder, local_file))[0] or "application/octet-stream"
-            )
-            file_metadata = {
-                "title": local_file,
-                "parents": [{"id": folder_id}],
-                "mimeType": local_file_mimetype,
-            }
-            upload_tasks.append((file_metadata, os.path.join(folder, local_file), drive))
-        progress_bar_with_threading_executor(
-            file_upload, upload_tasks, f"Uploading files from {folder}", num_of_uploader
+    Args:
+        plan (SyncPlan): The plan made by plan_push.
+        src_full_path (str): The local path to push from.
+        parents_id (dict): Maps the folder paths that exist on Google Drive to their IDs. Kept up to date with the
+            folders the plan creates, moves and trashes.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        num_of_uploader(int): Number of workers of the pipeline, or of requests in flight with an engine.
+        batch_size (int): Number of calls per batch request.
+        state (FileStateCache): The local file-state cache, updated after each upload.
+        uploader (ResumableUploader): Uploads large files in resumable chunks.
+        metrics (RunMetrics): The metrics of the run, for the pipeline.
+        engine (AsyncEngine): Upload through the async transport instead.
+    """
+    if engine is not None:
+        pipeline = engine.pipeline("Uploading", metrics)
+    else:
+        pipeline = TransferPipeline(num_of_uploader, "Uploading", metrics=metrics)
+    with pipeline:
+        uploaded = execute_push_plan(
+            plan, src_full_path, parents_id, drive, num_of_uploader, batch_size, pipeline, state, uploader, engine
         )
+    execute_copies(plan, src_full_path, parents_id, uploaded, drive, batch_size, state)
+
+
+def pack_upload(args: Tuple[Dict, str, List[Entry], GoogleDrive]) -> int:
+    """
+    Packs the files of an archive chunk into a temporary tar.gz file and uploads it in a single request.
 
-        update_tasks = []
-        for drive_file in update_files:
+    Args:
+        args (tuple): Contains the metadata of the chunk, the local archived folder, the entries of the chunk,
+            and the Google Drive instance.
 
-            file_dir = os.path.join(folder, drive_file["title"])
+    Returns:
+        int: The number of files packed.
+    """
+    file_metadata, folder_path, entries, drive = args
+    chunk_path = pack_chunk(folder_path, entries)
+    try:
+        file_upload((file_metadata, chunk_path, drive))
+    finally:
+        os.remove(chunk_path)
+    return len(entries)
 
-            drive_md5 = drive_file["md5Checksum"]
-            local_file_md5 = hashlib.md5(open(file_dir, "rb").read()).hexdigest()
 
-            if drive_md5 != local_file_md5:
-                file_id = [f["id"] for f in items if f["title"] == drive_file["title"]][0]
-                file_mime = [f["mimeType"] for f in items if f["title"] == drive_file["title"]][0]
+def upload_index(archive: Archive, folder_id: str, drive: GoogleDrive) -> None:
+    """
+    Uploads the index of an archive, replacing the previous one if there is one.
 
+    Args:
+        archive (Archive): The archive.
+        folder_id (str): The ID of the archive folder on Google Drive.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+    """
+    file_metadata = {"title": INDEX_NAME, "parents": [{"id": folder_id}], "mimeType": "application/gzip"}
+    if INDEX_NAME in archive.remote:
+        file_metadata["id"] = archive.remote[INDEX_NAME]["id"]
+    fd, index_path = tempfile.mkstemp(suffix=".json.gz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(encode_index(archive.chunks))
+        file_upload((file_metadata, index_path, drive))
+    finally:
+        os.remove(index_path)
+
+
+def execute_archive_push(
+    plan: SyncPlan,
+    archives: List[Archive],
+    src_full_path: str,
+    parents_id: Dict[str, str],
+    drive: GoogleDrive,
+    num_of_uploader: int,
+    batch_size: int,
+    metrics: RunMetrics,
+) -> None:
+    """
+    Packs and uploads the new chunks of the archived folders, once the push plan created their archive folders.
+
+    The index of an archive is only replaced once all its chunks are on gdrive, and the chunks it no longer lists
+    are trashed last, so a pull running meanwhile always finds the chunks of the index it reads.
+
+    Args:
+        plan (SyncPlan): The plan made by plan_push and plan_archive_push.
+        archives (list): The archives returned by plan_archive_push.
+        src_full_path (str): The local path to push from.
+        parents_id (dict): Maps the folder paths on Google Drive to their IDs, new folders included.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        num_of_uploader(int): Number of chunks packed and uploaded at once.
+        batch_size (int): Number of calls per batch request when trashing.
+        metrics (RunMetrics): The metrics of the run, for the pipeline.
+    """
+    parent_folder = os.path.dirname(src_full_path)
+    by_path = {archive.remote_path: archive for archive in archives}
+    packs = plan.of_kind("pack")
+    if packs:
+        with TransferPipeline(num_of_uploader, "Packing", metrics=metrics) as pipeline:
+            for action in packs:
+                archive = by_path[action.parent]
+                name = os.path.basename(action.path)
                 file_metadata = {
-                    "id": file_id,
-                    "title": drive_file["title"],
-                    "parents": [{"id": parents_id[str(last_dir)]}],
-                    "mimeType": file_mime,
+                    "title": name,
+                    "parents": [{"id": parents_id[action.parent]}],
+                    "mimeType": "application/gzip",
                 }
-                update_tasks.append((file_metadata, file_dir, drive))
-        progress_bar_with_threading_executor(
-            file_upload, update_tasks, f"Updating files from {folder}", num_of_uploader
-        )
+                task = (file_metadata, os.path.join(parent_folder, archive.path), archive.chunks[name], drive)
+                pipeline.submit(pack_upload, task, action.size, functools.partial(metrics.count_files, "packed"))
+
+    changed = {action.parent for action in packs}
+    stale_ids = []
+    for archive in archives:
+        stale = archive.stale()
+        if archive.remote_path in changed or stale or INDEX_NAME not in archive.remote:
+            upload_index(archive, parents_id[archive.remote_path], drive)
+        stale_ids.extend(drive_file["id"] for drive_file in stale)
+    if stale_ids:
+        print(f"Trashing {len(stale_ids)} chunks no longer used...")
+        with metrics.phase("trash"):
+            trash_files(stale_ids, drive, batch_size)
+
+
+def push(
+    src_full_path: str,
+    dest_dir: str,
+    ignore_dirs: Tuple[str],
+    num_of_uploader: int,
+    batch_size: int = BATCH_SIZE,
+    resumable_threshold: int = RESUMABLE_THRESHOLD,
+    chunk_size: int = CHUNK_SIZE,
+    drive: Optional[GoogleDrive] = None,
+    metrics: Optional[RunMetrics] = None,
+    adaptive: bool = False,
+    max_workers: int = MAX_WORKERS,
+    dry_run: bool = False,
+    plan_json: Optional[str] = None,
+    transport: str = "threads",
+    state: Optional[FileStateCache] = None,
+    folder_ids: Optional[FolderIdCache] = None,
+    sessions: Optional[UploadSessions] = None,
+    archive_dirs: Tuple[str] = (),
+    hasher: Optional[HashEngine] = None,
+) -> SyncPlan:
+    """
+    Pushes local files to Google Drive, creating folders and uploading files as necessary.
 
-        removal_tasks = []
-        for drive_file in remove_files:
-            file_id = [f["id"] for f in items if f["title"] == drive_file["title"]][0]
-            removal_tasks.append((file_id, drive))
-        progress_bar_with_threading_executor(
-            file_trash, removal_tasks, f"Removing files that were in {folder}", num_of_uploader
-        )
+    Args:
+        src_full_path (str): The local path to push from.
+        dest_dir (str): The destination directory path on Google Drive.
+        ignore_dirs (list): A list of directories to ignore during the push.
+        num_of_uploader(int): Number of workers in threading executor.
+        batch_size (int): Number of calls per batch request when creating and trashing.
+        resumable_threshold (int): Files of at least this many bytes are uploaded in resumable chunks.
+        chunk_size (int): Size of the chunks of resumable uploads in bytes, a multiple of 256 KiB.
+        drive (GoogleDrive): The Google Drive to use, e.g. the FakeDrive of the benchmarks. Loads the saved credentials when None.
+        metrics (RunMetrics): Collects timings and call counts of the run.
+        adaptive (bool): Start at num_of_uploader concurrent calls and adapt to how Google Drive responds: more while
+            calls stay fast, fewer on rate limits and server errors.
+        max_workers (int): The most concurrent calls adaptive mode goes up to.
+        dry_run (bool): Print the plan instead of carrying it out. Nothing is changed on gdrive or locally.
+        plan_json (str): Also write the plan to this JSON file, "-" for standard output.
+        transport (str): "threads" for one blocking call per worker thread, or "async" to list, create folders,
+            upload and trash on an event loop with num_of_uploader requests in flight. Needs aiohttp.
+        state (FileStateCache): The local file-state cache, shared by runs in one process. Loaded when None.
+        folder_ids (FolderIdCache): The folder ID cache, shared by runs in one process. Loaded when None.
+        sessions (UploadSessions): The unfinished resumable uploads, shared by runs in one process. Loaded when None.
+        archive_dirs (list): Names of directories to push in archive mode, as a few compressed chunks and an index
+            next to them instead of file by file. See argsync.archive.
+        hasher (HashEngine): The engine hashing local files, shared by runs in one process. Started for the push
+            when None.
+
+    Returns:
+        SyncPlan: The plan of the push.
+    """
+    if drive is None:
+        drive = load_authorized_gdrive()
+    if metrics is None:
+        metrics = RunMetrics("push")
+    instrument(drive, metrics)
+    if state is None:
+        state = FileStateCache()
+    uploader = ResumableUploader(resumable_threshold, chunk_size, sessions)
+    dest_dir = dest_dir.rstrip("/")
+    engine = AsyncEngine(drive, num_of_uploader, resumable_threshold, chunk_size) if transport == "async" else None
 
-    remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
-
-    # Delete old folders from Drive
-    removal_tasks = []
-    for folder_dir in remove_folders:
-        folder = os.path.join(parent_folder, folder_dir)
-        last_dir = pathlib.Path(folder_dir)
-        folder_id = parents_id[str(last_dir)]
-        removal_tasks.append((folder_id, drive))
-    progress_bar_with_threading_executor(file_trash, removal_tasks, "Deleting unwanted folders", num_of_uploader)
-    print("Push completed.")
+    print("Push started." if not dry_run else "Dry run started, nothing will be changed.")
+    if ignore_dirs:
+        print(f"Ignoring dirs: {' '.join(ignore_dirs)}")
+    if archive_dirs:
+        print(f"Archiving dirs: {' '.join(archive_dirs)}")
+    if engine is not None:
+        print(f"Async transport: up to {num_of_uploader} requests in flight.")
+    if adaptive:
+        print(f"Adaptive concurrency: starting at {num_of_uploader}, up to {max_workers}.")
+        attach_limiter(drive, AdaptiveLimiter(num_of_uploader, maximum=max_workers))
+        num_of_uploader = max(max_workers, num_of_uploader)
+    else:
+        attach_limiter(drive, None)
+        if num_of_uploader != 5 and engine is None:
+            print(f"Number of uploaders: {num_of_uploader}")
+    ensure_pool(drive, num_of_uploader)
+    folder_name = src_full_path.split(os.path.sep)[-1]
+    if folder_ids is None:
+        folder_ids = FolderIdCache()
+    with metrics.phase("resolve"):
+        folder_id = check_upload(src_full_path, dest_dir, drive, folder_ids)
+        dest_dir_id = None
+        if folder_id is None:
+            dest_dir_id = get_dest_dir_id(dest_dir, drive, create=not dry_run, cache=folder_ids)
+
+    plan = SyncPlan("push", src_full_path, os.path.join(dest_dir, folder_name))
+    if folder_id is None and dest_dir_id is None:
+        plan.note(f"{dest_dir} does not exist on gdrive and will be created.")
+    try:
+        with engine or contextlib.nullcontext():
+            tree = None
+            if folder_id is None:
+                print(f"{os.path.join(dest_dir, folder_name)} does not exist. Uploading folder to gdrive...")
+            else:
+                print("Comparing local stroage to gdrive...")
+                with metrics.phase("listing"):
+                    if engine is not None:
+                        tree = engine.list_tree(folder_name, folder_id)
+                    else:
+                        tree = list_tree(folder_name, folder_id, drive, num_of_uploader)
+            with HashEngine() if hasher is None else contextlib.nullcontext(hasher) as hashing:
+                archived = find_archived(src_full_path, ignore_dirs, archive_dirs) if archive_dirs else []
+                # Takes the archive folders out of tree first, and plan_push skips the archived folders
+                archives = plan_archive_push(src_full_path, archived, tree, ignore_dirs, drive, state, hashing, plan)
+                plan_push(src_full_path, tree, tuple(ignore_dirs) + tuple(archive_dirs), drive, state, hashing, plan)
+
+            if dry_run:
+                print(plan.summary())
+            if plan_json:
+                plan.write_json(plan_json)
+            if not dry_run:
+                parents_id = tree.parents_id if tree is not None else {"": dest_dir_id}
+                apply_push_plan(
+                    plan,
+                    src_full_path,
+                    parents_id,
+                    drive,
+                    num_of_uploader,
+                    batch_size,
+                    state,
+                    uploader,
+                    metrics,
+                    engine,
+                )
+                if archives:
+                    execute_archive_push(
+                        plan, archives, src_full_path, parents_id, drive, num_of_uploader, batch_size, metrics
+                    )
+                if folder_id is None:
+                    folder_ids.put(cache_key(f"{dest_dir}/{folder_name}"), parents_id[folder_name])
+    finally:
+        if not dry_run:
+            state.save()
+            folder_ids.save()
+    print("Push completed." if not dry_run else "Dry run completed.")
+    return plan
@@ -0,0 +1,151 @@
+import contextlib
+import functools
+import threading
+from typing import Callable, List, Optional
+
+from pydrive2.drive import GoogleDrive, GoogleDriveFile
+
+from argsync.batch import execute_batched
+from argsync.plan import index_by_title
+from argsync.state import FolderIdCache
+from argsync.throttle import call_with_retries
+from argsync.tree import FOLDER_MIME_TYPE, LIST_FIELDS
+
+CHECK_FIELDS = "id,title,mimeType,labels/trashed,parents/id,parents/isRoot"
+# Lookups that create folders run one at a time, so concurrent runs of a process never create a folder twice
+_create_lock = threading.Lock()
+
+
+def list_folders(parents_id: str, drive: GoogleDrive) -> List[GoogleDriveFile]:
+    """
+    Lists all folders in the specified Google Drive directory.
+
+    Args:
+        parents_id (str): The ID of the parent directory in Google Drive.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        list: A list of Google Drive file objects representing folders.
+    """
+    query = f"'{parents_id}' in parents and trashed=false and mimeType='{FOLDER_MIME_TYPE}'"
+    return call_with_retries(lambda: drive.ListFile({"q": query, "fields": LIST_FIELDS}).GetList(), drive, "files.list")
+
+
+def path_segments(remote_path: str) -> List[str]:
+    """
+    Splits a Google Drive path into folder names.
+
+    Args:
+        remote_path (str): The path, formatted as gdrive:path/to/folder.
+
+    Returns:
+        list: The folder names from the top, empty for gdrive: itself.
+    """
+    return [segment for segment in remote_path.split(":", 1)[1].split("/") if segment]
+
+
+def _cache_key(segments: List[str]) -> str:
+    return "gdrive:" + "/".join(segments)
+
+
+def cache_key(remote_path: str) -> str:
+    """
+    Returns the key a Google Drive path is cached under, e.g. gdrive:a/b for gdrive:a//b/.
+
+    Args:
+        remote_path (str): The path, formatted as gdrive:path/to/folder.
+
+    Returns:
+        str: The normalized path.
+    """
+    return _cache_key(path_segments(remote_path))
+
+
+def _is_child(item: dict, title: str, parent_id: str) -> bool:
+    if item["title"] != title or item["mimeType"] != FOLDER_MIME_TYPE or item["labels"]["trashed"]:
+        return False
+    return any(p["id"] == parent_id or (parent_id == "root" and p.get("isRoot")) for p in item.get("parents", []))
+
+
+def check_cached(segments: List[str], drive: GoogleDrive, cache: FolderIdCache) -> List[str]:
+    """
+    Returns the IDs of the longest run of cached folders from the top of a path that still checks out.
+
+    All cached folders of the path are fetched in one batch request, and each must still be an untrashed folder
+    with the expected title inside the folder before it. The first one that fails is dropped from the cache,
+    together with everything below it.
+
+    Args:
+        segments (list): The folder names of the path, from the top.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        cache (FolderIdCache): The folder ID cache.
+
+    Returns:
+        list: The IDs of the verified folders, from the top.
+    """
+    cached = []
+    for depth in range(1, len(segments) + 1):
+        folder_id = cache.get(_cache_key(segments[:depth]))
+        if folder_id is None:
+            break
+        cached.append(folder_id)
+    if not cached:
+        return []
+
+    service = drive.auth.service
+    requests = {
+        folder_id: functools.partial(service.files().get, fileId=folder_id, fields=CHECK_FIELDS) for folder_id in cached
+    }
+    # Failed gets count as failed checks. Listing from the last good folder reports real errors anyway.
+    results, _ = execute_batched(requests, drive)
+
+    verified, parent_id = [], "root"
+    for depth, folder_id in enumerate(cached, start=1):
+        item = results.get(folder_id)
+        if item is None or not _is_child(item, segments[depth - 1], parent_id):
+            cache.invalidate(_cache_key(segments[:depth]))
+            break
+        verified.append(folder_id)
+        parent_id = folder_id
+    return verified
+
+
+def resolve_folder(
+    remote_path: str,
+    drive: GoogleDrive,
+    cache: Optional[FolderIdCache] = None,
+    create: Optional[Callable[[str, str], str]] = None,
+) -> Optional[str]:
+    """
+    Returns the ID of the folder at a Google Drive path.
+
+    Without a cache, this lists the folders of every level from the top. With one, the cached part of the path
+    is checked in a single batch request and only the levels below it are listed, so a path resolved before
+    costs one round trip. Every folder found or created is cached.
+
+    Args:
+        remote_path (str): The path, formatted as gdrive:path/to/folder.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        cache (FolderIdCache): The folder ID cache, None to always list.
+        create (function): Called with the name and parent ID of a missing folder, returns the ID of the new
+            folder. When None, a missing folder ends the lookup.
+
+    Returns:
+        str or None: The folder ID, "root" for gdrive:, or None if the folder does not exist and create is None.
+    """
+    segments = path_segments(remote_path)
+    with _create_lock if create is not None else contextlib.nullcontext():
+        verified = check_cached(segments, drive, cache) if cache is not None else []
+        folder_id = verified[-1] if verified else "root"
+
+        for depth in range(len(verified), len(segments)):
+            folders, _ = index_by_title(list_folders(folder_id, drive))
+            if segments[depth] in folders:
+                folder_id = folders[segments[depth]]["id"]
+            elif create is not None:
+                folder_id = create(segments[depth], folder_id)
+            else:
+                return None
+            if cache is not None:
+                cache.put(_cache_key(segments[: depth + 1]), folder_id)
+    return folder_id
@@ -0,0 +1,242 @@
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import httplib2
+from googleapiclient.errors import HttpError
+from pydrive2.drive import GoogleDrive
+
+from argsync.gdrive import pooled_http
+from argsync.metrics import metrics_for
+from argsync.state import get_cache_dir, write_json_atomic
+from argsync.throttle import MAX_RETRIES, backoff_delay, call_slot, is_retryable, report_outcome
+
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v2/files"
+# Chunks must be multiples of 256 KiB, except for the last one.
+CHUNK_ALIGNMENT = 256 * 1024
+# How many times an upload starts a new session after Google Drive dropped its session, before it gives up
+MAX_RESTARTS = 3
+CHUNK_SIZE = 8 * 1024 * 1024
+RESUMABLE_THRESHOLD = 32 * 1024 * 1024
+
+
+class UploadSessions:
+    """
+    On-disk record of unfinished resumable uploads, keyed by absolute local path.
+
+    A session is only reused while the file keeps the size and mtime it had when the session started,
+    and while it targets the same Google Drive file or folder.
+    """
+
+    def __init__(self, sessions_file: Optional[pathlib.Path] = None):
+        self.sessions_file = pathlib.Path(sessions_file) if sessions_file else get_cache_dir() / "uploads.json"
+        self._lock = threading.Lock()
+        try:
+            with open(self.sessions_file, "r") as f:
+                self._sessions: Dict[str, Dict] = json.load(f)
+        except (OSError, ValueError):
+            self._sessions = {}
+
+    def get(self, file_path: str, st: os.stat_result, target: str) -> Optional[Dict]:
+        """
+        Returns the saved session of a file if it can still be resumed.
+
+        Args:
+            file_path (str): The path of the local file.
+            st (os.stat_result): The current stat of the file.
+            target (str): The ID of the Google Drive file being updated, or of the parent folder.
+
+        Returns:
+            dict or None: The session with its uri and last confirmed offset.
+        """
+        with self._lock:
+            session = self._sessions.get(os.path.abspath(file_path))
+        if session and session["size"] == st.st_size and session["mtime_ns"] == st.st_mtime_ns:
+            if session["target"] == target:
+                return session
+        return None
+
+    def put(self, file_path: str, st: os.stat_result, target: str, uri: str, offset: int = 0) -> None:
+        """
+        Saves a new upload session of a file.
+
+        Args:
+            file_path (str): The path of the local file.
+            st (os.stat_result): The stat of the file when the session started.
+            target (str): The ID of the Google Drive file being updated, or of the parent folder.
+            uri (str): The session URI returned by Google Drive.
+            offset (int): The number of bytes already confirmed.
+        """
+        with self._lock:
+            self._sessions[os.path.abspath(file_path)] = {
+                "uri": uri,
+                "offset": offset,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "target": target,
+            }
+            self._save()
+
+    def advance(self, file_path: str, offset: int) -> None:
+        """
+        Saves the last confirmed offset of an upload session.
+
+        Args:
+            file_path (str): The path of the local file.
+            offset (int): The number of bytes confirmed by Google Drive.
+        """
+        with self._lock:
+            session = self._sessions.get(os.path.abspath(file_path))
+            if session is not None:
+                session["offset"] = offset
+                self._save()
+
+    def remove(self, file_path: str) -> None:
+        """
+        Drops the session of a file once it finished or expired.
+
+        Args:
+            file_path (str): The path of the local file.
+        """
+        with self._lock:
+            if self._sessions.pop(os.path.abspath(file_path), None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        write_json_atomic(self.sessions_file, self._sessions)
+
+
+class SessionExpired(Exception):
+    """Raised when Google Drive no longer knows an upload session."""
+
+
+class ResumableUploader:
+    """
+    Uploads large files in chunks through Google Drive resumable upload sessions.
+
+    The session URI and the last confirmed offset are saved after every chunk, so an upload that hits a
+    network error continues where it stopped, both on retry and on the next push.
+    """
+
+    def __init__(
+        self,
+        threshold: int = RESUMABLE_THRESHOLD,
+        chunk_size: int = CHUNK_SIZE,
+        sessions: Optional[UploadSessions] = None,
+        max_retries: int = MAX_RETRIES,
+        max_restarts: int = MAX_RESTARTS,
+    ):
+        if chunk_size % CHUNK_ALIGNMENT:
+            raise ValueError(f"chunk_size must be a multiple of {CHUNK_ALIGNMENT} bytes.")
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.sessions = sessions or UploadSessions()
+        self.max_retries = max_retries
+        self.max_restarts = max_restarts
+
+    def _start(self, http: httplib2.Http, file_metadata: Dict, size: int) -> str:
+        body = {k: v for k, v in file_metadata.items() if k != "id"}
+        if "id" in file_metadata:
+            uri, method = f"{UPLOAD_URL}/{file_metadata['id']}?uploadType=resumable", "PUT"
+        else:
+            uri, method = f"{UPLOAD_URL}?uploadType=resumable", "POST"
+        headers = {
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": file_metadata.get("mimeType", "application/octet-stream"),
+            "X-Upload-Content-Length": str(size),
+        }
+        resp, content = http.request(uri, method, body=json.dumps(body), headers=headers)
+        if resp.status != 200:
+            raise HttpError(resp, content, uri=uri)
+        return resp["location"]
+
+    def _query(self, http: httplib2.Http, uri: str, size: int) -> Tuple[int, Optional[Dict]]:
+        resp, content = http.request(uri, "PUT", body="", headers={"Content-Range": f"bytes */{size}"})
+        if resp.status in (200, 201):
+            return size, json.loads(content)
+        if resp.status == 308:
+            return _next_offset(resp), None
+        if resp.status in (404, 410):
+            raise SessionExpired(uri)
+        raise HttpError(resp, content, uri=uri)
+
+    def upload(self, file_metadata: Dict, file_path: str, drive: GoogleDrive) -> Dict:
+        """
+        Uploads a file, resuming a saved session for it if there is one.
+
+        Args:
+            file_metadata (dict): The metadata of the file. If it has an id, that file is updated.
+            file_path (str): The path of the local file.
+            drive (GoogleDrive): An instance of the GoogleDrive class.
+
+        Returns:
+            dict: The file resource returned by Google Drive.
+
+        Raises:
+            SessionExpired: If Google Drive dropped the session more than max_restarts times.
+        """
+        st = os.stat(file_path)
+        size = st.st_size
+        target = file_metadata.get("id") or file_metadata["parents"][0]["id"]
+        session = self.sessions.get(file_path, st, target)
+        uri, offset = (session["uri"], None) if session else (None, 0)
+        retries = restarts = 0
+
+        with open(file_path, "rb") as f:
+            while True:
+                start = time.perf_counter()
+                try:
+                    if uri is None:
+                        with pooled_http(drive) as http:
+                            uri, offset = self._start(http, file_metadata, size), 0
+                        self.sessions.put(file_path, st, target, uri)
+                    if offset is None:
+                        with pooled_http(drive) as http:
+                            offset, resource = self._query(http, uri, size)
+                        if resource is not None:
+                            self.sessions.remove(file_path)
+                            return resource
+                    f.seek(offset)
+                    data = f.read(self.chunk_size)
+                    headers = {"Content-Range": f"bytes {offset}-{offset + len(data) - 1}/{size}"}
+                    with call_slot(drive), pooled_http(drive) as http:
+                        start = time.perf_counter()
+                        resp, content = http.request(uri, "PUT", body=data, headers=headers)
+                    if resp.status in (200, 201):
+                        self.sessions.remove(file_path)
+                        return json.loads(content)
+                    if resp.status == 308:
+                        report_outcome(drive, "upload.chunk", time.perf_counter() - start)
+                        offset = _next_offset(resp)
+                        self.sessions.advance(file_path, offset)
+                        retries = 0
+                        continue
+                    if resp.status in (404, 410):
+                        raise SessionExpired(uri)
+                    raise HttpError(resp, content, uri=uri)
+                except SessionExpired:
+                    self.sessions.remove(file_path)
+                    restarts += 1
+                    if restarts > self.max_restarts:
+                        raise
+                    uri = None
+                except (OSError, httplib2.HttpLib2Error, HttpError) as e:
+                    report_outcome(drive, "upload.chunk", time.perf_counter() - start, e)
+                    if isinstance(e, HttpError) and not is_retryable(e):
+                        raise
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise
+                    metrics_for(drive).retried("upload.chunk")
+                    time.sleep(backoff_delay(retries))
+                    # Ask the server how much of the chunk arrived
+                    offset = None
+
+
+def _next_offset(resp: httplib2.Response) -> int:
+    match = re.match(r"bytes=0-(\d+)", resp.get("range", ""))
+    return int(match.group(1)) + 1 if match else 0
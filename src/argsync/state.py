@@ -0,0 +1,275 @@
+import collections
+import json
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from argsync.hashing import HashEngine, file_md5
+
+# Number of folder paths FolderIdCache keeps. The least recently used ones are dropped beyond that.
+MAX_FOLDER_IDS = 1024
+
+
+def get_cache_dir() -> pathlib.Path:
+    """
+    Returns the directory where argsync keeps its persistent state, creating it if needed.
+
+    Returns:
+        pathlib.Path: $XDG_CACHE_HOME/argsync, or ~/.cache/argsync when the variable is not set.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = pathlib.Path(base) / "argsync"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def write_json_atomic(path: pathlib.Path, data: Any, **kwargs) -> None:
+    """
+    Writes JSON to a file, replacing it atomically.
+
+    The data goes to a uniquely named temporary file next to path first, so concurrent argsync processes
+    saving the same file never write into each other's temporary file. The last one to finish wins.
+
+    Args:
+        path (pathlib.Path): The file to write.
+        data: The JSON-serializable data.
+        **kwargs: Passed on to json.dump, e.g. separators.
+    """
+    path = pathlib.Path(path)
+    fd, tmp_file = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp_file, path)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+class FileStateCache:
+    """
+    Persistent store of local file states, keyed by absolute path.
+
+    Every entry holds (size, mtime_ns, inode, md5). A file is only re-hashed when its stat tuple
+    differs from the stored one, so unchanged files are compared against gdrive without being read.
+    """
+
+    def __init__(self, state_file: Optional[pathlib.Path] = None):
+        self.state_file = pathlib.Path(state_file) if state_file else get_cache_dir() / "file_state.json"
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries: Dict[str, List] = {}
+        try:
+            with open(self.state_file, "r") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _stat_key(st: os.stat_result) -> List[int]:
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def lookup(self, file_path: str) -> Optional[str]:
+        """
+        Returns the cached md5 of a file if its stat tuple is unchanged.
+
+        Args:
+            file_path (str): The path of the local file.
+
+        Returns:
+            str or None: The cached md5, or None if the file is unknown or has changed.
+        """
+        file_path = os.path.abspath(file_path)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(file_path)
+        if entry is not None and entry[:3] == self._stat_key(st):
+            return entry[3]
+        return None
+
+    def md5(self, file_path: str) -> str:
+        """
+        Returns the md5 of a local file, hashing it only if the cache entry is missing or stale.
+
+        Args:
+            file_path (str): The path of the local file.
+
+        Returns:
+            str: The md5 hex digest of the file content.
+        """
+        cached = self.lookup(file_path)
+        if cached is not None:
+            return cached
+        st = os.stat(file_path)
+        md5 = file_md5(file_path)
+        self.record(file_path, md5, st)
+        return md5
+
+    def md5_many(self, file_paths: Iterable[str], engine: HashEngine) -> Iterator[Tuple[str, str]]:
+        """
+        Yields the md5 of many local files. Cached digests come first, the rest as the engine finishes them.
+
+        Args:
+            file_paths (iterable): The paths of the local files.
+            engine (HashEngine): The engine used to hash files whose cache entry is missing or stale.
+
+        Yields:
+            tuple: The path of a file and its md5 hex digest.
+        """
+        stale = {}
+        for file_path in file_paths:
+            cached = self.lookup(file_path)
+            if cached is not None:
+                yield file_path, cached
+            else:
+                stale[file_path] = os.stat(file_path)
+        for file_path, md5 in engine.imap_unordered(stale):
+            self.record(file_path, md5, stale[file_path])
+            yield file_path, md5
+
+    def record(self, file_path: str, md5: Optional[str], st: Optional[os.stat_result] = None) -> None:
+        """
+        Stores the md5 of a local file together with its current stat tuple.
+
+        Args:
+            file_path (str): The path of the local file.
+            md5 (str): The md5 hex digest of the file content. Nothing is stored if it is None.
+            st (os.stat_result): The stat taken when the content was hashed or transferred.
+                Defaults to the current stat of the file.
+        """
+        if md5 is None:
+            return
+        file_path = os.path.abspath(file_path)
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return
+        with self._lock:
+            self._entries[file_path] = self._stat_key(st) + [md5]
+            self._dirty = True
+
+    def forget(self, file_path: str) -> None:
+        """
+        Drops the entry of a local file, e.g. after it was removed.
+
+        Args:
+            file_path (str): The path of the local file.
+        """
+        with self._lock:
+            if self._entries.pop(os.path.abspath(file_path), None) is not None:
+                self._dirty = True
+
+    def move(self, old_path: str, new_path: str) -> None:
+        """
+        Carries the entries of a renamed file or folder over to its new path. Renaming keeps the size, mtime and
+        inode of the files, so their stored md5 stays valid.
+
+        Args:
+            old_path (str): The path before the rename.
+            new_path (str): The path after the rename.
+        """
+        old_path, new_path = os.path.abspath(old_path), os.path.abspath(new_path)
+        with self._lock:
+            moved = [p for p in self._entries if p == old_path or p.startswith(old_path + os.sep)]
+            for file_path in moved:
+                self._entries[new_path + file_path[len(old_path) :]] = self._entries.pop(file_path)
+            if moved:
+                self._dirty = True
+
+    def save(self) -> None:
+        """
+        Writes the store to disk if anything changed. The file is replaced atomically.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            write_json_atomic(self.state_file, self._entries, separators=(",", ":"))
+            self._dirty = False
+
+
+class FolderIdCache:
+    """
+    Persistent LRU map of Google Drive folder paths, formatted as gdrive:path/to/folder, to folder IDs.
+
+    Entries are hints, not facts: folders can be renamed, moved or trashed on gdrive at any time, so callers
+    check an ID before use and invalidate it when the check fails.
+    """
+
+    def __init__(self, cache_file: Optional[pathlib.Path] = None, max_entries: int = MAX_FOLDER_IDS):
+        self.cache_file = pathlib.Path(cache_file) if cache_file else get_cache_dir() / "folder_ids.json"
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+        try:
+            with open(self.cache_file, "r") as f:
+                # Stored least recently used first
+                self._entries.update((path, folder_id) for path, folder_id in json.load(f))
+        except (OSError, ValueError, TypeError):
+            self._entries.clear()
+
+    def get(self, path: str) -> Optional[str]:
+        """
+        Returns the cached ID of a folder and marks it as recently used.
+
+        Args:
+            path (str): The path of the folder on Google Drive.
+
+        Returns:
+            str or None: The cached folder ID, or None if the path is not cached.
+        """
+        with self._lock:
+            folder_id = self._entries.get(path)
+            if folder_id is not None:
+                self._entries.move_to_end(path)
+                self._dirty = True
+            return folder_id
+
+    def put(self, path: str, folder_id: str) -> None:
+        """
+        Caches the ID of a folder, dropping the least recently used entries beyond max_entries.
+
+        Args:
+            path (str): The path of the folder on Google Drive.
+            folder_id (str): The ID of the folder.
+        """
+        with self._lock:
+            if self._entries.get(path) != folder_id:
+                self._dirty = True
+            self._entries[path] = folder_id
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._dirty = True
+
+    def invalidate(self, path: str) -> None:
+        """
+        Drops a folder and every folder cached below it.
+
+        Args:
+            path (str): The path of the folder on Google Drive.
+        """
+        with self._lock:
+            stale = [p for p in self._entries if p == path or p.startswith(path.rstrip("/") + "/")]
+            for p in stale:
+                del self._entries[p]
+            self._dirty = self._dirty or bool(stale)
+
+    def save(self) -> None:
+        """
+        Writes the cache to disk if anything changed. The file is replaced atomically.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            write_json_atomic(self.cache_file, list(self._entries.items()), separators=(",", ":"))
+            self._dirty = False
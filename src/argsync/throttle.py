@@ -0,0 +1,290 @@
+import contextlib
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, TypeVar
+
+import httplib2
+from googleapiclient.errors import HttpError
+from pydrive2.drive import GoogleDrive
+from pydrive2.files import ApiRequestError
+
+from argsync.gdrive import pooled_http
+from argsync.metrics import metrics_for
+
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 32.0
+MAX_WORKERS = 32
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RETRYABLE_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "backendError")
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError, socket.timeout, httplib2.HttpLib2Error)
+
+# A call is healthy while it takes at most this many times the running average of its kind
+LATENCY_TOLERANCE = 2.0
+# Concurrency is cut at most once per this many seconds, since one overload fails many calls at once
+CUT_COOLDOWN = 1.0
+
+T = TypeVar("T")
+
+
+def _http_error(error: Exception) -> Optional[HttpError]:
+    if isinstance(error, HttpError):
+        return error
+    if isinstance(error, ApiRequestError) and error.args and isinstance(error.args[0], HttpError):
+        return error.args[0]
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Tells whether a failed call is worth retrying, i.e. it was rate limited, hit a server error or lost its
+    connection.
+
+    Args:
+        error (Exception): The error of the call, including PyDrive2's ApiRequestError.
+
+    Returns:
+        bool: True if the call should be retried.
+    """
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    http_error = _http_error(error)
+    if http_error is None:
+        return False
+    if http_error.resp.status in RETRYABLE_STATUS:
+        return True
+    return http_error.resp.status == 403 and any(reason in str(http_error) for reason in RETRYABLE_REASONS)
+
+
+def may_have_run(error: Exception) -> bool:
+    """
+    Tells whether a failed call may have been carried out anyway: Google Drive answered with a server error,
+    or the connection was lost before the answer arrived. Rate-limited calls were not carried out.
+
+    Args:
+        error (Exception): The error of the call, including PyDrive2's ApiRequestError.
+
+    Returns:
+        bool: True if the effect of the call may exist on Google Drive.
+    """
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    http_error = _http_error(error)
+    return http_error is not None and http_error.resp.status >= 500
+
+
+def is_overloaded(error: Exception) -> bool:
+    """
+    Tells whether a failed call means Google Drive wants fewer requests: a 403 rate limit, a 429 or a 5xx.
+
+    Args:
+        error (Exception): The error of the call.
+
+    Returns:
+        bool: True if concurrency should be cut back.
+    """
+    http_error = _http_error(error)
+    return http_error is not None and is_retryable(http_error)
+
+
+def backoff_delay(attempt: int, base: float = BASE_DELAY, cap: float = MAX_DELAY) -> float:
+    """
+    Returns how long to wait before a retry: exponential backoff with full jitter, so clients that failed
+    together do not retry together.
+
+    Args:
+        attempt (int): The number of the retry, starting at 1.
+        base (float): The delay ceiling of the first retry in seconds.
+        cap (float): The maximum delay ceiling in seconds.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class AdaptiveLimiter:
+    """
+    Caps the number of API calls in flight, and adapts the cap to how Google Drive responds.
+
+    The cap grows by one after a full round of healthy calls, i.e. as many calls as the cap that each took
+    no more than LATENCY_TOLERANCE times the average of their kind. It is halved on every 403 rate limit,
+    429 or 5xx response, at most once per CUT_COOLDOWN seconds. This is the additive-increase,
+    multiplicative-decrease scheme TCP uses for its congestion window.
+
+    Each cut also holds back new calls for a jittered, exponentially growing pause. Otherwise the slots
+    freed by calls sleeping before their retry would go straight to new calls, and the overload would go on.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = MAX_WORKERS):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._healthy = 0
+        self._latency: Dict[str, float] = {}
+        self._last_cut = float("-inf")
+        self._paused_until = 0.0
+        self._strikes = 0
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds one of the allowed concurrent calls for the duration of the with block."""
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._active >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    def succeeded(self, kind: str, seconds: float) -> None:
+        """
+        Reports a successful call.
+
+        Args:
+            kind (str): The kind of call, e.g. "files.list". Latency is only compared within a kind.
+            seconds (float): How long the call took.
+        """
+        with self._cond:
+            average = self._latency.get(kind, seconds)
+            self._latency[kind] = 0.9 * average + 0.1 * seconds
+            if seconds > LATENCY_TOLERANCE * average:
+                self._healthy = 0
+                return
+            self._healthy += 1
+            if self._healthy >= int(self.limit):
+                self._strikes = 0
+                if self.limit < self.maximum:
+                    self.limit += 1
+                    self._cond.notify()
+                self._healthy = 0
+
+    def overloaded(self) -> None:
+        """Reports a call that failed because Google Drive is overloaded or rate limiting."""
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_cut < CUT_COOLDOWN:
+                return
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_cut = now
+            self._healthy = 0
+            self._strikes += 1
+            self._paused_until = now + backoff_delay(self._strikes)
+
+
+def limiter_for(drive: GoogleDrive) -> Optional[AdaptiveLimiter]:
+    """
+    Returns the limiter attached to a drive with attach_limiter, if any.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+
+    Returns:
+        AdaptiveLimiter or None: The limiter, or None when concurrency is fixed.
+    """
+    return getattr(drive, "argsync_limiter", None)
+
+
+def attach_limiter(drive: GoogleDrive, limiter: Optional[AdaptiveLimiter]) -> None:
+    """
+    Makes every call through call_with_retries on a drive wait for a slot of limiter.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        limiter (AdaptiveLimiter): The limiter, or None to go back to fixed concurrency.
+    """
+    drive.argsync_limiter = limiter
+
+
+@contextlib.contextmanager
+def call_slot(drive: GoogleDrive) -> Iterator[None]:
+    """Holds a slot of the drive's limiter for the with block, or does nothing when there is none."""
+    limiter = limiter_for(drive)
+    if limiter is None:
+        yield
+    else:
+        with limiter.slot():
+            yield
+
+
+def report_outcome(drive: GoogleDrive, kind: str, seconds: float, error: Optional[Exception] = None) -> None:
+    """
+    Feeds the outcome of a call to the drive's limiter, if any.
+
+    Args:
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        kind (str): The kind of call.
+        seconds (float): How long the call took.
+        error (Exception): The error of the call, None if it succeeded.
+    """
+    limiter = limiter_for(drive)
+    if limiter is None:
+        return
+    if error is None:
+        limiter.succeeded(kind, seconds)
+    elif is_overloaded(error):
+        limiter.overloaded()
+
+
+def call_with_retries(
+    fn: Callable[[], T],
+    drive: GoogleDrive,
+    kind: str,
+    max_retries: int = MAX_RETRIES,
+    lookup: Optional[Callable[[], Optional[T]]] = None,
+) -> T:
+    """
+    Runs an API call, retrying it with jittered exponential backoff while it fails with a retryable error.
+
+    Each attempt waits for a slot of the drive's limiter, and reports back to it. It also leases a connection
+    from the drive's connection pool, which PyDrive2 and thread_http use for the duration of fn.
+
+    Running a call again is only safe for idempotent calls. Calls that create something, like inserts, pass
+    lookup: a call that may have been carried out despite its error is first looked up, and only run again if
+    its result is not on Google Drive.
+
+    Args:
+        fn (function): Makes the call. It must be safe to run again after a failure, unless lookup is given.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        kind (str): The kind of call, e.g. "files.list", for the limiter and the retry counts.
+        max_retries (int): Number of times a failed call is retried.
+        lookup (function): Called when a failed call may have run. Returns what fn would have returned if its
+            result exists, None otherwise.
+
+    Returns:
+        The result of fn, or of lookup.
+    """
+    attempt = 0
+    while True:
+        with call_slot(drive), pooled_http(drive):
+            start = time.perf_counter()
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                result, error = None, e
+            report_outcome(drive, kind, time.perf_counter() - start, error)
+        if error is None:
+            return result
+        attempt += 1
+        if not is_retryable(error) or attempt > max_retries:
+            raise error
+        if lookup is not None and may_have_run(error):
+            existing = lookup()
+            if existing is not None:
+                return existing
+        metrics_for(drive).retried(kind)
+        time.sleep(backoff_delay(attempt))
@@ -0,0 +1,411 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import click
+from pydrive2.drive import GoogleDrive
+
+from argsync.batch import BATCH_SIZE
+from argsync.gdrive import ensure_pool, load_authorized_gdrive
+from argsync.hashing import HashEngine
+from argsync.metrics import RunMetrics, instrument
+from argsync.plan import SyncPlan, index_local
+from argsync.push import apply_push_plan, check_upload, get_dest_dir_id, plan_push
+from argsync.resolve import cache_key
+from argsync.resumable import CHUNK_SIZE, RESUMABLE_THRESHOLD, ResumableUploader
+from argsync.state import FileStateCache, FolderIdCache
+from argsync.throttle import attach_limiter, backoff_delay
+from argsync.tree import FOLDER_MIME_TYPE, PARENTS_PER_QUERY, RemoteTree, list_children, list_tree
+
+# inotify event bits, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# What makes a folder dirty. Files count once they are closed after writing, not on every write.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds without events before a burst is synced, and the longest a burst is held back while events keep coming
+DEBOUNCE = 2.0
+MAX_DELAY = 30.0
+
+
+class Inotify:
+    """
+    A minimal binding of the Linux inotify API through ctypes, so watch mode needs no extra dependency.
+
+    Raises:
+        OSError: If inotify is not available, e.g. on macOS or Windows.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("inotify is not available on this system.")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        """
+        Starts watching a directory, or updates the watch of one that is watched already.
+
+        Args:
+            path (str): The directory.
+            mask (int): The events to report.
+
+        Returns:
+            int: The watch descriptor, which events refer to.
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """Stops a watch. Watches of removed directories are gone already, which is not an error."""
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout: Optional[float]) -> List[Tuple[int, int, str]]:
+        """
+        Waits for events and returns all that are queued.
+
+        Args:
+            timeout (float): Seconds to wait, None to wait until there is an event.
+
+        Returns:
+            list: The (watch descriptor, mask, name) of every event. The name is empty for events of the
+                watched directory itself.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class DirtyFolders:
+    """
+    Watches a local folder tree and collects the folders whose direct content changed.
+
+    Folders are named by their path relative to the parent of the watched folder, like the paths of a SyncPlan.
+    New folders are watched as they appear, and everything below a new or moved-in folder counts as dirty.
+
+    Attributes:
+        overflowed (bool): Set when the kernel dropped events, so only a full sync is reliable.
+    """
+
+    def __init__(self, src_full_path: str, ignore_dirs: Iterable[str] = (), inotify: Optional[Inotify] = None):
+        self.src_full_path = src_full_path
+        self.parent_folder = os.path.dirname(src_full_path)
+        self.ignore_dirs = set(ignore_dirs)
+        self.inotify = inotify or Inotify()
+        self.overflowed = False
+        self._paths: Dict[int, str] = {}
+        self._dirty: Set[str] = set()
+        self._watch_tree(src_full_path)
+        self._dirty.clear()
+
+    def _watch_tree(self, folder_path: str) -> None:
+        for root, dirs, _ in os.walk(folder_path, topdown=True):
+            dirs[:] = [d for d in dirs if d not in self.ignore_dirs]
+            try:
+                wd = self.inotify.add_watch(root)
+            except OSError:
+                # Removed since the walk listed it
+                continue
+            rel = os.path.relpath(root, self.parent_folder)
+            self._paths[wd] = rel
+            self._dirty.add(rel)
+
+    def _unwatch_tree(self, rel: str) -> None:
+        for wd in [wd for wd, path in self._paths.items() if path == rel or path.startswith(rel + os.sep)]:
+            self.inotify.rm_watch(wd)
+            del self._paths[wd]
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        folder = self._paths.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self._paths[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if folder == os.path.basename(self.src_full_path):
+                raise click.ClickException(f"{self.src_full_path} was removed or moved away.")
+            return
+        self._dirty.add(folder)
+        if mask & IN_ISDIR and name not in self.ignore_dirs:
+            path = os.path.join(folder, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(os.path.join(self.parent_folder, path))
+            elif mask & IN_MOVED_FROM:
+                # The watches follow the folder wherever it went, and it is watched again if it turns up inside
+                self._unwatch_tree(path)
+
+    def wait(self, debounce: float = DEBOUNCE, max_delay: float = MAX_DELAY) -> Set[str]:
+        """
+        Blocks until something changed, then collects events until there were none for debounce seconds, or
+        until max_delay seconds passed since the first one.
+
+        Args:
+            debounce (float): Seconds of quiet that end a burst.
+            max_delay (float): The longest a burst is collected.
+
+        Returns:
+            set: The dirty folders. Check overflowed before using them.
+        """
+        while not self._dirty and not self.overflowed:
+            for event in self.inotify.read(None):
+                self._handle(*event)
+        deadline = time.monotonic() + max_delay
+        while not self.overflowed:
+            timeout = min(debounce, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            events = self.inotify.read(timeout)
+            if not events:
+                break
+            for event in events:
+                self._handle(*event)
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def mark(self, folders: Iterable[str]) -> None:
+        """
+        Marks folders dirty again, e.g. after their sync failed, so the next wait returns them.
+
+        Args:
+            folders (iterable): The folder paths, as returned by wait.
+        """
+        self._dirty.update(folders)
+
+    def close(self) -> None:
+        self.inotify.close()
+
+
+def list_dirty(
+    folder_name: str,
+    parent_folder: str,
+    dirty: Set[str],
+    ignore_dirs: Iterable[str],
+    parents_id: Dict[str, str],
+    drive: GoogleDrive,
+    num_of_workers: int,
+) -> Tuple[Dict[str, Dict[str, int]], RemoteTree]:
+    """
+    Indexes both sides of the dirty folders only, for plan_push.
+
+    Each dirty folder is compared with its direct content on gdrive, listed in queries of up to
+    PARENTS_PER_QUERY folders. Folders on gdrive that are gone locally are listed with everything below them,
+    so what they held can be matched with files that moved elsewhere.
+
+    Args:
+        folder_name (str): The name of the watched folder.
+        parent_folder (str): The local folder containing it.
+        dirty (set): The relative paths of the dirty folders.
+        ignore_dirs (iterable): Names of directories that are not synced.
+        parents_id (dict): Maps the folder paths on gdrive to their IDs. Folders that are only found now are added.
+        drive (GoogleDrive): An instance of the GoogleDrive class.
+        num_of_workers (int): Number of queries in flight when listing gone folders.
+
+    Returns:
+        tuple: The local index and the remote tree of the dirty folders.
+    """
+    local = {}
+    for folder_dir in dirty:
+        folder_path = os.path.join(parent_folder, folder_dir)
+        if os.path.isdir(folder_path):
+            # index_local names the folder relative to its own parent
+            (local[folder_dir],) = index_local(folder_path, ignore_dirs, recursive=False).values()
+
+    tree = RemoteTree(folder_name, parents_id[folder_name])
+    tree.parents_id = parents_id
+    tree.files = {}
+    listed = {parents_id[d]: d for d in dirty if d in parents_id}
+    for folder_dir in listed.values():
+        tree.files[folder_dir] = []
+    ids = list(listed)
+    gone = []
+    for i in range(0, len(ids), PARENTS_PER_QUERY):
+        for item in list_children(ids[i : i + PARENTS_PER_QUERY], drive):
+            parent_path = next(listed[p["id"]] for p in item["parents"] if p["id"] in listed)
+            path = os.path.join(parent_path, item["title"])
+            if item["mimeType"] != FOLDER_MIME_TYPE:
+                tree.files[parent_path].append(item)
+            elif path not in tree.files and item["title"] not in ignore_dirs:
+                parents_id.setdefault(path, item["id"])
+                if not os.path.isdir(os.path.join(parent_folder, path)):
+                    gone.append((path, item["id"]))
+    for path, folder_id in gone:
+        subtree = list_tree(path, folder_id, drive, num_of_workers)
+        tree.files.update(subtree.files)
+        parents_id.update(subtree.parents_id)
+    return local, tree
+
+
+def watch(
+    src_full_path: str,
+    dest_dir: str,
+    ignore_dirs: Tuple[str],
+    num_of_uploader: int,
+    batch_size: int = BATCH_SIZE,
+    resumable_threshold: int = RESUMABLE_THRESHOLD,
+    chunk_size: int = CHUNK_SIZE,
+    debounce: float = DEBOUNCE,
+    max_delay: float = MAX_DELAY,
+    drive: Optional[GoogleDrive] = None,
+    stats: bool = False,
+    max_syncs: Optional[int] = None,
+) -> None:
+    """
+    Pushes a local folder once, then keeps pushing what changes in it until interrupted.
+
+    Changes are picked up through inotify. A burst of events is synced once it settles, and only the folders
+    whose direct content changed are compared, instead of walking and listing the whole tree again. Moves and
+    copies are detected as on a full push. If the kernel drops events, the next sync is a full one.
+
+    Args:
+        src_full_path (str): The local path to push from.
+        dest_dir (str): The destination directory path on Google Drive.
+        ignore_dirs (list): A list of directories to ignore.
+        num_of_uploader(int): Number of workers in threading executor.
+        batch_size (int): Number of calls per batch request when creating, moving, copying and trashing.
+        resumable_threshold (int): Files of at least this many bytes are uploaded in resumable chunks.
+        chunk_size (int): Size of the chunks of resumable uploads in bytes, a multiple of 256 KiB.
+        debounce (float): Seconds without changes before a burst of changes is synced.
+        max_delay (float): The longest a burst of changes waits before it is synced anyway.
+        drive (GoogleDrive): The Google Drive to use, e.g. the FakeDrive of the benchmarks. Loads the saved credentials when None.
+        stats (bool): Print the stats of every sync.
+        max_syncs (int): Stop after this many syncs following the first push, None to go on until interrupted.
+    """
+    try:
+        dirty_folders = DirtyFolders(src_full_path, ignore_dirs)
+    except OSError as e:
+        raise click.ClickException(f"Cannot watch {src_full_path}: {e}")
+    if drive is None:
+        drive = load_authorized_gdrive()
+    attach_limiter(drive, None)
+    ensure_pool(drive, num_of_uploader)
+    state = FileStateCache()
+    folder_ids = FolderIdCache()
+    uploader = ResumableUploader(resumable_threshold, chunk_size)
+    dest_dir = dest_dir.rstrip("/")
+    folder_name = src_full_path.split(os.path.sep)[-1]
+    parent_folder = os.path.dirname(src_full_path)
+    parents_id: Dict[str, str] = {}
+
+    def sync(dirty: Optional[Set[str]]) -> None:
+        metrics = RunMetrics("watch")
+        instrument(drive, metrics)
+        plan = SyncPlan("push", src_full_path, os.path.join(dest_dir, folder_name))
+        try:
+            if dirty is None:
+                parents_id.clear()
+                with metrics.phase("resolve"):
+                    folder_id = check_upload(src_full_path, dest_dir, drive, folder_ids)
+                    if folder_id is None:
+                        parents_id[""] = get_dest_dir_id(dest_dir, drive, cache=folder_ids)
+                local, tree = None, None
+                if folder_id is not None:
+                    with metrics.phase("listing"):
+                        tree = list_tree(folder_name, folder_id, drive, num_of_uploader)
+                    parents_id.update(tree.parents_id)
+            else:
+                with metrics.phase("listing"):
+                    local, tree = list_dirty(
+                        folder_name, parent_folder, dirty, ignore_dirs, parents_id, drive, num_of_uploader
+                    )
+            with HashEngine() as hasher:
+                plan_push(src_full_path, tree, ignore_dirs, drive, state, hasher, plan, local)
+            if plan:
+                apply_push_plan(
+                    plan, src_full_path, parents_id, drive, num_of_uploader, batch_size, state, uploader, metrics
+                )
+            if dirty is None and tree is None:
+                folder_ids.put(cache_key(f"{dest_dir}/{folder_name}"), parents_id[folder_name])
+        finally:
+            state.save()
+            folder_ids.save()
+            metrics.finish()
+        totals = plan.totals()
+        done = ", ".join(f"{kind} {t['count']}" for kind, t in totals.items()) or "nothing to do"
+        print(
+            f"[{time.strftime('%H:%M:%S')}] Synced {'everything' if dirty is None else f'{len(dirty)} folders'}: {done}."
+        )
+        if stats:
+            print(metrics.summary())
+
+    failures = 0
+
+    def try_sync(dirty: Optional[Set[str]]) -> None:
+        # A failed sync does not stop the watch: its folders are synced again with the next changes
+        nonlocal failures
+        try:
+            sync(dirty)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            delay = backoff_delay(failures)
+            print(f"[{time.strftime('%H:%M:%S')}] Sync failed: {e}. Retrying in {delay:.1f}s.")
+            if dirty is None:
+                # Only a full sync is reliable after the first one or an overflow failed
+                dirty_folders.overflowed = True
+            else:
+                dirty_folders.mark(dirty)
+            time.sleep(delay)
+
+    print(f"Watching {src_full_path}. Press Ctrl+C to stop.")
+    if ignore_dirs:
+        print(f"Ignoring dirs: {' '.join(ignore_dirs)}")
+    try:
+        try_sync(None)
+        syncs = 0
+        while max_syncs is None or syncs < max_syncs:
+            dirty = dirty_folders.wait(debounce, max_delay)
+            if dirty_folders.overflowed:
+                dirty_folders.overflowed = False
+                try_sync(None)
+            else:
+                try_sync(dirty)
+            syncs += 1
+    except KeyboardInterrupt:
+        print("Watch stopped.")
+    finally:
+        dirty_folders.close()